@@ -3,6 +3,10 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 
 from abc import ABCMeta, abstractmethod
+from datetime import timedelta
+
+from django.core.cache import cache
+from django.utils import timezone
 
 
 class BaseBackend(object):
@@ -40,3 +44,64 @@ class BaseBackend(object):
         :return: tuple of the number of contacts created, updated, deleted and ignored
         """
         pass
+
+    @staticmethod
+    def _get_poll_results_counts_delta(poll):
+        """
+        Gets the delta a sync adds the counts of the results it writes to, None when the counters are rebuilt
+        """
+        from rtm.backend.diff import PollResultsCountsDelta
+        from rtm.polls.models import POLL_RESULTS_INCREMENTAL_COUNTS
+
+        if not POLL_RESULTS_INCREMENTAL_COUNTS:
+            return None
+
+        return PollResultsCountsDelta(poll)
+
+    @staticmethod
+    def _mark_poll_results_sync_paused(org, poll, cursor, after, before, batches_latest, countdown=300):
+        from rtm.polls.models import Poll
+        from rtm.polls.scheduler import take_pull_slot
+        from rtm.polls.tasks import pull_poll_results
+        from rtm.utils import datetime_to_json_date
+
+        cache.set(Poll.POLL_RESULTS_LAST_PULL_CURSOR % (org.pk, poll.flow_uuid), cursor, None)
+        cache.set(Poll.POLL_RESULTS_CURSOR_AFTER_CACHE_KEY % (org.pk, poll.flow_uuid), after, None)
+        cache.set(Poll.POLL_RESULTS_CURSOR_BEFORE_CACHE_KEY % (org.pk, poll.flow_uuid), before, None)
+        cache.set(Poll.POLL_RESULTS_BATCHES_LATEST_CACHE_KEY % (org.pk, poll.flow_uuid), batches_latest, None)
+
+        # the sync resumes on its own, keep the scheduler from pulling the flow again before then
+        cache.set(
+            Poll.POLL_RESULTS_PAUSED_UNTIL_CACHE_KEY % (org.pk, poll.flow_uuid),
+            datetime_to_json_date(timezone.now() + timedelta(seconds=countdown)),
+            countdown,
+        )
+
+        # the pull keeps its slot while it waits so paused pulls count against the pulls running at the same time
+        slot = take_pull_slot(org.pk, poll.flow_uuid, countdown + Poll.POLL_SYNC_LOCK_TIMEOUT)
+        pull_poll_results.apply_async((poll.pk, slot), countdown=countdown, queue="sync")
+
+    @staticmethod
+    def _mark_poll_results_sync_completed(poll, org, latest_synced_obj_time):
+        from rtm.polls.models import Poll
+        from rtm.utils import datetime_to_json_date
+
+        # update the time for this poll from which we fetch next time
+        cache.set(Poll.POLL_RESULTS_LAST_PULL_CACHE_KEY % (org.pk, poll.flow_uuid), latest_synced_obj_time, None)
+        # update the last time the sync happened
+        cache.set(
+            Poll.POLL_RESULTS_LAST_SYNC_TIME_CACHE_KEY % (org.pk, poll.flow_uuid),
+            datetime_to_json_date(timezone.now()),
+            None,
+        )
+        # clear the saved cursor
+        cache.delete(Poll.POLL_RESULTS_LAST_PULL_CURSOR % (org.pk, poll.flow_uuid))
+        cache.delete(Poll.POLL_RESULTS_PAUSED_UNTIL_CACHE_KEY % (org.pk, poll.flow_uuid))
+
+        # Use redis cache with expiring(in 48 hrs) key to allow other polls task
+        # to sync all polls without hitting the API rate limit
+        cache.set(
+            Poll.POLL_RESULTS_LAST_OTHER_POLLS_SYNCED_CACHE_KEY % (org.id, poll.flow_uuid),
+            datetime_to_json_date(timezone.now()),
+            Poll.POLL_RESULTS_LAST_OTHER_POLLS_SYNCED_CACHE_TIMEOUT,
+        )
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import json
+import os
+import tempfile
+import time
+import zlib
+from collections import defaultdict
+
+# size of the compressed chunks we read from an archive download
+ARCHIVE_DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# maximum number of decompressed bytes we produce from a single compressed chunk at a time
+ARCHIVE_DECOMPRESS_MAX_LENGTH = 1024 * 1024
+
+
+def _gzip_decompressor():
+    # 16 + MAX_WBITS makes zlib expect and skip the gzip header and trailer
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+
+def iter_gzip_lines(chunks):
+    """
+    Decompresses a gzip stream given as an iterable of compressed byte chunks and yields its lines.
+
+    Only the current chunk, at most ARCHIVE_DECOMPRESS_MAX_LENGTH decompressed bytes and the current
+    partial line are held in memory at any time.
+    """
+    decompressor = _gzip_decompressor()
+    pending = b""
+
+    for chunk in chunks:
+        data = chunk
+        while data:
+            pending += decompressor.decompress(data, ARCHIVE_DECOMPRESS_MAX_LENGTH)
+            data = decompressor.unconsumed_tail
+
+            # concatenated gzip members, start a new decompressor on what follows the finished one
+            if decompressor.eof:
+                data = decompressor.unused_data
+                decompressor = _gzip_decompressor()
+
+            lines = pending.split(b"\n")
+            pending = lines.pop()
+            for line in lines:
+                yield line
+
+    pending += decompressor.flush()
+    for line in pending.split(b"\n"):
+        if line:
+            yield line
+
+
+class ArchiveStore(object):
+    """
+    Local store of decompressed run archives, keyed by the org and the archive hash or period. The store is on
+    the local disk of each worker, every worker downloads the archives it needs once.
+
+    Each archive is saved once as plain lines next to a sidecar index mapping every flow UUID to the byte
+    offsets of its records, so polls can read only their own records and skip archives without any.
+    """
+
+    DATA_SUFFIX = ".jsonl"
+    INDEX_SUFFIX = ".index.json"
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    @staticmethod
+    def get_archive_key(org_id, archive):
+        # archives without a hash are only told apart by their period, which every workspace has
+        if archive.hash:
+            return "%d_%s" % (org_id, archive.hash)
+
+        return "%d_%s_%s" % (org_id, archive.period, archive.start_date.strftime("%Y%m%d"))
+
+    def _data_path(self, key):
+        return os.path.join(self.directory, key + self.DATA_SUFFIX)
+
+    def _index_path(self, key):
+        return os.path.join(self.directory, key + self.INDEX_SUFFIX)
+
+    def has_archive(self, key):
+        # the index is written last, so an archive is only complete once it exists
+        return os.path.exists(self._index_path(key))
+
+    def save_archive(self, key, chunks):
+        """
+        Decompresses and saves an archive from its compressed byte chunks, building its flow index as it goes
+        """
+        os.makedirs(self.directory, exist_ok=True)
+
+        flow_offsets = defaultdict(list)
+        data_fd, data_tmp_path = tempfile.mkstemp(dir=self.directory, suffix=self.DATA_SUFFIX)
+        try:
+            with os.fdopen(data_fd, "wb") as data_file:
+                offset = 0
+                for line in iter_gzip_lines(chunks):
+                    if not line:
+                        continue
+
+                    flow_uuid = json.loads(line.decode("utf-8")).get("flow", dict()).get("uuid")
+                    if flow_uuid:
+                        flow_offsets[flow_uuid].append(offset)
+
+                    data_file.write(line + b"\n")
+                    offset += len(line) + 1
+
+            os.replace(data_tmp_path, self._data_path(key))
+        except Exception:
+            os.remove(data_tmp_path)
+            raise
+
+        index_fd, index_tmp_path = tempfile.mkstemp(dir=self.directory, suffix=self.INDEX_SUFFIX)
+        with os.fdopen(index_fd, "w") as index_file:
+            json.dump(flow_offsets, index_file)
+        os.replace(index_tmp_path, self._index_path(key))
+
+    def get_flow_offsets(self, key, flow_uuid):
+        index_path = self._index_path(key)
+
+        # mark the archive as used, access times are not reliable on every mount
+        os.utime(index_path)
+        with open(index_path) as index_file:
+            return json.load(index_file).get(flow_uuid, [])
+
+    def iter_flow_records(self, key, flow_uuid):
+        """
+        Yields the decoded records of the given flow in the archive, reading nothing else from it
+        """
+        offsets = self.get_flow_offsets(key, flow_uuid)
+        if not offsets:
+            return
+
+        with open(self._data_path(key), "rb") as data_file:
+            for offset in offsets:
+                if data_file.tell() != offset:
+                    data_file.seek(offset)
+                yield json.loads(data_file.readline().decode("utf-8"))
+
+    def prune(self, max_age):
+        """
+        Removes the archives not read or written in the last max_age seconds, returns how many were removed
+        """
+        if not os.path.isdir(self.directory):
+            return 0
+
+        threshold = time.time() - max_age
+        removed = 0
+        for filename in os.listdir(self.directory):
+            if not filename.endswith(self.INDEX_SUFFIX):
+                continue
+
+            key = filename[: -len(self.INDEX_SUFFIX)]
+            index_path = self._index_path(key)
+            if os.path.getmtime(index_path) >= threshold:
+                continue
+
+            os.remove(index_path)
+            if os.path.exists(self._data_path(key)):
+                os.remove(self._data_path(key))
+            removed += 1
+
+        return removed
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from collections import defaultdict
+
+from django.db import transaction
+
+from rtm.polls.models import PollResult
+from rtm.polls.rebuilds import mark_flow_dirty
+
+from .loaders import POLL_RESULTS_LOADER_INSERT, save_poll_results
+from .records import PollResultRecord
+
+POLL_RESULT_KIND_VALUE = "val"
+POLL_RESULT_KIND_PATH = "path"
+
+# the columns of the results already in the db needed to generate their counters and stats
+POLL_RESULT_COUNTED_FIELDS = (
+    "org_id",
+    "flow",
+    "ruleset",
+    "contact",
+    "date",
+    "category",
+    "text",
+    "state",
+    "district",
+    "ward",
+    "gender",
+    "born",
+)
+
+
+class PollResultsCountsDelta(object):
+    """
+    Changes to the counters and poll stats of a poll from the results a sync writes, the counts of the old value
+    of every written result are taken away and the ones of its new value added. The counters are shared by the
+    polls of the flow, the stats are projected on the questions of each of them
+    """
+
+    def __init__(self, poll):
+        self.poll = poll
+        self.counters = defaultdict(int)
+        self.stats = defaultdict(int)
+        self.polls = None
+        self.lookups = None
+
+    def add(self, old_result, new_result):
+        if old_result is not None:
+            for key, count in old_result.generate_counters().items():
+                self.counters[(old_result.org_id, old_result.ruleset, key)] -= count
+            for key, count in old_result.generate_poll_stats().items():
+                self.stats[key] -= count
+
+        for key, count in new_result.generate_counters().items():
+            self.counters[(new_result.org_id, new_result.ruleset, key)] += count
+        for key, count in new_result.generate_poll_stats().items():
+            self.stats[key] += count
+
+    def apply(self):
+        """
+        Writes the changes added since the last call
+        """
+        if self.polls is None:
+            self.polls = list(self.poll.get_flow_polls())
+            self.lookups = {poll.pk: poll.get_poll_stats_lookups() for poll in self.polls}
+
+        for i, poll in enumerate(self.polls):
+            counters = self.counters if i == 0 else dict()
+            poll.apply_poll_results_counts_delta(counters, self.stats, self.lookups[poll.pk])
+
+        self.counters = defaultdict(int)
+        self.stats = defaultdict(int)
+
+
+class PollResultsDiff(object):
+    """
+    Backend agnostic diff of the poll results of a fetch. Backends normalize each step of their runs and add it
+    here, the newest step of every contact and question is kept and written with the given loader, which keeps
+    the newest between it and the result already in the db.
+    """
+
+    # the contact columns used when the contact of a run is not synced yet
+    EMPTY_CONTACT = ("", "", "", None, None)
+
+    def __init__(self, org_id, flow_uuid, stats_dict, counts_delta=None):
+        self.org_id = org_id
+        self.flow_uuid = flow_uuid
+        self.stats_dict = stats_dict
+        self.counts_delta = counts_delta
+
+        # (contact, ruleset) -> PollResultRecord
+        self.records = dict()
+
+    def add_value(self, contact_uuid, ruleset_uuid, category, text, contact_record, date, completed):
+        """
+        Adds the value of a run, replacing the kept step if this one differs and is newer
+        """
+        key = (contact_uuid, ruleset_uuid)
+        state, district, ward, born, gender = contact_record or self.EMPTY_CONTACT
+        existing = self.records.get(key, None)
+
+        if existing is not None:
+            self.stats_dict["num_val_ignored"] += 1
+
+            if not self.is_update_required(
+                existing, category, text, state, district, ward, born, gender, completed, date
+            ):
+                return
+
+        self.records[key] = PollResultRecord(
+            POLL_RESULT_KIND_VALUE,
+            self.org_id,
+            self.flow_uuid,
+            ruleset_uuid,
+            contact_uuid,
+            date,
+            completed,
+            category,
+            text,
+            state,
+            district,
+            ward,
+            gender,
+            born,
+        )
+
+    def add_path(self, contact_uuid, ruleset_uuid, contact_record, date, completed):
+        """
+        Adds a path step of a run to a question, replacing the kept step if this one is newer
+        """
+        key = (contact_uuid, ruleset_uuid)
+        existing = self.records.get(key, None)
+
+        if existing is not None:
+            self.stats_dict["num_path_ignored"] += 1
+
+            if not date > existing.date:
+                return
+
+        state, district, ward, born, gender = contact_record or self.EMPTY_CONTACT
+        self.records[key] = PollResultRecord(
+            POLL_RESULT_KIND_PATH,
+            self.org_id,
+            self.flow_uuid,
+            ruleset_uuid,
+            contact_uuid,
+            date,
+            completed,
+            None,
+            "",
+            state,
+            district,
+            ward,
+            gender,
+            born,
+        )
+
+    def ignore(self, kind):
+        self.stats_dict["num_%s_ignored" % kind] += 1
+
+    @staticmethod
+    def is_update_required(record, category, text, state, district, ward, born, gender, completed, date):
+        if record.date is None:
+            return True
+
+        # if the reporter answered the step, check if this is a newer run
+        if not date > record.date:
+            return False
+
+        return (record.category, record.text, record.state, record.district, record.ward) != (
+            category,
+            text,
+            state,
+            district,
+            ward,
+        ) or (record.born, record.gender, record.completed) != (born, gender, completed)
+
+    def get_existing_results(self, keys):
+        """
+        Gets the results in the db for the given (contact, ruleset) keys
+        """
+        contact_uuids = set(contact_uuid for contact_uuid, ruleset_uuid in keys)
+        existing = PollResult.objects.filter(org_id=self.org_id, flow=self.flow_uuid, contact__in=contact_uuids)
+
+        return {
+            (result.contact, result.ruleset): result
+            for result in existing.only(*POLL_RESULT_COUNTED_FIELDS)
+            if (result.contact, result.ruleset) in keys
+        }
+
+    def save(self, loader=POLL_RESULTS_LOADER_INSERT):
+        """
+        Writes the kept steps and counts them by kind as created, updated or ignored in the sync stats, along with
+        the changes to the counters when they are maintained incrementally
+        """
+        records = self.records
+        self.records = dict()
+
+        num_written = 0
+
+        with transaction.atomic():
+            existing = dict()
+            if self.counts_delta is not None and records:
+                existing = self.get_existing_results(records.keys())
+
+            for contact_uuid, ruleset_uuid, created in save_poll_results(list(records.values()), loader):
+                record = records.pop((contact_uuid, ruleset_uuid))
+                num_written += 1
+                self.stats_dict["num_%s_%s" % (record.kind, "created" if created else "updated")] += 1
+
+                if self.counts_delta is not None:
+                    self.counts_delta.add(existing.get((contact_uuid, ruleset_uuid)), record.as_poll_result())
+
+            if self.counts_delta is not None:
+                self.counts_delta.apply()
+
+        # without a delta the counters of the flow need a rebuild to pick up these changes, a delta that can not be
+        # applied rolls back the results along with it
+        if num_written and self.counts_delta is None:
+            mark_flow_dirty(self.org_id, self.flow_uuid)
+
+        # whatever was not written is older than the result we already have
+        for record in records.values():
+            self.stats_dict["num_%s_ignored" % record.kind] += 1
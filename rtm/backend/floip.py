@@ -3,23 +3,23 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 import logging
 import time
-from collections import defaultdict
 
 import requests
 from dash.utils.sync import BaseSyncer, sync_local_to_changes
 from django_redis import get_redis_connection
-from temba_client.v2 import TembaClient
 
-from django.conf import settings
-from django.core.cache import cache
 from django.utils import timezone
 
 from rtm.contacts.models import Contact
 from rtm.locations.models import Boundary
-from rtm.polls.models import Poll, PollQuestion, PollResponseCategory, PollResult
+from rtm.polls.models import Poll, PollQuestion, PollResponseCategory, SyncRun
 from rtm.utils import datetime_to_json_date, json_date_to_datetime
 
 from . import BaseBackend
+from .diff import PollResultsDiff
+from .loaders import get_poll_results_loader
+from .ratelimit import RateLimitedTembaClient
+from .records import get_contact_records_map
 
 logger = logging.getLogger(__name__)
 
@@ -186,8 +186,7 @@ class FLOIPBackend(BaseBackend):
     """
 
     def _get_client(self, org):
-        agent = getattr(settings, "SITE_API_USER_AGENT", None)
-        return TembaClient(self.backend.host, self.backend.api_token, user_agent=agent)
+        return RateLimitedTembaClient.for_backend(self.backend)
 
     def pull_fields(self, org):
         # Not needed
@@ -297,7 +296,7 @@ class FLOIPBackend(BaseBackend):
             for category in choices:
                 PollResponseCategory.update_or_create(question, None, category)
 
-    def pull_results(self, poll, modified_after, modified_before, progress_callback=None):
+    def pull_results(self, poll, modified_after, modified_before, progress_callback=None, loader=None):
         org = poll.org
         r = get_redis_connection()
         key = Poll.POLL_PULL_RESULTS_TASK_LOCK % (org.pk, poll.flow_uuid)
@@ -340,6 +339,11 @@ class FLOIPBackend(BaseBackend):
                     pull_after_delete,
                 ) = poll.get_pull_cached_params()
 
+                # first time syncs can load many runs, allow those to be streamed through COPY
+                loader = get_poll_results_loader(
+                    loader, first_sync=latest_synced_obj_time is None or pull_after_delete is not None
+                )
+
                 if pull_after_delete is not None:
                     after = None
                     latest_synced_obj_time = None
@@ -352,6 +356,8 @@ class FLOIPBackend(BaseBackend):
                     after = latest_synced_obj_time
 
                 start = time.time()
+                sync_run = SyncRun.start(poll, SyncRun.SOURCE_API)
+                counts_delta = self._get_poll_results_counts_delta(poll)
                 logger.info("Start fetching runs for poll #%d on org #%d" % (poll.pk, org.pk))
 
                 params = dict(
@@ -359,14 +365,16 @@ class FLOIPBackend(BaseBackend):
                 )
 
                 while poll_results_url:
+                    fetch_start = time.time()
                     response = requests.request("GET", poll_results_url, headers=headers, params=params)
                     response_json = response.json()
 
                     results = response_json["data"]["attributes"]["responses"]
                     poll_results_url = response_json["data"]["relationships"]["links"]["next"]
 
-                    contacts_map, poll_results_map, poll_results_to_save_map = self._initiate_lookup_maps(
-                        results, org, poll
+                    process_start = time.time()
+                    contacts_map, poll_results_diff = self._initiate_lookup_maps(
+                        results, org, poll, stats_dict, counts_delta
                     )
 
                     for result in results:
@@ -376,22 +384,20 @@ class FLOIPBackend(BaseBackend):
                             batches_latest = result[0]
 
                         contact_obj = contacts_map.get(result[2], None)
-                        self._process_run_poll_results(
-                            org,
-                            poll.flow_uuid,
-                            questions_uuids,
-                            result,
-                            contact_obj,
-                            poll_results_map,
-                            poll_results_to_save_map,
-                            stats_dict,
-                        )
+                        self._process_run_poll_results(questions_uuids, result, contact_obj, poll_results_diff)
 
                         stats_dict["num_synced"] += len(results)
                         if progress_callback:
                             progress_callback(stats_dict["num_synced"])
 
-                    self._save_new_poll_results_to_database(poll_results_to_save_map)
+                    write_start = time.time()
+                    poll_results_diff.save(loader)
+                    sync_run.add_fetch(
+                        len(results),
+                        process_start - fetch_start,
+                        write_start - process_start,
+                        time.time() - write_start,
+                    )
 
                     logger.info(
                         "Processed fetch of %d - %d "
@@ -402,7 +408,12 @@ class FLOIPBackend(BaseBackend):
                     logger.info("=" * 40)
 
                     if stats_dict["num_synced"] >= Poll.POLL_RESULTS_MAX_SYNC_RUNS or time.time() > lock_expiration:
-                        poll.rebuild_poll_results_counts()
+                        if stats_dict["num_synced"] >= Poll.POLL_RESULTS_MAX_SYNC_RUNS:
+                            sync_run.finish(stats_dict, SyncRun.PAUSE_MAX_RUNS)
+                        else:
+                            sync_run.finish(stats_dict, SyncRun.PAUSE_LOCK_EXPIRY)
+
+                        poll.update_poll_results_counts()
 
                         cursor = result[1]
                         self._mark_poll_results_sync_paused(org, poll, cursor, after, before, batches_latest)
@@ -444,13 +455,7 @@ class FLOIPBackend(BaseBackend):
 
                 self._mark_poll_results_sync_completed(poll, org, latest_synced_obj_time)
 
-                # from django.db import connection as db_connection, reset_queries
-                # slowest_queries = sorted(db_connection.queries, key=lambda q: q['time'], reverse=True)[:10]
-                # for q in slowest_queries:
-                #     print "=" * 60
-                #     print "\n\n\n"
-                #     print "%s -- %s" % (q['time'], q['sql'])
-                # reset_queries()
+                sync_run.finish(stats_dict)
 
                 logger.info(
                     "Finished pulling results for poll #%d on org #%d runs in %ds, "
@@ -475,200 +480,16 @@ class FLOIPBackend(BaseBackend):
             stats_dict["num_path_ignored"],
         )
 
-    def _initiate_lookup_maps(self, fetch, org, poll):
+    def _initiate_lookup_maps(self, fetch, org, poll, stats_dict, counts_delta=None):
         contact_uuids = [run[2] for run in fetch]
-        contacts = Contact.objects.filter(org=org, uuid__in=contact_uuids)
-        contacts_map = {c.uuid: c for c in contacts}
-        existing_poll_results = PollResult.objects.filter(
-            flow=poll.flow_uuid, org=poll.org_id, contact__in=contact_uuids
-        )
-        poll_results_map = defaultdict(dict)
-        for res in existing_poll_results:
-            poll_results_map[res.contact][res.ruleset] = res
-
-        poll_results_to_save_map = defaultdict(dict)
-        return contacts_map, poll_results_map, poll_results_to_save_map
-
-    def _process_run_poll_results(
-        self,
-        org,
-        flow_uuid,
-        questions_uuids,
-        result,
-        contact_obj,
-        existing_db_poll_results_map,
-        poll_results_to_save_map,
-        stats_dict,
-    ):
-        contact_uuid = result[2]
-        completed = True
-
-        state = ""
-        district = ""
-        ward = ""
-        born = None
-        gender = None
-        if contact_obj is not None:
-            state = contact_obj.state
-            district = contact_obj.district
-            ward = contact_obj.ward
-            born = contact_obj.born
-            gender = contact_obj.gender
-
-        value_date = json_date_to_datetime(result[0])
-        ruleset_uuid = result[4]
-        category = result[5]
-        text = result[5]
-
-        existing_poll_result = existing_db_poll_results_map.get(contact_uuid, dict()).get(ruleset_uuid, None)
-
-        poll_result_to_save = poll_results_to_save_map.get(contact_uuid, dict()).get(ruleset_uuid, None)
-
-        if existing_poll_result is not None:
-
-            update_required = self._check_update_required(
-                existing_poll_result, category, text, state, district, ward, born, gender, completed, value_date
-            )
-
-            if update_required:
-                # update the db object
-                PollResult.objects.filter(pk=existing_poll_result.pk).update(
-                    category=category,
-                    text=text,
-                    state=state,
-                    district=district,
-                    ward=ward,
-                    date=value_date,
-                    born=born,
-                    gender=gender,
-                    completed=completed,
-                )
-
-                # update the map object as well
-                existing_poll_result.category = category
-                existing_poll_result.text = text
-                existing_poll_result.state = state
-                existing_poll_result.district = district
-                existing_poll_result.ward = ward
-                existing_poll_result.date = value_date
-                existing_poll_result.born = born
-                existing_poll_result.gender = gender
-                existing_poll_result.completed = completed
+        contacts_map = get_contact_records_map(org, contact_uuids)
 
-                existing_db_poll_results_map[contact_uuid][ruleset_uuid] = existing_poll_result
+        # the results already in the db are only read for their counts, the newest wins when the fetch is upserted
+        poll_results_diff = PollResultsDiff(org.pk, poll.flow_uuid, stats_dict, counts_delta)
+        return contacts_map, poll_results_diff
 
-                stats_dict["num_val_updated"] += 1
-            else:
-                stats_dict["num_val_ignored"] += 1
-
-        elif poll_result_to_save is not None:
-
-            replace_save_map = self._check_update_required(
-                poll_result_to_save, category, text, state, district, ward, born, gender, completed, value_date
-            )
-
-            if replace_save_map:
-                result_obj = PollResult(
-                    org=org,
-                    flow=flow_uuid,
-                    ruleset=ruleset_uuid,
-                    contact=contact_uuid,
-                    category=category,
-                    text=text,
-                    state=state,
-                    district=district,
-                    ward=ward,
-                    born=born,
-                    gender=gender,
-                    date=value_date,
-                    completed=completed,
-                )
-
-                poll_results_to_save_map[contact_uuid][ruleset_uuid] = result_obj
-
-            stats_dict["num_val_ignored"] += 1
-        else:
-
-            result_obj = PollResult(
-                org=org,
-                flow=flow_uuid,
-                ruleset=ruleset_uuid,
-                contact=contact_uuid,
-                category=category,
-                text=text,
-                state=state,
-                district=district,
-                ward=ward,
-                born=born,
-                gender=gender,
-                date=value_date,
-                completed=completed,
-            )
-
-            poll_results_to_save_map[contact_uuid][ruleset_uuid] = result_obj
-
-            stats_dict["num_val_created"] += 1
-
-    @staticmethod
-    def _check_update_required(poll_obj, category, text, state, district, ward, born, gender, completed, value_date):
-        update_required = any(
-            [
-                poll_obj.category != category,
-                poll_obj.text != text,
-                poll_obj.state != state,
-                poll_obj.district != district,
-                poll_obj.ward != ward,
-                poll_obj.born != born,
-                poll_obj.gender != gender,
-                poll_obj.completed != completed,
-            ]
-        )
-
-        # if the reporter answered the step, check if this is a newer run
-        if poll_obj.date is not None:
-            update_required = update_required and (value_date > poll_obj.date)
-        else:
-            update_required = True
-        return update_required
-
-    @staticmethod
-    def _save_new_poll_results_to_database(poll_results_to_save_map):
-        new_poll_results = []
-        for c_key in poll_results_to_save_map.keys():
-            for r_key in poll_results_to_save_map.get(c_key, dict()):
-                obj_to_create = poll_results_to_save_map.get(c_key, dict()).get(r_key, None)
-                if obj_to_create is not None:
-                    new_poll_results.append(obj_to_create)
-        PollResult.objects.bulk_create(new_poll_results)
-
-    @staticmethod
-    def _mark_poll_results_sync_paused(org, poll, cursor, after, before, batches_latest):
-        cache.set(Poll.POLL_RESULTS_LAST_PULL_CURSOR % (org.pk, poll.flow_uuid), cursor, None)
-        cache.set(Poll.POLL_RESULTS_CURSOR_AFTER_CACHE_KEY % (org.pk, poll.flow_uuid), after, None)
-        cache.set(Poll.POLL_RESULTS_CURSOR_BEFORE_CACHE_KEY % (org.pk, poll.flow_uuid), before, None)
-        cache.set(Poll.POLL_RESULTS_BATCHES_LATEST_CACHE_KEY % (org.pk, poll.flow_uuid), batches_latest, None)
-
-        from rtm.polls.tasks import pull_refresh
-
-        pull_refresh.apply_async((poll.pk,), countdown=300, queue="sync")
-
-    @staticmethod
-    def _mark_poll_results_sync_completed(poll, org, latest_synced_obj_time):
-        # update the time for this poll from which we fetch next time
-        cache.set(Poll.POLL_RESULTS_LAST_PULL_CACHE_KEY % (org.pk, poll.flow_uuid), latest_synced_obj_time, None)
-        # update the last time the sync happened
-        cache.set(
-            Poll.POLL_RESULTS_LAST_SYNC_TIME_CACHE_KEY % (org.pk, poll.flow_uuid),
-            datetime_to_json_date(timezone.now()),
-            None,
-        )
-        # clear the saved cursor
-        cache.delete(Poll.POLL_RESULTS_LAST_PULL_CURSOR % (org.pk, poll.flow_uuid))
-
-        # Use redis cache with expiring(in 48 hrs) key to allow other polls task
-        # to sync all polls without hitting the API rate limit
-        cache.set(
-            Poll.POLL_RESULTS_LAST_OTHER_POLLS_SYNCED_CACHE_KEY % (org.id, poll.flow_uuid),
-            datetime_to_json_date(timezone.now()),
-            Poll.POLL_RESULTS_LAST_OTHER_POLLS_SYNCED_CACHE_TIMEOUT,
+    def _process_run_poll_results(self, questions_uuids, result, contact_obj, poll_results_diff):
+        # FLOIP responses are one value per row, the category is the response itself
+        poll_results_diff.add_value(
+            result[2], result[4], result[5], result[5], contact_obj, json_date_to_datetime(result[0]), True
         )
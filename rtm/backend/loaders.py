@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import io
+
+from psycopg2.extras import execute_values
+
+from django.db import connection, transaction
+
+from rtm.polls.models import PollResult
+
+# upserts poll results in batches of VALUES, the contact activities are maintained row by row by the db trigger
+POLL_RESULTS_LOADER_INSERT = "insert"
+
+# streams poll results through COPY and maintains the contact activities with a single set based step
+POLL_RESULTS_LOADER_COPY = "copy"
+
+# uses COPY for first time syncs and archives, batches of VALUES otherwise
+POLL_RESULTS_LOADER_AUTO = "auto"
+
+POLL_RESULTS_LOADERS = (POLL_RESULTS_LOADER_INSERT, POLL_RESULTS_LOADER_COPY, POLL_RESULTS_LOADER_AUTO)
+
+POLL_RESULTS_COPY_COLUMNS = (
+    "org_id",
+    "flow",
+    "ruleset",
+    "contact",
+    "date",
+    "completed",
+    "category",
+    "text",
+    "state",
+    "district",
+    "ward",
+    "gender",
+    "born",
+)
+
+POLL_RESULTS_STAGING_TABLE = "polls_pollresult_staging"
+
+# read by the ureport_update_contact_activities trigger function to skip the row by row maintenance
+SKIP_CONTACT_ACTIVITIES_SETTING = "ureport.skip_contact_activities"
+
+# the newest result wins, older or same time results for a contact and question are ignored
+UPSERT_POLL_RESULTS_SQL = """
+INSERT INTO polls_pollresult (%(columns)s) %(source)s
+ON CONFLICT (org_id, flow, contact, ruleset) DO UPDATE SET %(updates)s
+WHERE polls_pollresult.date IS NULL OR EXCLUDED.date > polls_pollresult.date
+RETURNING %(returning)s
+"""
+
+UPSERT_RETURNING = "contact, ruleset, (xmax = 0) AS created"
+
+# flags the staged rows that were written, ignored ones are older than the result we already have, a staged row is
+# the only one of its contact and question so the keys returned by the upsert tell them apart
+UPSERT_STAGED_POLL_RESULTS_SQL = """
+WITH written AS (%(upsert)s), staged_written AS (
+    UPDATE %(staging)s staged SET written = TRUE
+    FROM written
+    WHERE staged.org_id = written.org_id AND staged.flow = written.flow AND staged.contact = written.contact
+    AND staged.ruleset = written.ruleset
+)
+SELECT contact, ruleset, created FROM written
+"""
+
+INSERT_STAGED_CONTACT_ACTIVITIES_SQL = """
+INSERT INTO stats_contactactivity(contact, date, org_id)
+SELECT DISTINCT staged.contact, months.month::date, staged.org_id
+FROM %(staging)s staged
+CROSS JOIN LATERAL generate_series(
+    date_trunc('month', staged.date)::timestamp,
+    (date_trunc('month', staged.date)::timestamp + interval '11 months')::date,
+    interval '1 month'
+) AS months(month)
+WHERE staged.org_id IS NOT NULL AND staged.flow IS NOT NULL AND staged.ruleset IS NOT NULL
+AND staged.category IS NOT NULL AND staged.written
+ON CONFLICT (org_id, contact, date) DO NOTHING
+"""
+
+# the trigger leaves the attributes of the last row it processes for a contact, the rows are upserted in staged order
+UPDATE_STAGED_CONTACT_ACTIVITIES_SQL = """
+UPDATE stats_contactactivity activity
+SET born = latest.born, gender = latest.gender, state = latest.state, district = latest.district, ward = latest.ward
+FROM (
+    SELECT DISTINCT ON (staged.org_id, staged.contact)
+        staged.org_id, staged.contact, staged.born, staged.gender, staged.state, staged.district, staged.ward
+    FROM %(staging)s staged
+    WHERE staged.org_id IS NOT NULL AND staged.flow IS NOT NULL AND staged.ruleset IS NOT NULL
+    AND staged.category IS NOT NULL AND staged.written
+    ORDER BY staged.org_id, staged.contact, staged.staged_order DESC
+) latest
+WHERE activity.org_id = latest.org_id AND activity.contact = latest.contact
+AND activity.date > date_trunc('month', CURRENT_DATE) - INTERVAL '1 year'
+"""
+
+
+def _upsert_sql(source, returning=UPSERT_RETURNING):
+    return UPSERT_POLL_RESULTS_SQL % dict(
+        columns=", ".join(POLL_RESULTS_COPY_COLUMNS),
+        source=source,
+        updates=", ".join("%s = EXCLUDED.%s" % (field, field) for field in PollResult.SYNC_UPDATE_FIELDS),
+        returning=returning,
+    )
+
+
+def _copy_value(value):
+    """
+    Encodes a value for the text format of COPY
+    """
+    if value is None:
+        return "\\N"
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+def _copy_rows(poll_results):
+    stream = io.StringIO()
+    for poll_result in poll_results:
+        row = [_copy_value(getattr(poll_result, column)) for column in POLL_RESULTS_COPY_COLUMNS]
+        stream.write("\t".join(row))
+        stream.write("\n")
+
+    stream.seek(0)
+    return stream
+
+
+def insert_poll_results(poll_results):
+    """
+    Upserts poll results in batches of VALUES, returns the (contact, ruleset, created) of the rows written
+    """
+    if not poll_results:
+        return []
+
+    rows = [
+        tuple(getattr(poll_result, column) for column in POLL_RESULTS_COPY_COLUMNS) for poll_result in poll_results
+    ]
+
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            upsert_sql = _upsert_sql("VALUES %s")
+            return execute_values(
+                cursor.cursor, upsert_sql, rows, page_size=PollResult.SYNC_UPDATE_BATCH_SIZE, fetch=True
+            )
+
+
+def copy_poll_results(poll_results):
+    """
+    Upserts poll results by streaming them into a temporary staging table with COPY and merging them into
+    polls_pollresult with a single INSERT ... SELECT, then maintains their contact activities in one set based
+    step instead of once per row in the trigger. Returns the (contact, ruleset, created) of the rows written
+    """
+    if not poll_results:
+        return []
+
+    columns = ", ".join(POLL_RESULTS_COPY_COLUMNS)
+    sql_params = dict(staging=POLL_RESULTS_STAGING_TABLE)
+
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "CREATE TEMPORARY TABLE %s ON COMMIT DROP AS SELECT %s FROM %s WITH NO DATA"
+                % (POLL_RESULTS_STAGING_TABLE, columns, PollResult._meta.db_table)
+            )
+            # the order rows were copied in is the order the trigger would have processed them
+            cursor.execute(
+                "ALTER TABLE %s ADD COLUMN staged_order SERIAL, ADD COLUMN written BOOLEAN NOT NULL DEFAULT FALSE"
+                % POLL_RESULTS_STAGING_TABLE
+            )
+            cursor.copy_expert(
+                "COPY %s (%s) FROM STDIN" % (POLL_RESULTS_STAGING_TABLE, columns), _copy_rows(poll_results)
+            )
+
+            cursor.execute("SELECT set_config(%s, 'on', true)", [SKIP_CONTACT_ACTIVITIES_SETTING])
+            upsert_sql = _upsert_sql(
+                "SELECT %s FROM %s ORDER BY staged_order" % (columns, POLL_RESULTS_STAGING_TABLE),
+                returning="org_id, flow, %s" % UPSERT_RETURNING,
+            )
+            cursor.execute(UPSERT_STAGED_POLL_RESULTS_SQL % dict(sql_params, upsert=upsert_sql))
+            written = cursor.fetchall()
+            cursor.execute("SELECT set_config(%s, 'off', true)", [SKIP_CONTACT_ACTIVITIES_SETTING])
+
+            cursor.execute(INSERT_STAGED_CONTACT_ACTIVITIES_SQL % sql_params)
+            cursor.execute(UPDATE_STAGED_CONTACT_ACTIVITIES_SQL % sql_params)
+
+            # dropped here too in case we are inside an outer transaction that loads more fetches
+            cursor.execute("DROP TABLE %s" % POLL_RESULTS_STAGING_TABLE)
+
+    return written
+
+
+def get_poll_results_loader(loader=None, first_sync=False):
+    """
+    Resolves the loader to use for a sync, from the one asked for or the POLL_RESULTS_LOADER setting
+    """
+    from django.conf import settings
+
+    if loader is None:
+        loader = getattr(settings, "POLL_RESULTS_LOADER", POLL_RESULTS_LOADER_AUTO)
+
+    if loader not in POLL_RESULTS_LOADERS:
+        raise ValueError("Unknown poll results loader: %s" % loader)
+
+    if loader == POLL_RESULTS_LOADER_AUTO:
+        return POLL_RESULTS_LOADER_COPY if first_sync else POLL_RESULTS_LOADER_INSERT
+
+    return loader
+
+
+def save_poll_results(poll_results, loader=POLL_RESULTS_LOADER_INSERT):
+    """
+    Writes poll results or records, at most one per contact and question, keeping the newest result of each in
+    the db. Returns the (contact, ruleset, created) of the rows created or updated
+    """
+    if loader == POLL_RESULTS_LOADER_COPY:
+        return copy_poll_results(poll_results)
+
+    return insert_poll_results(poll_results)
@@ -1,17 +1,18 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, division, print_function, unicode_literals
 
-import gzip
-import io
 import json
 import logging
+import os
+import queue
+import socket
+import tempfile
+import threading
 import time
-from collections import defaultdict
 import pytz
 import requests
 from typing import Dict, List
 
-from django.core.cache import cache
 from django.utils import timezone
 from django.conf import settings
 
@@ -19,20 +20,106 @@ from dash.utils import is_dict_equal
 from dash.utils.sync import BaseSyncer, sync_local_to_changes, sync_local_to_set
 from django_redis import get_redis_connection
 from temba_client.exceptions import TembaRateExceededError
-from temba_client.v2.types import Run, Flow
+from temba_client.v2.types import Archive, Run, Flow
 from temba_client.v2 import TembaClient
 from temba_client.clients import CursorQuery
 
 from rtm.contacts.models import Contact, ContactField
 from rtm.locations.models import Boundary
-from rtm.polls.models import Poll, PollQuestion, PollResponseCategory, PollResult
+from rtm.polls.models import Poll, PollQuestion, PollResponseCategory, SyncRun
 from rtm.polls.tasks import pull_refresh_from_archives
 from rtm.utils import chunk_list, datetime_to_json_date, json_date_to_datetime
 
 from . import BaseBackend
+from .archives import ARCHIVE_DOWNLOAD_CHUNK_SIZE, ArchiveStore
+from .diff import POLL_RESULT_KIND_PATH, PollResultsDiff
+from .loaders import get_poll_results_loader
+from .ratelimit import RateLimitedTembaClient
+from .records import get_contact_records_map
 
 logger = logging.getLogger(__name__)
 
+# number of runs pages fetched ahead from the API while the current page is processed, 0 to fetch serially
+POLL_RESULTS_PREFETCH_DEPTH = getattr(settings, "POLL_RESULTS_PREFETCH_DEPTH", 2)
+
+# local directory where the run archives are kept once downloaded, with their flow indexes
+RUN_ARCHIVES_CACHE_DIR = getattr(
+    settings, "RUN_ARCHIVES_CACHE_DIR", os.path.join(tempfile.gettempdir(), "rtm-run-archives")
+)
+
+# archives not used by any poll for this long are removed from the local directory
+RUN_ARCHIVES_CACHE_MAX_AGE = getattr(settings, "RUN_ARCHIVES_CACHE_MAX_AGE", 60 * 60 * 24 * 7)
+
+RUN_ARCHIVE_DOWNLOAD_LOCK = "run-archive-download-lock:%s:%s"
+RUN_ARCHIVE_DOWNLOAD_LOCK_TIMEOUT = 60 * 30
+
+
+class FetchesPrefetcher(object):
+    """
+    Iterates the fetches of a temba cursor query, pulling the next pages from the API in a background thread
+    """
+
+    QUEUE_PUT_TIMEOUT = 1
+
+    _DONE = object()
+
+    def __init__(self, fetches, depth, resume_cursor=None):
+        self.fetches = fetches
+        self.queue = queue.Queue(maxsize=depth)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._produce, daemon=True)
+
+        # the cursor to resume from after the last page handed to the consumer
+        self.cursor = resume_cursor
+        self.api_time = 0
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=self.QUEUE_PUT_TIMEOUT)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce(self):
+        try:
+            while not self.stopped.is_set():
+                api_start = time.time()
+                try:
+                    fetch = next(self.fetches)
+                except StopIteration:
+                    break
+
+                cursor = self.fetches.get_cursor()
+                if not self._put((fetch, cursor, time.time() - api_start)):
+                    return
+
+            self._put((self._DONE, None, 0))
+        except Exception as e:
+            self._put((e, None, 0))
+
+    def __iter__(self):
+        self.thread.start()
+
+        while True:
+            fetch, cursor, api_time = self.queue.get()
+            if fetch is self._DONE:
+                return
+
+            if isinstance(fetch, Exception):
+                raise fetch
+
+            self.cursor = cursor
+            self.api_time = api_time
+            yield fetch
+
+    def get_cursor(self):
+        return self.cursor
+
+    def stop(self):
+        self.stopped.set()
+
 
 class FieldSyncer(BaseSyncer):
     """
@@ -309,9 +396,11 @@ class RapidProBackend(BaseBackend):
     RapidPro instance as a backend
     """
 
-    @staticmethod
-    def _get_client(org, api_version):
-        return org.get_temba_client(api_version=api_version)
+    def _get_client(self, org, api_version):
+        if api_version != 2:
+            return org.get_temba_client(api_version=api_version)
+
+        return RateLimitedTembaClient.for_backend(self.backend)
 
     def fetch_flows(self, org):
         client = self._get_client(org, 2)
@@ -400,21 +489,28 @@ class RapidProBackend(BaseBackend):
             org, ContactSyncer(backend=self.backend), fetches, deleted_fetches, progress_callback
         )
 
-    def _iter_archive_records(self, archive, flow_uuid):
-        r = requests.get(archive.download_url, stream=True)
-        stream = gzip.GzipFile(fileobj=io.BytesIO(r.content))
+    def _iter_archive_records(self, org, archive, flow_uuid):
+        archive_store = ArchiveStore(RUN_ARCHIVES_CACHE_DIR)
+        key = ArchiveStore.get_archive_key(org.pk, archive)
 
-        while True:
-            line = stream.readline()
-            if not line:
-                break
-            line_decoded = line.decode("utf-8")
-            if line_decoded.find(flow_uuid) > 0:
-                yield json.loads(line_decoded)
+        if not archive_store.has_archive(key):
+            r = get_redis_connection()
+
+            # the same archive is needed by every poll of the org, make sure only one worker process of this host
+            # downloads it, the archives are kept on the local disk so other hosts download their own
+            lock_key = RUN_ARCHIVE_DOWNLOAD_LOCK % (socket.gethostname(), key)
+            with r.lock(lock_key, timeout=RUN_ARCHIVE_DOWNLOAD_LOCK_TIMEOUT):
+                if not archive_store.has_archive(key):
+                    with requests.get(archive.download_url, stream=True) as response:
+                        response.raise_for_status()
+                        archive_store.save_archive(key, response.iter_content(chunk_size=ARCHIVE_DOWNLOAD_CHUNK_SIZE))
 
-    def _iter_poll_record_runs(self, archive, poll_flow_uuid):
+        for record in archive_store.iter_flow_records(key, flow_uuid):
+            yield record
 
-        for record_batch in chunk_list(self._iter_archive_records(archive, poll_flow_uuid), 1000):
+    def _iter_poll_record_runs(self, org, archive, poll_flow_uuid):
+
+        for record_batch in chunk_list(self._iter_archive_records(org, archive, poll_flow_uuid), 1000):
             matching = []
             for record in record_batch:
                 if record["flow"]["uuid"] == poll_flow_uuid:
@@ -422,7 +518,20 @@ class RapidProBackend(BaseBackend):
                     matching.append(record)
             yield Run.deserialize_list(matching)
 
-    def pull_results_from_archives(self, poll):
+    def get_poll_archives(self, poll):
+        client = self._get_client(poll.org, 2)
+        first = poll.poll_date.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+        archives_query = client.get_archives(archive_type="run", after=first)
+        archives_fetches = archives_query.iterfetches(retry_on_rate_exceed=True)
+
+        poll_archives = []
+        for archives in archives_fetches:
+            poll_archives += [archive.serialize() for archive in archives if archive.record_count > 0]
+
+        return poll_archives
+
+    def pull_results_from_archive(self, poll, archive_json, loader=None):
         org = poll.org
         r = get_redis_connection()
         key = Poll.POLL_PULL_RESULTS_TASK_LOCK % (org.pk, poll.flow_uuid)
@@ -437,67 +546,60 @@ class RapidProBackend(BaseBackend):
             num_synced=0,
         )
 
-        with r.lock(key):
-            first = poll.poll_date.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-
-            client = self._get_client(org, 2)
-
-            questions_uuids = poll.get_question_uuids()
-            archives_query = client.get_archives(archive_type="run", after=first)
-            archives_fetches = archives_query.iterfetches(retry_on_rate_exceed=True)
-
-            i = 0
-            for archives in archives_fetches:
+        archive = Archive.deserialize(archive_json)
+        loader = get_poll_results_loader(loader, first_sync=True)
+        questions_uuids = poll.get_question_uuids()
 
-                for archive in archives:
-                    i += 1
-                    logger.info("Archive %d with %d records, size %d" % (i, archive.record_count, archive.size))
+        logger.info(
+            "Archive %s for poll #%d on org #%d with %d records, size %d"
+            % (archive.start_date, poll.pk, org.pk, archive.record_count, archive.size)
+        )
 
-                    try:
-                        start_archive = time.time()
-                        logger.info("Archive %d has %d records" % (i, archive.record_count))
+        start_archive = time.time()
+        sync_run = SyncRun.start(poll, SyncRun.SOURCE_ARCHIVE)
 
-                        if archive.record_count <= 0:
-                            continue
+        try:
+            counts_delta = self._get_poll_results_counts_delta(poll)
 
-                        flow_uuid = poll.flow_uuid
+            download_start = time.time()
+            for fetch in self._iter_poll_record_runs(org, archive, poll.flow_uuid):
+                download_time = time.time() - download_start
 
-                        for fetch in self._iter_poll_record_runs(archive, flow_uuid):
+                # the archives of a poll are downloaded and decoded in parallel,
+                # only the diff and writes against the existing results are serialized
+                with r.lock(key, timeout=Poll.POLL_SYNC_LOCK_TIMEOUT):
+                    fetch_start = time.time()
 
-                            fetch_start = time.time()
+                    contacts_map, poll_results_diff = self._initiate_lookup_maps(
+                        fetch, org, poll, stats_dict, counts_delta
+                    )
 
-                            contacts_map, poll_results_map, poll_results_to_save_map = self._initiate_lookup_maps(
-                                fetch, org, poll
-                            )
+                    for temba_run in fetch:
 
-                            for temba_run in fetch:
-
-                                contact_obj = contacts_map.get(temba_run.contact.uuid, None)
-                                self._process_run_poll_results(
-                                    org,
-                                    questions_uuids,
-                                    temba_run,
-                                    contact_obj,
-                                    poll_results_map,
-                                    poll_results_to_save_map,
-                                    stats_dict,
-                                )
+                        contact_obj = contacts_map.get(temba_run.contact.uuid, None)
+                        self._process_run_poll_results(questions_uuids, temba_run, contact_obj, poll_results_diff)
 
-                            stats_dict["num_synced"] += len(fetch)
+                    write_start = time.time()
+                    poll_results_diff.save(loader)
 
-                            self._save_new_poll_results_to_database(poll_results_to_save_map)
+                sync_run.add_fetch(len(fetch), download_time, write_start - fetch_start, time.time() - write_start)
+                stats_dict["num_synced"] += len(fetch)
 
-                            logger.info(
-                                "Processing archive %d took %ds for fetch of %d"
-                                % (i, time.time() - fetch_start, len(fetch))
-                            )
-
-                        logger.info("Full poll process archive in %ds" % (time.time() - start_archive))
-                    except Exception as e:
-                        logger.info(e)
-                        import traceback
+                logger.info(
+                    "Processing archive %s took %ds for fetch of %d"
+                    % (archive.start_date, time.time() - fetch_start, len(fetch))
+                )
+                download_start = time.time()
 
-                        traceback.print_exc()
+            logger.info("Full poll process archive in %ds" % (time.time() - start_archive))
+        except Exception:
+            # failing the task keeps the chord from marking the poll synced without the results of this archive
+            logger.exception(
+                "Failed pulling archive %s for poll #%d on org #%d" % (archive.start_date, poll.pk, org.pk)
+            )
+            raise
+        finally:
+            sync_run.finish(stats_dict)
 
         return (
             stats_dict["num_val_created"],
@@ -508,7 +610,7 @@ class RapidProBackend(BaseBackend):
             stats_dict["num_path_ignored"],
         )
 
-    def pull_results(self, poll, modified_after, modified_before, progress_callback=None):
+    def pull_results(self, poll, modified_after, modified_before, progress_callback=None, loader=None):
         org = poll.org
         r = get_redis_connection()
         key = Poll.POLL_PULL_RESULTS_TASK_LOCK % (org.pk, poll.flow_uuid)
@@ -542,6 +644,11 @@ class RapidProBackend(BaseBackend):
                     pull_after_delete,
                 ) = poll.get_pull_cached_params()
 
+                # first time syncs can load many runs, allow those to be streamed through COPY
+                loader = get_poll_results_loader(
+                    loader, first_sync=latest_synced_obj_time is None or pull_after_delete is not None
+                )
+
                 if pull_after_delete is not None:
                     after = None
                     latest_synced_obj_time = None
@@ -556,13 +663,19 @@ class RapidProBackend(BaseBackend):
 
                 start = time.time()
                 logger.info("Start fetching runs for poll #%d on org #%d" % (poll.pk, org.pk))
+                sync_run = SyncRun.start(poll, SyncRun.SOURCE_API)
+                counts_delta = self._get_poll_results_counts_delta(poll)
 
                 poll_runs_query = client.get_runs(flow=poll.flow_uuid, after=after, before=before)
                 fetches = poll_runs_query.iterfetches(retry_on_rate_exceed=True, resume_cursor=resume_cursor)
 
+                if POLL_RESULTS_PREFETCH_DEPTH > 0:
+                    fetches = FetchesPrefetcher(fetches, POLL_RESULTS_PREFETCH_DEPTH, resume_cursor=resume_cursor)
+
                 try:
                     fetch_start = time.time()
                     for fetch in fetches:
+                        api_wait_time = time.time() - fetch_start
 
                         logger.info(
                             "RapidPro API fetch for poll #%d "
@@ -572,12 +685,13 @@ class RapidProBackend(BaseBackend):
                                 org.pk,
                                 stats_dict["num_synced"],
                                 stats_dict["num_synced"] + len(fetch),
-                                time.time() - fetch_start,
+                                api_wait_time,
                             )
                         )
 
-                        contacts_map, poll_results_map, poll_results_to_save_map = self._initiate_lookup_maps(
-                            fetch, org, poll
+                        process_start = time.time()
+                        contacts_map, poll_results_diff = self._initiate_lookup_maps(
+                            fetch, org, poll, stats_dict, counts_delta
                         )
 
                         for temba_run in fetch:
@@ -586,27 +700,35 @@ class RapidProBackend(BaseBackend):
                                 batches_latest = datetime_to_json_date(temba_run.modified_on.replace(tzinfo=pytz.utc))
 
                             contact_obj = contacts_map.get(temba_run.contact.uuid, None)
-                            self._process_run_poll_results(
-                                org,
-                                questions_uuids,
-                                temba_run,
-                                contact_obj,
-                                poll_results_map,
-                                poll_results_to_save_map,
-                                stats_dict,
-                            )
+                            self._process_run_poll_results(questions_uuids, temba_run, contact_obj, poll_results_diff)
 
                         stats_dict["num_synced"] += len(fetch)
                         if progress_callback:
                             progress_callback(stats_dict["num_synced"])
 
-                        self._save_new_poll_results_to_database(poll_results_to_save_map)
+                        write_start = time.time()
+                        poll_results_diff.save(loader)
+                        sync_run.add_fetch(
+                            len(fetch), api_wait_time, write_start - process_start, time.time() - write_start
+                        )
 
                         logger.info(
                             "Processed fetch of %d - %d "
                             "runs for poll #%d on org #%d"
                             % (stats_dict["num_synced"] - len(fetch), stats_dict["num_synced"], poll.pk, org.pk)
                         )
+                        logger.info(
+                            "Fetch stages for poll #%d on org #%d: API %0.3fs (waited %0.3fs), "
+                            "process %0.3fs, DB write %0.3fs"
+                            % (
+                                poll.pk,
+                                org.pk,
+                                getattr(fetches, "api_time", api_wait_time),
+                                api_wait_time,
+                                write_start - process_start,
+                                time.time() - write_start,
+                            )
+                        )
                         fetch_start = time.time()
                         logger.info("=" * 40)
 
@@ -614,7 +736,12 @@ class RapidProBackend(BaseBackend):
                             stats_dict["num_synced"] >= Poll.POLL_RESULTS_MAX_SYNC_RUNS
                             or time.time() > lock_expiration
                         ):
-                            poll.rebuild_poll_results_counts()
+                            if stats_dict["num_synced"] >= Poll.POLL_RESULTS_MAX_SYNC_RUNS:
+                                sync_run.finish(stats_dict, SyncRun.PAUSE_MAX_RUNS)
+                            else:
+                                sync_run.finish(stats_dict, SyncRun.PAUSE_LOCK_EXPIRY)
+
+                            poll.update_poll_results_counts()
 
                             cursor = fetches.get_cursor()
                             self._mark_poll_results_sync_paused(org, poll, cursor, after, before, batches_latest)
@@ -647,11 +774,16 @@ class RapidProBackend(BaseBackend):
                                 stats_dict["num_path_updated"],
                                 stats_dict["num_path_ignored"],
                             )
-                except TembaRateExceededError:
-                    poll.rebuild_poll_results_counts()
+                except TembaRateExceededError as e:
+                    sync_run.finish(stats_dict, SyncRun.PAUSE_RATE_LIMIT)
+                    poll.update_poll_results_counts()
 
+                    # resume as soon as the workspace has room for our requests again
                     cursor = fetches.get_cursor()
-                    self._mark_poll_results_sync_paused(org, poll, cursor, after, before, batches_latest)
+                    countdown = client.rate_limiter.get_countdown(e.retry_after)
+                    self._mark_poll_results_sync_paused(
+                        org, poll, cursor, after, before, batches_latest, countdown=countdown
+                    )
 
                     logger.info(
                         "Break pull results for poll #%d on org #%d in %ds, "
@@ -681,6 +813,9 @@ class RapidProBackend(BaseBackend):
                         stats_dict["num_path_updated"],
                         stats_dict["num_path_ignored"],
                     )
+                finally:
+                    if isinstance(fetches, FetchesPrefetcher):
+                        fetches.stop()
 
                 if batches_latest is not None and (
                     latest_synced_obj_time is None
@@ -689,14 +824,7 @@ class RapidProBackend(BaseBackend):
                     latest_synced_obj_time = batches_latest
 
                 self._mark_poll_results_sync_completed(poll, org, latest_synced_obj_time)
-
-                # from django.db import connection as db_connection, reset_queries
-                # slowest_queries = sorted(db_connection.queries, key=lambda q: q['time'], reverse=True)[:10]
-                # for q in slowest_queries:
-                #     print "=" * 60
-                #     print "\n\n\n"
-                #     print "%s -- %s" % (q['time'], q['sql'])
-                # reset_queries()
+                sync_run.finish(stats_dict)
 
                 logger.info(
                     "Finished pulling results for poll #%d on org #%d runs in %ds, "
@@ -721,289 +849,32 @@ class RapidProBackend(BaseBackend):
             stats_dict["num_path_ignored"],
         )
 
-    def _initiate_lookup_maps(self, fetch, org, poll):
+    def _initiate_lookup_maps(self, fetch, org, poll, stats_dict, counts_delta=None):
         contact_uuids = [run.contact.uuid for run in fetch]
-        contacts = Contact.objects.filter(org=org, uuid__in=contact_uuids)
-        contacts_map = {c.uuid: c for c in contacts}
-        existing_poll_results = PollResult.objects.filter(
-            flow=poll.flow_uuid, org=poll.org_id, contact__in=contact_uuids
-        )
-        poll_results_map = defaultdict(dict)
-        for res in existing_poll_results:
-            poll_results_map[res.contact][res.ruleset] = res
-
-        poll_results_to_save_map = defaultdict(dict)
-        return contacts_map, poll_results_map, poll_results_to_save_map
-
-    def _process_run_poll_results(
-        self,
-        org,
-        questions_uuids,
-        temba_run,
-        contact_obj,
-        existing_db_poll_results_map,
-        poll_results_to_save_map,
-        stats_dict,
-    ):
-        flow_uuid = temba_run.flow.uuid
+        contacts_map = get_contact_records_map(org, contact_uuids)
+
+        # the results already in the db are only read for their counts, the newest wins when the fetch is upserted
+        poll_results_diff = PollResultsDiff(org.pk, poll.flow_uuid, stats_dict, counts_delta)
+        return contacts_map, poll_results_diff
+
+    def _process_run_poll_results(self, questions_uuids, temba_run, contact_obj, poll_results_diff):
         contact_uuid = temba_run.contact.uuid
         completed = temba_run.exit_type == "completed"
 
-        state = ""
-        district = ""
-        ward = ""
-        born = None
-        gender = None
-        if contact_obj is not None:
-            state = contact_obj.state
-            district = contact_obj.district
-            ward = contact_obj.ward
-            born = contact_obj.born
-            gender = contact_obj.gender
-
         for temba_value in sorted(temba_run.values.values(), key=lambda val: val.time):
-            ruleset_uuid = temba_value.node
-            category = temba_value.category
             text = ""
             if temba_value.input is not None:
                 text = temba_value.value[:2560] if temba_value.value is not None else temba_value.value
-            value_date = temba_value.time
-
-            existing_poll_result = existing_db_poll_results_map.get(contact_uuid, dict()).get(ruleset_uuid, None)
-
-            poll_result_to_save = poll_results_to_save_map.get(contact_uuid, dict()).get(ruleset_uuid, None)
-
-            if existing_poll_result is not None:
-
-                update_required = self._check_update_required(
-                    existing_poll_result, category, text, state, district, ward, born, gender, completed, value_date
-                )
-
-                if update_required:
-                    # update the db object
-                    PollResult.objects.filter(pk=existing_poll_result.pk).update(
-                        category=category,
-                        text=text,
-                        state=state,
-                        district=district,
-                        ward=ward,
-                        date=value_date,
-                        born=born,
-                        gender=gender,
-                        completed=completed,
-                    )
 
-                    # update the map object as well
-                    existing_poll_result.category = category
-                    existing_poll_result.text = text
-                    existing_poll_result.state = state
-                    existing_poll_result.district = district
-                    existing_poll_result.ward = ward
-                    existing_poll_result.date = value_date
-                    existing_poll_result.born = born
-                    existing_poll_result.gender = gender
-                    existing_poll_result.completed = completed
-
-                    existing_db_poll_results_map[contact_uuid][ruleset_uuid] = existing_poll_result
-
-                    stats_dict["num_val_updated"] += 1
-                else:
-                    stats_dict["num_val_ignored"] += 1
-
-            elif poll_result_to_save is not None:
-
-                replace_save_map = self._check_update_required(
-                    poll_result_to_save, category, text, state, district, ward, born, gender, completed, value_date
-                )
-
-                if replace_save_map:
-                    result_obj = PollResult(
-                        org=org,
-                        flow=flow_uuid,
-                        ruleset=ruleset_uuid,
-                        contact=contact_uuid,
-                        category=category,
-                        text=text,
-                        state=state,
-                        district=district,
-                        ward=ward,
-                        born=born,
-                        gender=gender,
-                        date=value_date,
-                        completed=completed,
-                    )
-
-                    poll_results_to_save_map[contact_uuid][ruleset_uuid] = result_obj
-
-                stats_dict["num_val_ignored"] += 1
-            else:
-
-                result_obj = PollResult(
-                    org=org,
-                    flow=flow_uuid,
-                    ruleset=ruleset_uuid,
-                    contact=contact_uuid,
-                    category=category,
-                    text=text,
-                    state=state,
-                    district=district,
-                    ward=ward,
-                    born=born,
-                    gender=gender,
-                    date=value_date,
-                    completed=completed,
-                )
-
-                poll_results_to_save_map[contact_uuid][ruleset_uuid] = result_obj
+            poll_results_diff.add_value(
+                contact_uuid, temba_value.node, temba_value.category, text, contact_obj, temba_value.time, completed
+            )
 
-                stats_dict["num_val_created"] += 1
         for temba_path in temba_run.path:
-            ruleset_uuid = temba_path.node
-            category = None
-            text = ""
-            value_date = temba_path.time
-
-            if ruleset_uuid in questions_uuids:
-                existing_poll_result = existing_db_poll_results_map.get(contact_uuid, dict()).get(ruleset_uuid, None)
-
-                poll_result_to_save = poll_results_to_save_map.get(contact_uuid, dict()).get(ruleset_uuid, None)
-
-                if existing_poll_result is not None:
-                    if existing_poll_result.date is None or value_date > existing_poll_result.date:
-                        # update the db object
-                        PollResult.objects.filter(pk=existing_poll_result.pk).update(
-                            category=category,
-                            text=text,
-                            state=state,
-                            district=district,
-                            ward=ward,
-                            date=value_date,
-                            born=born,
-                            gender=gender,
-                            completed=completed,
-                        )
-
-                        # update the map object as well
-                        existing_poll_result.category = category
-                        existing_poll_result.text = text
-                        existing_poll_result.state = state
-                        existing_poll_result.district = district
-                        existing_poll_result.ward = ward
-                        existing_poll_result.date = value_date
-                        existing_poll_result.born = born
-                        existing_poll_result.gender = gender
-                        existing_poll_result.completed = completed
-
-                        existing_db_poll_results_map[contact_uuid][ruleset_uuid] = existing_poll_result
-
-                        stats_dict["num_path_updated"] += 1
-                    else:
-                        stats_dict["num_path_ignored"] += 1
-
-                elif poll_result_to_save is not None:
-                    if value_date > poll_result_to_save.date:
-                        result_obj = PollResult(
-                            org=org,
-                            flow=flow_uuid,
-                            ruleset=ruleset_uuid,
-                            contact=contact_uuid,
-                            category=category,
-                            text=text,
-                            state=state,
-                            district=district,
-                            ward=ward,
-                            born=born,
-                            gender=gender,
-                            date=value_date,
-                            completed=completed,
-                        )
-
-                        poll_results_to_save_map[contact_uuid][ruleset_uuid] = result_obj
-
-                    stats_dict["num_path_ignored"] += 1
-
-                else:
-
-                    result_obj = PollResult(
-                        org=org,
-                        flow=flow_uuid,
-                        ruleset=ruleset_uuid,
-                        contact=contact_uuid,
-                        category=category,
-                        text=text,
-                        state=state,
-                        district=district,
-                        ward=ward,
-                        born=born,
-                        gender=gender,
-                        date=value_date,
-                        completed=completed,
-                    )
-
-                    poll_results_to_save_map[contact_uuid][ruleset_uuid] = result_obj
-
-                    stats_dict["num_path_created"] += 1
-
+            if temba_path.node in questions_uuids:
+                poll_results_diff.add_path(contact_uuid, temba_path.node, contact_obj, temba_path.time, completed)
             else:
-                stats_dict["num_path_ignored"] += 1
-
-    @staticmethod
-    def _check_update_required(poll_obj, category, text, state, district, ward, born, gender, completed, value_date):
-        update_required = poll_obj.category != category or poll_obj.text != text
-        update_required = update_required or poll_obj.state != state
-        update_required = update_required or poll_obj.district != district
-        update_required = update_required or poll_obj.ward != ward
-        update_required = update_required or poll_obj.born != born
-        update_required = update_required or poll_obj.gender != gender
-        update_required = update_required or poll_obj.completed != completed
-        # if the reporter answered the step, check if this is a newer run
-        if poll_obj.date is not None:
-            update_required = update_required and (value_date > poll_obj.date)
-        else:
-            update_required = True
-        return update_required
-
-    @staticmethod
-    def _save_new_poll_results_to_database(poll_results_to_save_map):
-        new_poll_results = []
-        for c_key in poll_results_to_save_map.keys():
-            for r_key in poll_results_to_save_map.get(c_key, dict()):
-                obj_to_create = poll_results_to_save_map.get(c_key, dict()).get(r_key, None)
-                if obj_to_create is not None:
-                    new_poll_results.append(obj_to_create)
-        PollResult.objects.bulk_create(new_poll_results)
-
-    @staticmethod
-    def _mark_poll_results_sync_paused(org, poll, cursor, after, before, batches_latest):
-        cache.set(Poll.POLL_RESULTS_LAST_PULL_CURSOR % (org.pk, poll.flow_uuid), cursor, None)
-        cache.set(Poll.POLL_RESULTS_CURSOR_AFTER_CACHE_KEY % (org.pk, poll.flow_uuid), after, None)
-        cache.set(Poll.POLL_RESULTS_CURSOR_BEFORE_CACHE_KEY % (org.pk, poll.flow_uuid), before, None)
-        cache.set(Poll.POLL_RESULTS_BATCHES_LATEST_CACHE_KEY % (org.pk, poll.flow_uuid), batches_latest, None)
-
-        from rtm.polls.tasks import pull_refresh
-
-        pull_refresh.apply_async((poll.pk,), countdown=300, queue="sync")
-
-    @staticmethod
-    def _mark_poll_results_sync_completed(poll, org, latest_synced_obj_time):
-        # update the time for this poll from which we fetch next time
-        cache.set(Poll.POLL_RESULTS_LAST_PULL_CACHE_KEY % (org.pk, poll.flow_uuid), latest_synced_obj_time, None)
-        # update the last time the sync happened
-        cache.set(
-            Poll.POLL_RESULTS_LAST_SYNC_TIME_CACHE_KEY % (org.pk, poll.flow_uuid),
-            datetime_to_json_date(timezone.now()),
-            None,
-        )
-        # clear the saved cursor
-        cache.delete(Poll.POLL_RESULTS_LAST_PULL_CURSOR % (org.pk, poll.flow_uuid))
-
-        # Use redis cache with expiring(in 48 hrs) key to allow other polls task
-        # to sync all polls without hitting the API rate limit
-        cache.set(
-            Poll.POLL_RESULTS_LAST_OTHER_POLLS_SYNCED_CACHE_KEY % (org.id, poll.flow_uuid),
-            datetime_to_json_date(timezone.now()),
-            Poll.POLL_RESULTS_LAST_OTHER_POLLS_SYNCED_CACHE_TIMEOUT,
-        )
+                poll_results_diff.ignore(POLL_RESULT_KIND_PATH)
 
 
 class RapidProBackendGlobal(object):
@@ -1012,7 +883,7 @@ class RapidProBackendGlobal(object):
     def __init__(self):
         self._host: str = settings.SITE_API_HOST
         self._token: str = settings.TOKEN_WORKSPACE_GLOBAL
-        self._temba_client = TembaClient(host=self._host, token=self._token)
+        self._temba_client = RateLimitedTembaClient(host=self._host, token=self._token)
 
     @property
     def host(self) -> str:
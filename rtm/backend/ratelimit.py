@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import hashlib
+import math
+import time
+
+from django_redis import get_redis_connection
+from temba_client.clients import MAX_RETRIES
+from temba_client.exceptions import TembaRateExceededError
+from temba_client.v2 import TembaClient
+
+from django.conf import settings
+
+# requests per hour allowed to each RapidPro workspace, shared by every worker syncing it
+RAPIDPRO_API_RATE_LIMIT = getattr(settings, "RAPIDPRO_API_RATE_LIMIT", 2400)
+
+# number of requests a workspace can make back to back after being idle
+RAPIDPRO_API_BURST = getattr(settings, "RAPIDPRO_API_BURST", 20)
+
+# longest a request waits for its turn before giving up and letting its task be rescheduled
+RAPIDPRO_API_MAX_WAIT = getattr(settings, "RAPIDPRO_API_MAX_WAIT", 60)
+
+# longest a request asked to retry on rate limits waits for its turn
+RAPIDPRO_API_MAX_RETRY_WAIT = getattr(settings, "RAPIDPRO_API_MAX_RETRY_WAIT", 60 * 10)
+
+RATE_LIMIT_BUCKET_KEY = "rapidpro-rate-limit:%s"
+
+# refills the bucket for the time elapsed since the last call then takes a token, going into debt when the wait
+# is acceptable so that waiting callers are served in order, returns whether a token was taken and the wait
+TAKE_TOKEN_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local max_wait = tonumber(ARGV[4])
+
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+
+local wait = 0
+if tokens < 1 then
+    wait = (1 - tokens) / rate
+end
+
+local taken = 0
+if max_wait >= 0 and wait <= max_wait then
+    tokens = tokens - 1
+    taken = 1
+end
+
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate + math.max(0, max_wait)) + 60)
+
+return {taken, tostring(wait)}
+"""
+
+# empties the bucket so that no token is available for the given number of seconds
+EMPTY_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local delay = tonumber(ARGV[4])
+
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+tokens = math.min(tokens, 1 - delay * rate)
+
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(delay + burst / rate) + 60)
+
+return tostring(tokens)
+"""
+
+
+def get_backend_host(backend):
+    # like org.get_temba_client of dash, backends without a host of their own use the site RapidPro
+    return backend.host or getattr(settings, "SITE_API_HOST", None)
+
+
+class RateLimiter(object):
+    """
+    Token bucket in Redis limiting the requests made to a RapidPro workspace across all workers and tasks.
+
+    Requests wait for their turn instead of failing with a 429 from the API, when the wait would be longer than
+    they can afford a TembaRateExceededError is raised with the wait, so the sync can be rescheduled then.
+    """
+
+    def __init__(self, key, rate_limit=None, burst=None):
+        self.key = key
+        self.rate = (rate_limit or RAPIDPRO_API_RATE_LIMIT) / 3600.0
+        self.burst = burst or RAPIDPRO_API_BURST
+
+    @classmethod
+    def for_workspace(cls, host, token):
+        # orgs sharing a workspace share its limit, the token itself is not kept in Redis
+        workspace = hashlib.sha1(("%s:%s" % (host, token)).encode("utf-8")).hexdigest()
+        return cls(RATE_LIMIT_BUCKET_KEY % workspace)
+
+    @classmethod
+    def for_backend(cls, backend):
+        return cls.for_workspace(get_backend_host(backend), backend.api_token)
+
+    def _run(self, script, arg):
+        r = get_redis_connection()
+        return r.eval(script, 1, self.key, repr(self.rate), self.burst, repr(time.time()), arg)
+
+    def take(self, max_wait):
+        """
+        Takes a token if one is available within max_wait seconds, returns whether it was taken and the seconds
+        to wait before using it, or before one is available
+        """
+        taken, wait = self._run(TAKE_TOKEN_SCRIPT, max_wait)
+        return bool(taken), float(wait)
+
+    def get_wait(self):
+        """
+        Gets the seconds until a token is available, without taking it
+        """
+        return self.take(-1)[1]
+
+    def acquire(self, max_wait=RAPIDPRO_API_MAX_WAIT):
+        """
+        Blocks until the next request can be made, or raises TembaRateExceededError with the seconds to wait
+        """
+        taken, wait = self.take(max_wait)
+        if not taken:
+            raise TembaRateExceededError(int(math.ceil(wait)))
+
+        if wait > 0:
+            time.sleep(wait)
+
+    def pause(self, delay):
+        """
+        Holds back every request for the given number of seconds, e.g. when the API tells us to retry later
+        """
+        self._run(EMPTY_BUCKET_SCRIPT, delay)
+
+    def get_countdown(self, retry_after=0):
+        """
+        Gets the countdown in seconds to reschedule a task that was refused by the API or by this limiter
+        """
+        return max(int(math.ceil(self.get_wait())), retry_after or 0, 1)
+
+
+class RateLimitedTembaClient(TembaClient):
+    """
+    API v2 client taking a token of the workspace rate limiter before every request
+    """
+
+    def __init__(self, host, token, user_agent=None, verify_ssl=None, rate_limiter=None):
+        super(RateLimitedTembaClient, self).__init__(host, token, user_agent=user_agent, verify_ssl=verify_ssl)
+
+        self.rate_limiter = rate_limiter or RateLimiter.for_workspace(host, token)
+
+    @classmethod
+    def for_backend(cls, backend):
+        agent = getattr(settings, "SITE_API_USER_AGENT", None)
+        return cls(get_backend_host(backend), backend.api_token, user_agent=agent)
+
+    def _request(self, method, url, params=None, body=None, retry_on_rate_exceed=False):
+        max_wait = RAPIDPRO_API_MAX_RETRY_WAIT if retry_on_rate_exceed else RAPIDPRO_API_MAX_WAIT
+        retries = 0
+
+        while True:
+            self.rate_limiter.acquire(max_wait)
+
+            try:
+                return super(RateLimitedTembaClient, self)._request(method, url, params=params, body=body)
+            except TembaRateExceededError as ex:
+                # our limit is above the one of the workspace, hold back every worker not just this one
+                self.rate_limiter.pause(ex.retry_after)
+
+                retries += 1
+                if not retry_on_rate_exceed or retries >= MAX_RETRIES:
+                    raise
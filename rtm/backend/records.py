@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from collections import namedtuple
+
+from rtm.contacts.models import Contact
+from rtm.polls.models import PollResult
+
+# the contact columns copied on every poll result of the contact
+ContactRecord = namedtuple("ContactRecord", ("state", "district", "ward", "born", "gender"))
+
+
+class PollResultRecord(object):
+    """
+    A poll result in flight during a sync, much lighter than a PollResult instance as many get replaced by a
+    newer step of the same run before the fetch is written. Kind is val or path, for the sync stats.
+    """
+
+    __slots__ = (
+        "kind",
+        "org_id",
+        "flow",
+        "ruleset",
+        "contact",
+        "date",
+        "completed",
+        "category",
+        "text",
+        "state",
+        "district",
+        "ward",
+        "gender",
+        "born",
+    )
+
+    def __init__(
+        self,
+        kind,
+        org_id,
+        flow,
+        ruleset,
+        contact,
+        date,
+        completed,
+        category,
+        text,
+        state,
+        district,
+        ward,
+        gender,
+        born,
+    ):
+        self.kind = kind
+        self.org_id = org_id
+        self.flow = flow
+        self.ruleset = ruleset
+        self.contact = contact
+        self.date = date
+        self.completed = completed
+        self.category = category
+        self.text = text
+        self.state = state
+        self.district = district
+        self.ward = ward
+        self.gender = gender
+        self.born = born
+
+    def as_poll_result(self):
+        return PollResult(**{field: getattr(self, field) for field in self.__slots__ if field != "kind"})
+
+    def __repr__(self):
+        return "PollResultRecord(%s, %s, %s, %s)" % (self.kind, self.contact, self.ruleset, self.date)
+
+
+def get_contact_records_map(org, contact_uuids):
+    """
+    Loads only the columns the sync copies on poll results for the given contacts, keyed by contact UUID
+    """
+    contacts = Contact.objects.filter(org=org, uuid__in=set(contact_uuids)).values_list("uuid", *ContactRecord._fields)
+    return {contact[0]: ContactRecord(*contact[1:]) for contact in contacts}
@@ -0,0 +1,109 @@
+import gzip
+import json
+import os
+import tempfile
+import unittest
+import uuid
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytz
+
+from rtm.backend.archives import ARCHIVE_DOWNLOAD_CHUNK_SIZE, ArchiveStore, iter_gzip_lines
+
+
+def build_archive_fixture(path, num_records, flow_uuids):
+    """
+    Writes a gzipped run archive with one JSON run record per line, like the RapidPro run archives
+    """
+    with gzip.open(path, "wb") as archive:
+        for i in range(num_records):
+            record = dict(
+                id=i,
+                uuid=str(uuid.uuid4()),
+                flow=dict(uuid=flow_uuids[i % len(flow_uuids)], name="Poll"),
+                contact=dict(uuid=str(uuid.uuid4()), name=""),
+                responded=True,
+                path=[dict(node=str(uuid.uuid4()), time="2020-01-01T00:00:00.000Z")],
+                values=dict(age=dict(value=str(i), category="Other", node=str(uuid.uuid4()))),
+                created_on="2020-01-01T00:00:00.000Z",
+                modified_on="2020-01-01T00:00:00.000Z",
+                exited_on="2020-01-01T00:00:00.000Z",
+                exit_type="completed",
+            )
+            archive.write(json.dumps(record).encode("utf-8") + b"\n")
+
+
+def iter_file_chunks(path, chunk_size=ARCHIVE_DOWNLOAD_CHUNK_SIZE):
+    with open(path, "rb") as archive:
+        while True:
+            chunk = archive.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+class TestIterGzipLines(unittest.TestCase):
+    def test_lines(self):
+        content = b"first\nsecond\n\nlast"
+        compressed = gzip.compress(content)
+
+        # feed the stream one byte at a time to split lines and the gzip header across chunks
+        chunks = [compressed[i : i + 1] for i in range(len(compressed))]
+        self.assertEqual(list(iter_gzip_lines(chunks)), [b"first", b"second", b"", b"last"])
+
+        self.assertEqual(list(iter_gzip_lines([compressed])), [b"first", b"second", b"", b"last"])
+        self.assertEqual(list(iter_gzip_lines([])), [])
+
+    def test_concatenated_members(self):
+        compressed = gzip.compress(b"a\nb\n") + gzip.compress(b"c\nd\n")
+        self.assertEqual(list(iter_gzip_lines([compressed[:10], compressed[10:]])), [b"a", b"b", b"c", b"d"])
+
+    def test_matches_gzip_file(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "runs.jsonl.gz")
+            build_archive_fixture(path, 2000, [str(uuid.uuid4())])
+
+            with gzip.open(path, "rb") as archive:
+                expected = [line.rstrip(b"\n") for line in archive]
+
+            self.assertEqual(list(iter_gzip_lines(iter_file_chunks(path))), expected)
+
+
+class TestArchiveStore(unittest.TestCase):
+    def test_flow_records(self):
+        flow_uuids = [str(uuid.uuid4()) for i in range(3)]
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "runs.jsonl.gz")
+            build_archive_fixture(path, 300, flow_uuids[:2])
+
+            store = ArchiveStore(os.path.join(tmp_dir, "store"))
+            self.assertFalse(store.has_archive("abc"))
+
+            store.save_archive("abc", iter_file_chunks(path))
+            self.assertTrue(store.has_archive("abc"))
+
+            with gzip.open(path, "rb") as archive:
+                records = [json.loads(line.decode("utf-8")) for line in archive]
+
+            for flow_uuid in flow_uuids:
+                expected = [record for record in records if record["flow"]["uuid"] == flow_uuid]
+                self.assertEqual(list(store.iter_flow_records("abc", flow_uuid)), expected)
+
+            self.assertEqual(list(store.iter_flow_records("abc", flow_uuids[2])), [])
+
+            self.assertEqual(store.prune(60), 0)
+            self.assertEqual(store.prune(-1), 1)
+            self.assertFalse(store.has_archive("abc"))
+            self.assertEqual(os.listdir(os.path.join(tmp_dir, "store")), [])
+
+    def test_archive_key(self):
+        start_date = datetime(2020, 3, 1, tzinfo=pytz.utc)
+        archive = SimpleNamespace(hash=None, period="monthly", start_date=start_date)
+        hashed_archive = SimpleNamespace(hash="f4b1", period="monthly", start_date=start_date)
+
+        # every workspace has an archive for the same period, each org gets its own
+        self.assertEqual(ArchiveStore.get_archive_key(1, archive), "1_monthly_20200301")
+        self.assertEqual(ArchiveStore.get_archive_key(2, archive), "2_monthly_20200301")
+        self.assertEqual(ArchiveStore.get_archive_key(1, hashed_archive), "1_f4b1")
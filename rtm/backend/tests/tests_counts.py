@@ -0,0 +1,123 @@
+from datetime import timedelta
+
+from django.test import TransactionTestCase
+
+from rtm.backend.diff import PollResultsCountsDelta, PollResultsDiff
+from rtm.backend.loaders import POLL_RESULTS_LOADER_COPY, POLL_RESULTS_LOADER_INSERT
+from rtm.backend.records import ContactRecord
+from rtm.polls.models import Poll, PollResultsCounter
+from rtm.polls.rebuilds import clear_flow_dirty, get_dirty_flows, get_dirty_polls, mark_flow_dirty
+from rtm.test import RTMTestMixin
+
+
+class PollResultsCountsTestMixin(RTMTestMixin):
+    @staticmethod
+    def save_with_diff(poll, poll_results, loader, counts_delta):
+        stats_dict = dict(
+            num_val_created=0,
+            num_val_updated=0,
+            num_val_ignored=0,
+            num_path_created=0,
+            num_path_updated=0,
+            num_path_ignored=0,
+        )
+        poll_results_diff = PollResultsDiff(poll.org_id, poll.flow_uuid, stats_dict, counts_delta)
+        for result in poll_results:
+            contact_record = ContactRecord(result.state, result.district, result.ward, result.born, result.gender)
+            poll_results_diff.add_value(
+                result.contact,
+                result.ruleset,
+                result.category,
+                result.text,
+                contact_record,
+                result.date,
+                result.completed,
+            )
+        poll_results_diff.save(loader)
+        return stats_dict
+
+
+class PollResultsCountsDeltaTest(PollResultsCountsTestMixin, TransactionTestCase):
+    def test_incremental_counts_match_rebuild(self):
+        for loader in (POLL_RESULTS_LOADER_INSERT, POLL_RESULTS_LOADER_COPY):
+            org = self.create_org()
+            poll = self.create_poll(org, 2)
+            rulesets = list(poll.questions.values_list("ruleset_uuid", flat=True))
+
+            poll_results = self.build_poll_results(org, 60, rulesets)
+            for result in poll_results:
+                result.flow = poll.flow_uuid
+
+            counts_delta = PollResultsCountsDelta(poll)
+            self.save_with_diff(poll, poll_results[:80], loader, counts_delta)
+            self.save_with_diff(poll, poll_results[80:], loader, counts_delta)
+
+            # newer answers change the category, location and gender of some results, older ones are ignored
+            changed = []
+            for i, result in enumerate(poll_results[:40]):
+                result.date += timedelta(hours=1) if i % 2 else -timedelta(hours=1)
+                result.category = "No" if i % 3 else "Other"
+                result.state = "R-ABUJA"
+                result.gender = "F"
+                changed.append(result)
+
+            stats_dict = self.save_with_diff(poll, changed, loader, counts_delta)
+            self.assertEqual(stats_dict["num_val_updated"], 20)
+            self.assertEqual(stats_dict["num_val_ignored"], 20)
+
+            poll.squash_poll_results_counts()
+            incremental_counters = self.get_counters(poll)
+            incremental_stats = self.get_stats(poll)
+            self.assertTrue(incremental_counters)
+
+            # squashed to one row per counter
+            self.assertEqual(
+                PollResultsCounter.objects.filter(org=org, ruleset__in=rulesets).count(), len(incremental_counters)
+            )
+
+            poll.rebuild_poll_results_counts()
+            self.assertEqual(self.get_counters(poll), incremental_counters)
+            self.assertEqual(self.get_stats(poll), incremental_stats)
+
+
+class PollResultsDirtyFlowsTest(PollResultsCountsTestMixin, TransactionTestCase):
+    def test_dirty_flows(self):
+        org = self.create_org()
+        poll = self.create_poll(org, 1)
+        other_poll = self.create_poll(org, 1)
+        rulesets = list(poll.questions.values_list("ruleset_uuid", flat=True))
+        clear_flow_dirty(org.pk, poll.flow_uuid)
+
+        poll_results = self.build_poll_results(org, 10, rulesets)
+        for result in poll_results:
+            result.flow = poll.flow_uuid
+
+        self.save_with_diff(poll, poll_results, POLL_RESULTS_LOADER_INSERT, None)
+        self.assertIn((org.pk, poll.flow_uuid), get_dirty_flows(org.pk))
+        self.assertEqual(list(get_dirty_polls(Poll.objects.filter(org=org), org.pk)), [poll])
+
+        # the rebuild clears the flow, saving results that are all ignored does not mark it again
+        poll.rebuild_poll_results_counts()
+        self.assertNotIn((org.pk, poll.flow_uuid), get_dirty_flows(org.pk))
+
+        for result in poll_results:
+            result.date -= timedelta(days=1)
+
+        stats_dict = self.save_with_diff(poll, poll_results, POLL_RESULTS_LOADER_INSERT, None)
+        self.assertEqual(stats_dict["num_val_ignored"], len(poll_results))
+        self.assertFalse(get_dirty_polls(Poll.objects.filter(pk__in=[poll.pk, other_poll.pk]), org.pk).exists())
+
+        # an incremental sync keeps the counters up to date with its delta, it leaves the flow clean
+        for result in poll_results:
+            result.date += timedelta(days=2)
+            result.category = "No"
+
+        stats_dict = self.save_with_diff(poll, poll_results, POLL_RESULTS_LOADER_INSERT, PollResultsCountsDelta(poll))
+        self.assertEqual(stats_dict["num_val_updated"], len(poll_results))
+        self.assertNotIn((org.pk, poll.flow_uuid), get_dirty_flows(org.pk))
+
+        # a flow without questions has nothing to rebuild but is cleared too
+        empty_poll = self.create_poll(org, 0)
+        mark_flow_dirty(org.pk, empty_poll.flow_uuid)
+        empty_poll.rebuild_poll_results_counts()
+        self.assertNotIn((org.pk, empty_poll.flow_uuid), get_dirty_flows(org.pk))
@@ -0,0 +1,75 @@
+import unittest
+import uuid
+from datetime import datetime, timedelta
+
+import pytz
+
+from rtm.backend.diff import PollResultsDiff
+from rtm.backend.records import ContactRecord
+
+
+class TestPollResultsDiff(unittest.TestCase):
+    def setUp(self):
+        self.stats_dict = dict(
+            num_val_created=0,
+            num_val_updated=0,
+            num_val_ignored=0,
+            num_path_created=0,
+            num_path_updated=0,
+            num_path_ignored=0,
+        )
+        self.diff = PollResultsDiff(1, str(uuid.uuid4()), self.stats_dict)
+        self.contact = str(uuid.uuid4())
+        self.ruleset = str(uuid.uuid4())
+        self.contact_record = ContactRecord("R-LAGOS", "R-OYO", "", 1990, "M")
+        self.now = datetime(2020, 1, 1, tzinfo=pytz.utc)
+
+    def get_record(self):
+        return self.diff.records[(self.contact, self.ruleset)]
+
+    def test_add_value(self):
+        self.diff.add_value(self.contact, self.ruleset, "Yes", "yes", self.contact_record, self.now, True)
+
+        record = self.get_record()
+        self.assertEqual(record.kind, "val")
+        self.assertEqual(record.org_id, 1)
+        self.assertEqual((record.category, record.text, record.date), ("Yes", "yes", self.now))
+        self.assertEqual((record.state, record.district, record.ward, record.born, record.gender), self.contact_record)
+
+        # same answer later is ignored
+        later = self.now + timedelta(minutes=1)
+        self.diff.add_value(self.contact, self.ruleset, "Yes", "yes", self.contact_record, later, True)
+        self.assertEqual(self.get_record().date, self.now)
+
+        # different answer earlier is ignored
+        self.diff.add_value(self.contact, self.ruleset, "No", "no", self.contact_record, self.now, True)
+        self.assertEqual(self.get_record().category, "Yes")
+
+        # different answer later replaces it
+        self.diff.add_value(self.contact, self.ruleset, "No", "no", self.contact_record, later, True)
+        self.assertEqual((self.get_record().category, self.get_record().date), ("No", later))
+
+        self.assertEqual(self.stats_dict["num_val_ignored"], 3)
+
+    def test_add_value_without_contact(self):
+        self.diff.add_value(self.contact, self.ruleset, "Yes", "yes", None, self.now, False)
+
+        record = self.get_record()
+        self.assertEqual(
+            (record.state, record.district, record.ward, record.born, record.gender), ("", "", "", None, None)
+        )
+        self.assertFalse(record.completed)
+
+    def test_add_path(self):
+        self.diff.add_value(self.contact, self.ruleset, "Yes", "yes", self.contact_record, self.now, True)
+
+        self.diff.add_path(self.contact, self.ruleset, self.contact_record, self.now, True)
+        self.assertEqual(self.get_record().kind, "val")
+
+        later = self.now + timedelta(minutes=1)
+        self.diff.add_path(self.contact, self.ruleset, self.contact_record, later, True)
+        record = self.get_record()
+        self.assertEqual((record.kind, record.category, record.text, record.date), ("path", None, "", later))
+
+        self.diff.ignore("path")
+        self.assertEqual(self.stats_dict["num_path_ignored"], 3)
@@ -0,0 +1,206 @@
+import uuid
+from datetime import timedelta
+
+from django.test import TransactionTestCase
+
+from rtm.backend.loaders import (
+    POLL_RESULTS_LOADER_AUTO,
+    POLL_RESULTS_LOADER_COPY,
+    POLL_RESULTS_LOADER_INSERT,
+    get_poll_results_loader,
+    save_poll_results,
+)
+from rtm.backend.diff import PollResultsDiff
+from rtm.backend.records import ContactRecord
+from rtm.polls.models import PollResult
+from rtm.stats.models import ContactActivity
+from rtm.test import RTMTestMixin
+
+
+class PollResultsLoaderTestMixin(RTMTestMixin):
+    @staticmethod
+    def get_rows(org):
+        return sorted(
+            PollResult.objects.filter(org=org).values_list(
+                "contact",
+                "ruleset",
+                "date",
+                "completed",
+                "category",
+                "text",
+                "state",
+                "district",
+                "ward",
+                "gender",
+                "born",
+            )
+        )
+
+    @staticmethod
+    def get_activities(org):
+        return sorted(
+            ContactActivity.objects.filter(org=org).values_list(
+                "contact", "date", "born", "gender", "state", "district", "ward"
+            )
+        )
+
+
+class PollResultsLoaderTest(PollResultsLoaderTestMixin, TransactionTestCase):
+    def test_get_poll_results_loader(self):
+        self.assertEqual(
+            get_poll_results_loader(POLL_RESULTS_LOADER_INSERT, first_sync=True), POLL_RESULTS_LOADER_INSERT
+        )
+        self.assertEqual(get_poll_results_loader(POLL_RESULTS_LOADER_COPY), POLL_RESULTS_LOADER_COPY)
+        self.assertEqual(get_poll_results_loader(POLL_RESULTS_LOADER_AUTO, first_sync=True), POLL_RESULTS_LOADER_COPY)
+        self.assertEqual(
+            get_poll_results_loader(POLL_RESULTS_LOADER_AUTO, first_sync=False), POLL_RESULTS_LOADER_INSERT
+        )
+
+        with self.assertRaises(ValueError):
+            get_poll_results_loader("unknown")
+
+    @staticmethod
+    def copy_to_org(poll_results, org):
+        copied_fields = [f.attname for f in PollResult._meta.concrete_fields if f.attname not in ("id", "org_id")]
+        return [
+            PollResult(org=org, **{field: getattr(result, field) for field in copied_fields})
+            for result in poll_results
+        ]
+
+    def test_copy_matches_orm(self):
+        orm_org = self.create_org()
+        copy_org = self.create_org()
+        rulesets = [str(uuid.uuid4()) for i in range(3)]
+
+        # the rows of a contact disagree on its attributes, and the last one of each contact is its oldest
+        orm_results = self.build_poll_results(orm_org, 50, rulesets)
+        for i, result in enumerate(orm_results):
+            result.born = 1980 + i % 7
+            result.gender = "M" if i % 2 else "F"
+            result.state = "R-LAGOS" if i % 3 else "R-KANO"
+            result.district = "R-OYO" if i % 4 else "R-IKEJA"
+            result.ward = "R-WARD-%d" % (i % 5)
+
+        save_poll_results(orm_results, POLL_RESULTS_LOADER_INSERT)
+        save_poll_results(self.copy_to_org(orm_results, copy_org), POLL_RESULTS_LOADER_COPY)
+
+        self.assertEqual(self.get_rows(copy_org), self.get_rows(orm_org))
+        self.assertEqual(self.get_activities(copy_org), self.get_activities(orm_org))
+
+        # results at the same time as the ones in the db are ignored, they must not change the activities
+        ignored = self.copy_to_org(orm_results[:6], orm_org)
+        for result in ignored:
+            result.born, result.gender, result.state = 2005, "O", "R-ABUJA"
+
+        newer = self.copy_to_org(orm_results[6:9], orm_org)
+        for result in newer:
+            result.date += timedelta(hours=1)
+            result.gender, result.district = "F", "R-EPE"
+
+        save_poll_results(ignored + newer, POLL_RESULTS_LOADER_INSERT)
+        save_poll_results(self.copy_to_org(ignored + newer, copy_org), POLL_RESULTS_LOADER_COPY)
+
+        self.assertEqual(self.get_rows(copy_org), self.get_rows(orm_org))
+        self.assertEqual(self.get_activities(copy_org), self.get_activities(orm_org))
+        self.assertFalse(ContactActivity.objects.filter(org=copy_org, gender="O").exists())
+
+    def test_newest_result_wins(self):
+        for loader in (POLL_RESULTS_LOADER_INSERT, POLL_RESULTS_LOADER_COPY):
+            org = self.create_org()
+            rulesets = [str(uuid.uuid4()) for i in range(2)]
+            poll_results = self.build_poll_results(org, 4, rulesets)
+
+            written = save_poll_results(poll_results, loader)
+            self.assertEqual(len(written), 8)
+            self.assertTrue(all(created for contact, ruleset, created in written))
+
+            newer, older = poll_results[2], poll_results[3]
+            newer.date += timedelta(hours=1)
+            newer.category = "No"
+            older.date -= timedelta(hours=1)
+            older.category = "No"
+
+            written = save_poll_results([newer, older], loader)
+            self.assertEqual(written, [(newer.contact, newer.ruleset, False)])
+
+            self.assertEqual(PollResult.objects.filter(org=org).count(), 8)
+            self.assertEqual(
+                PollResult.objects.get(org=org, contact=newer.contact, ruleset=newer.ruleset).category, "No"
+            )
+            self.assertEqual(
+                PollResult.objects.get(org=org, contact=older.contact, ruleset=older.ruleset).category, "Yes"
+            )
+
+    def test_update_refreshes_activities(self):
+        for loader in (POLL_RESULTS_LOADER_INSERT, POLL_RESULTS_LOADER_COPY):
+            org = self.create_org()
+            rulesets = [str(uuid.uuid4()) for i in range(2)]
+            poll_results = self.build_poll_results(org, 3, rulesets)
+            save_poll_results(poll_results, loader)
+
+            # the second contact answered again after moving, its activities take its new location and gender
+            result = poll_results[2]
+            activities = ContactActivity.objects.filter(org=org, contact=result.contact)
+            self.assertEqual(set(activities.values_list("gender", "state", "district")), {("M", "R-LAGOS", "R-OYO")})
+            months = set(activities.values_list("date", flat=True))
+
+            newer = self.copy_to_org([result], org)[0]
+            newer.date += timedelta(hours=1)
+            newer.gender, newer.state, newer.district = "F", "R-KANO", "R-EPE"
+
+            written = save_poll_results([newer], loader)
+            self.assertEqual(written, [(newer.contact, newer.ruleset, False)])
+
+            self.assertEqual(
+                set(activities.values_list("born", "gender", "state", "district", "ward")),
+                {(newer.born, "F", "R-KANO", "R-EPE", "")},
+            )
+            self.assertTrue(months <= set(activities.values_list("date", flat=True)))
+
+            # the other contacts are left alone
+            self.assertFalse(
+                ContactActivity.objects.filter(org=org, gender="F", state="R-KANO")
+                .exclude(contact=newer.contact)
+                .exists()
+            )
+
+    def test_diff_save(self):
+        org = self.create_org()
+        rulesets = [str(uuid.uuid4()) for i in range(2)]
+        first, second, third = self.build_poll_results(org, 2, rulesets)[:3]
+        save_poll_results([first], POLL_RESULTS_LOADER_INSERT)
+
+        stats_dict = dict(
+            num_val_created=0,
+            num_val_updated=0,
+            num_val_ignored=0,
+            num_path_created=0,
+            num_path_updated=0,
+            num_path_ignored=0,
+        )
+        poll_results_diff = PollResultsDiff(org.pk, first.flow, stats_dict)
+        contact_record = ContactRecord(first.state, first.district, first.ward, first.born, first.gender)
+
+        # older than the result in the db
+        poll_results_diff.add_value(
+            first.contact, first.ruleset, "No", "no", contact_record, first.date - timedelta(hours=1), True
+        )
+        poll_results_diff.add_path(second.contact, second.ruleset, contact_record, second.date, True)
+        poll_results_diff.add_value(third.contact, third.ruleset, "No", "no", None, third.date, True)
+        poll_results_diff.save(POLL_RESULTS_LOADER_INSERT)
+
+        self.assertEqual(
+            stats_dict,
+            dict(
+                num_val_created=1,
+                num_val_updated=0,
+                num_val_ignored=1,
+                num_path_created=1,
+                num_path_updated=0,
+                num_path_ignored=0,
+            ),
+        )
+        self.assertEqual(
+            PollResult.objects.get(org=org, contact=first.contact, ruleset=first.ruleset).category, first.category
+        )
+        self.assertEqual(PollResult.objects.get(org=org, contact=third.contact, ruleset=third.ruleset).state, "")
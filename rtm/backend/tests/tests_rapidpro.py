@@ -0,0 +1,221 @@
+import gzip
+import json
+import os
+import tempfile
+import uuid
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+from temba_client.v2.types import Archive
+
+from django.conf import settings
+from django.core.cache import cache
+from django.test import SimpleTestCase, TransactionTestCase
+from django.utils import timezone
+
+from rtm.backend.archives import ArchiveStore
+from rtm.backend.rapidpro import FetchesPrefetcher, RapidProBackend
+from rtm.polls.models import Poll, SyncRun
+from rtm.test import RTMTestMixin
+
+from .tests_archives import build_archive_fixture, iter_file_chunks
+
+
+class MockFetches(object):
+    """
+    Pages of runs iterated like a temba cursor iterator, page N being resumed from the cursor page-N
+    """
+
+    def __init__(self, pages, resume_cursor=None):
+        self.pages = pages
+        self.index = int(resume_cursor.split("-")[1]) - 1 if resume_cursor else 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.index >= len(self.pages):
+            raise StopIteration
+
+        page = self.pages[self.index]
+        self.index += 1
+        if isinstance(page, Exception):
+            raise page
+        return page
+
+    def get_cursor(self):
+        return "page-%d" % (self.index + 1) if self.index < len(self.pages) else None
+
+
+class FetchesPrefetcherTest(SimpleTestCase):
+    def test_cursors(self):
+        pages = [["a", "b"], ["c"], ["d", "e"]]
+        prefetcher = FetchesPrefetcher(MockFetches(pages), 2)
+
+        fetched = []
+        for fetch in prefetcher:
+            fetched.append((fetch, prefetcher.get_cursor()))
+
+        # each cursor resumes after the page handed out with it, even when the next pages were already fetched
+        self.assertEqual(fetched, [(["a", "b"], "page-2"), (["c"], "page-3"), (["d", "e"], None)])
+
+        prefetcher = FetchesPrefetcher(MockFetches(pages, resume_cursor="page-3"), 2, resume_cursor="page-3")
+        self.assertEqual(prefetcher.get_cursor(), "page-3")
+        self.assertEqual(list(prefetcher), [["d", "e"]])
+        self.assertIsNone(prefetcher.get_cursor())
+
+    def test_error(self):
+        prefetcher = FetchesPrefetcher(MockFetches([["a"], ValueError("boom")]), 2)
+
+        fetches = iter(prefetcher)
+        self.assertEqual(next(fetches), ["a"])
+        with self.assertRaises(ValueError):
+            next(fetches)
+        self.assertEqual(prefetcher.get_cursor(), "page-2")
+
+
+class PollResultsPullTest(RTMTestMixin, TransactionTestCase):
+    def setUp(self):
+        self.org = self.create_org()
+        self.poll = self.create_poll(self.org, 1)
+        self.backend = RapidProBackend(backend=None)
+
+        now = timezone.now()
+        self.pages = [
+            [
+                SimpleNamespace(
+                    contact=SimpleNamespace(uuid=str(uuid.uuid4())),
+                    modified_on=now - timedelta(minutes=10 - i * 2 - j),
+                    values=dict(),
+                    path=[],
+                    exit_type="completed",
+                )
+                for j in range(2)
+            ]
+            for i in range(3)
+        ]
+
+    def get_client(self):
+        def iterfetches(retry_on_rate_exceed, resume_cursor):
+            return MockFetches(self.pages, resume_cursor=resume_cursor)
+
+        client = MagicMock()
+        client.get_runs.return_value.iterfetches.side_effect = iterfetches
+        return client
+
+    @patch("rtm.backend.ratelimit.RateLimitedTembaClient.__init__", return_value=None)
+    def test_get_client(self, mock_client):
+        # like org.get_temba_client, a backend without a host uses the site RapidPro
+        backend = RapidProBackend(backend=SimpleNamespace(host="", api_token="token"))
+        backend._get_client(self.org, 2)
+        self.assertEqual(mock_client.call_args[0], (settings.SITE_API_HOST, "token"))
+
+        backend = RapidProBackend(backend=SimpleNamespace(host="https://rapidpro.example.com", api_token="token"))
+        backend._get_client(self.org, 2)
+        self.assertEqual(mock_client.call_args[0], ("https://rapidpro.example.com", "token"))
+
+    @patch("rtm.polls.tasks.pull_poll_results.apply_async")
+    def test_pause_saves_cursor(self, mock_pull_poll_results):
+        cursor_key = Poll.POLL_RESULTS_LAST_PULL_CURSOR % (self.org.pk, self.poll.flow_uuid)
+        client = self.get_client()
+
+        with patch.object(RapidProBackend, "_get_client", return_value=client):
+            with patch.object(Poll, "POLL_RESULTS_MAX_SYNC_RUNS", 4):
+                self.backend.pull_results(self.poll, None, None)
+
+            # paused after the second page, the next sync resumes at the third one
+            self.assertEqual(cache.get(cursor_key), "page-3")
+            self.assertEqual(mock_pull_poll_results.call_count, 1)
+
+            sync_run = SyncRun.objects.get(poll=self.poll)
+            self.assertEqual((sync_run.num_fetches, sync_run.num_runs), (2, 4))
+            self.assertEqual(sync_run.pause_reason, SyncRun.PAUSE_MAX_RUNS)
+
+            self.backend.pull_results(self.poll, None, None)
+
+        self.assertEqual(client.get_runs.return_value.iterfetches.call_args[1]["resume_cursor"], "page-3")
+        self.assertIsNone(cache.get(cursor_key))
+        self.assertEqual(mock_pull_poll_results.call_count, 1)
+
+        sync_run = SyncRun.objects.filter(poll=self.poll).order_by("id").last()
+        self.assertEqual((sync_run.num_fetches, sync_run.num_runs), (1, 2))
+        self.assertIsNone(sync_run.pause_reason)
+
+    @patch("rtm.backend.rapidpro.RapidProBackend._iter_poll_record_runs")
+    def test_archive_failure(self, mock_iter_poll_record_runs):
+        archive_json = Archive.create(
+            archive_type="run",
+            start_date=timezone.now().replace(day=1),
+            period="monthly",
+            record_count=4,
+            size=100,
+            hash=None,
+            download_url="http://archives/runs.jsonl.gz",
+        ).serialize()
+
+        def iter_poll_record_runs(org, archive, flow_uuid):
+            yield self.pages[0]
+            raise EOFError("truncated archive")
+
+        mock_iter_poll_record_runs.side_effect = iter_poll_record_runs
+
+        # the error reaches the task so the chord does not complete the pull, the sync run is still recorded
+        with self.assertRaises(EOFError):
+            self.backend.pull_results_from_archive(self.poll, archive_json)
+
+        sync_run = SyncRun.objects.get(poll=self.poll)
+        self.assertEqual(sync_run.source, SyncRun.SOURCE_ARCHIVE)
+        self.assertEqual((sync_run.num_fetches, sync_run.num_runs), (1, 2))
+        self.assertIsNotNone(sync_run.ended_on)
+
+    @patch("rtm.backend.rapidpro.socket.gethostname", return_value="worker-1")
+    @patch("rtm.backend.rapidpro.requests.get")
+    def test_archives_per_org(self, mock_get, mock_gethostname):
+        other_org = self.create_org()
+        start_date = timezone.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        archive = SimpleNamespace(hash=None, period="monthly", start_date=start_date, download_url="http://archives")
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            paths = dict()
+            for org in (self.org, other_org):
+                paths[org.pk] = os.path.join(tmp_dir, "%d.jsonl.gz" % org.pk)
+                build_archive_fixture(paths[org.pk], 10, [self.poll.flow_uuid])
+
+            downloads = []
+
+            def get(url, stream):
+                response = MagicMock()
+                response.__enter__.return_value.iter_content.side_effect = lambda chunk_size: iter_file_chunks(
+                    paths[downloads[-1]]
+                )
+                return response
+
+            mock_get.side_effect = get
+
+            with patch("rtm.backend.rapidpro.RUN_ARCHIVES_CACHE_DIR", os.path.join(tmp_dir, "store")):
+                with patch("rtm.backend.rapidpro.get_redis_connection") as mock_redis:
+                    records = dict()
+                    for org in (self.org, other_org, self.org):
+                        downloads.append(org.pk)
+                        records.setdefault(org.pk, []).append(
+                            list(self.backend._iter_archive_records(org, archive, self.poll.flow_uuid))
+                        )
+
+            # the archives of the same period of two workspaces are kept apart, each is downloaded once
+            self.assertEqual(mock_get.call_count, 2)
+            for org in (self.org, other_org):
+                with gzip.open(paths[org.pk], "rb") as archive_file:
+                    expected = [json.loads(line.decode("utf-8")) for line in archive_file]
+                self.assertEqual(records[org.pk][0], expected)
+            self.assertEqual(records[self.org.pk][1], records[self.org.pk][0])
+            self.assertNotEqual(records[self.org.pk][0], records[other_org.pk][0])
+
+            # only the workers of the same host wait for each other's downloads
+            self.assertEqual(
+                [call[0][0] for call in mock_redis.return_value.lock.call_args_list],
+                [
+                    "run-archive-download-lock:worker-1:%s" % ArchiveStore.get_archive_key(org.pk, archive)
+                    for org in (self.org, other_org)
+                ],
+            )
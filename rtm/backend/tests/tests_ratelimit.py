@@ -0,0 +1,77 @@
+import uuid
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from django_redis import get_redis_connection
+from temba_client.exceptions import TembaRateExceededError
+
+from django.conf import settings
+from django.test import SimpleTestCase
+
+from rtm.backend.ratelimit import RateLimitedTembaClient, RateLimiter, get_backend_host
+
+
+class RateLimiterTest(SimpleTestCase):
+    def setUp(self):
+        # one request per second with a burst of two
+        self.rate_limiter = RateLimiter("rapidpro-rate-limit:test-%s" % uuid.uuid4().hex, rate_limit=3600, burst=2)
+
+    def tearDown(self):
+        get_redis_connection().delete(self.rate_limiter.key)
+
+    def test_take(self):
+        self.assertEqual(self.rate_limiter.take(0), (True, 0))
+        self.assertEqual(self.rate_limiter.take(0), (True, 0))
+
+        # the bucket is empty, a token is about a second away
+        taken, wait = self.rate_limiter.take(0)
+        self.assertFalse(taken)
+        self.assertAlmostEqual(wait, 1, delta=0.1)
+
+        with self.assertRaises(TembaRateExceededError):
+            self.rate_limiter.acquire(0)
+
+        # callers that can wait are queued one behind the other
+        self.assertTrue(self.rate_limiter.take(10)[0])
+        taken, wait = self.rate_limiter.take(10)
+        self.assertTrue(taken)
+        self.assertAlmostEqual(wait, 2, delta=0.1)
+
+    def test_pause(self):
+        self.rate_limiter.pause(30)
+        self.assertAlmostEqual(self.rate_limiter.get_wait(), 30, delta=0.1)
+        self.assertEqual(self.rate_limiter.get_countdown(), 30)
+        self.assertEqual(self.rate_limiter.get_countdown(45), 45)
+
+        # getting the wait does not take a token
+        self.assertAlmostEqual(self.rate_limiter.get_wait(), 30, delta=0.1)
+
+    @patch("rtm.backend.ratelimit.time.sleep")
+    @patch("temba_client.clients.BaseClient._request")
+    def test_client_request(self, mock_request, mock_sleep):
+        client = RateLimitedTembaClient("localhost", "token", rate_limiter=self.rate_limiter)
+
+        mock_request.side_effect = [TembaRateExceededError(5), dict(results=[])]
+        self.assertEqual(client._request("get", "url", retry_on_rate_exceed=True), dict(results=[]))
+        self.assertEqual(mock_request.call_count, 2)
+
+        # the retry waited for the pause the API asked for
+        self.assertAlmostEqual(mock_sleep.call_args[0][0], 5, delta=0.1)
+
+        mock_request.reset_mock()
+        mock_request.side_effect = [TembaRateExceededError(5)]
+        with self.assertRaises(TembaRateExceededError):
+            client._request("get", "url")
+        self.assertEqual(mock_request.call_count, 1)
+
+    def test_backend_host(self):
+        backend = SimpleNamespace(host="https://rapidpro.example.com", api_token="token")
+        self.assertEqual(get_backend_host(backend), "https://rapidpro.example.com")
+
+        # a backend without a host is on the site RapidPro, and shares its limit with the backends naming it
+        site_backend = SimpleNamespace(host="", api_token="token")
+        self.assertEqual(get_backend_host(site_backend), settings.SITE_API_HOST)
+        self.assertEqual(
+            RateLimiter.for_backend(site_backend).key,
+            RateLimiter.for_backend(SimpleNamespace(host=settings.SITE_API_HOST, api_token="token")).key,
+        )
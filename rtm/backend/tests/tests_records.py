@@ -0,0 +1,119 @@
+import uuid
+from datetime import timedelta
+
+from django.test import TransactionTestCase
+from django.utils import timezone
+
+from rtm.backend.diff import POLL_RESULT_KIND_PATH, POLL_RESULT_KIND_VALUE, PollResultsDiff
+from rtm.backend.loaders import POLL_RESULTS_LOADER_COPY, POLL_RESULTS_LOADER_INSERT
+from rtm.backend.records import ContactRecord, PollResultRecord
+from rtm.polls.models import PollResult
+from rtm.test import RTMTestMixin
+
+
+class PollResultRecordTest(RTMTestMixin, TransactionTestCase):
+    def setUp(self):
+        self.org = self.create_org()
+        self.flow = str(uuid.uuid4())
+        self.rulesets = [str(uuid.uuid4()) for i in range(3)]
+        self.contacts = [str(uuid.uuid4()) for i in range(4)]
+        self.contact_record = ContactRecord("R-LAGOS", "R-OYO", "", 1990, "M")
+        self.now = timezone.now()
+
+    def get_stats_dict(self):
+        return dict(
+            num_val_created=0,
+            num_val_updated=0,
+            num_val_ignored=0,
+            num_path_created=0,
+            num_path_updated=0,
+            num_path_ignored=0,
+        )
+
+    def get_rows(self):
+        return sorted(
+            PollResult.objects.filter(org=self.org).values_list(
+                "contact", "ruleset", "date", "completed", "category", "text", "state", "district", "gender", "born"
+            )
+        )
+
+    def test_as_poll_result(self):
+        record = PollResultRecord(
+            POLL_RESULT_KIND_VALUE,
+            self.org.pk,
+            self.flow,
+            self.rulesets[0],
+            self.contacts[0],
+            self.now,
+            True,
+            "Yes",
+            "yes",
+            "R-LAGOS",
+            "R-OYO",
+            "",
+            "M",
+            1990,
+        )
+        poll_result = record.as_poll_result()
+
+        self.assertIsInstance(poll_result, PollResult)
+        self.assertIsNone(poll_result.pk)
+        self.assertEqual(
+            (poll_result.org_id, poll_result.flow, poll_result.ruleset, poll_result.contact, poll_result.date),
+            (self.org.pk, self.flow, self.rulesets[0], self.contacts[0], self.now),
+        )
+        self.assertEqual(
+            (poll_result.completed, poll_result.category, poll_result.text, poll_result.state, poll_result.born),
+            (True, "Yes", "yes", "R-LAGOS", 1990),
+        )
+
+    def test_diff_keeps_newest_record(self):
+        for loader in (POLL_RESULTS_LOADER_INSERT, POLL_RESULTS_LOADER_COPY):
+            PollResult.objects.filter(org=self.org).delete()
+            stats_dict = self.get_stats_dict()
+            poll_results_diff = PollResultsDiff(self.org.pk, self.flow, stats_dict)
+
+            for i, contact in enumerate(self.contacts):
+                for j, ruleset in enumerate(self.rulesets):
+                    date = self.now - timedelta(minutes=i * 10 + j)
+                    poll_results_diff.add_value(
+                        contact, ruleset, "Yes", "yes", self.contact_record, date - timedelta(seconds=2), False
+                    )
+                    poll_results_diff.add_path(
+                        contact, ruleset, self.contact_record, date - timedelta(seconds=3), False
+                    )
+                    poll_results_diff.add_value(contact, ruleset, "No", "no", self.contact_record, date, True)
+
+            self.assertTrue(all(isinstance(record, PollResultRecord) for record in poll_results_diff.records.values()))
+            poll_results_diff.save(loader)
+
+            expected = []
+            for i, contact in enumerate(self.contacts):
+                for j, ruleset in enumerate(self.rulesets):
+                    date = self.now - timedelta(minutes=i * 10 + j)
+                    expected.append((contact, ruleset, date, True, "No", "no", "R-LAGOS", "R-OYO", "M", 1990))
+            self.assertEqual(self.get_rows(), sorted(expected))
+            self.assertEqual(poll_results_diff.records, dict())
+            self.assertEqual(stats_dict["num_val_created"], 12)
+            self.assertEqual(stats_dict["num_val_ignored"], 12)
+            self.assertEqual(stats_dict["num_path_ignored"], 12)
+
+            # a newer path step replaces the value, an older value is ignored by the loader
+            stats_dict = self.get_stats_dict()
+            poll_results_diff = PollResultsDiff(self.org.pk, self.flow, stats_dict)
+            poll_results_diff.add_path(
+                self.contacts[0], self.rulesets[0], self.contact_record, self.now + timedelta(minutes=1), True
+            )
+            poll_results_diff.add_value(
+                self.contacts[1], self.rulesets[0], "Yes", "yes", None, self.now - timedelta(days=1), True
+            )
+            poll_results_diff.save(loader)
+
+            self.assertEqual(stats_dict["num_%s_updated" % POLL_RESULT_KIND_PATH], 1)
+            self.assertEqual(stats_dict["num_%s_ignored" % POLL_RESULT_KIND_VALUE], 1)
+
+            rows = {(row[0], row[1]): row for row in self.get_rows()}
+            self.assertEqual(
+                rows[(self.contacts[0], self.rulesets[0])][2:6], (self.now + timedelta(minutes=1), True, None, "")
+            )
+            self.assertEqual(rows[(self.contacts[1], self.rulesets[0])][4:6], ("No", "no"))
@@ -3,6 +3,7 @@ import logging
 import time
 
 from dash.orgs.tasks import org_task
+from temba_client.exceptions import TembaRateExceededError
 
 logger = logging.getLogger(__name__)
 
@@ -57,8 +58,19 @@ def pull_channel_stats(org):
 
 
 def request(backend, endpoint):
+    from rtm.backend.ratelimit import RateLimiter
+
     headers = {"Authorization": "Token {}".format(backend.api_token)}
 
+    # channel stats count against the same workspace limit as the syncs
+    rate_limiter = RateLimiter.for_backend(backend)
+    rate_limiter.acquire()
+
     response = requests.get("{}/api/v2/{}.json".format(backend.host, endpoint), headers=headers)
+    if response.status_code == 429:
+        retry_after = int(response.headers.get("retry-after") or 0)
+        rate_limiter.pause(retry_after)
+        raise TembaRateExceededError(retry_after)
+
     response = response.json()
     return response.get("results")
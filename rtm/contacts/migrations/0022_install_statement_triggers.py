@@ -0,0 +1,10 @@
+from django.db import migrations
+
+from rtm.sql import InstallSQL
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("contacts", "0021_auto_20190926_1554")]
+
+    operations = [InstallSQL("contacts_0022")]
@@ -0,0 +1,18 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("contacts", "0022_install_statement_triggers")]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="reporterscounter",
+            index=models.Index(
+                fields=["org", "type"],
+                name="contacts_reporters_org_prefix",
+                opclasses=["int4_ops", "varchar_pattern_ops"],
+            ),
+        ),
+        migrations.AlterIndexTogether(name="reporterscounter", index_together=set()),
+    ]
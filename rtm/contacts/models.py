@@ -4,12 +4,13 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 import logging
 import time
 from collections import defaultdict
+from datetime import date
 
 from dash.orgs.models import Org, OrgBackend
 from django_redis import get_redis_connection
 
 from django.db import connection, models
-from django.db.models import Count, Sum
+from django.db.models import Sum
 from django.utils.translation import ugettext_lazy as _
 
 from rtm.utils import chunk_list
@@ -20,6 +21,33 @@ CONTACT_FIELD_LOCK_KEY = "lock:contact-field:%d:%s"
 
 logger = logging.getLogger(__name__)
 
+# replaces the rows of the counters of an org that got new rows since the last squash with a single one holding
+# their sum, like ureport_squash_reporterscounters does for one counter but for all of them in one statement
+SQUASH_REPORTERS_COUNTERS_SQL = """
+WITH squashed AS (
+    DELETE FROM contacts_reporterscounter
+    WHERE org_id = %(org_id)s AND type IN (
+        SELECT DISTINCT type FROM contacts_reporterscounter WHERE org_id = %(org_id)s AND id > %(last_id)s
+    )
+    RETURNING org_id, type, count
+)
+INSERT INTO contacts_reporterscounter (org_id, type, count)
+SELECT org_id, type, GREATEST(0, SUM(count)) FROM squashed GROUP BY org_id, type
+"""
+
+# the first squash takes every counter of the org with more than one row
+SQUASH_ALL_REPORTERS_COUNTERS_SQL = """
+WITH squashed AS (
+    DELETE FROM contacts_reporterscounter
+    WHERE org_id = %(org_id)s AND type IN (
+        SELECT type FROM contacts_reporterscounter WHERE org_id = %(org_id)s GROUP BY type HAVING COUNT(*) > 1
+    )
+    RETURNING org_id, type, count
+)
+INSERT INTO contacts_reporterscounter (org_id, type, count)
+SELECT org_id, type, GREATEST(0, SUM(count)) FROM squashed GROUP BY org_id, type
+"""
+
 
 class ContactField(models.Model):
     """
@@ -229,6 +257,27 @@ class ReportersCounter(models.Model):
     COUNTS_SQUASH_LOCK = "org-reporters-counts-squash-lock"
     LAST_SQUASHED_ID_KEY = "org-reporters-last-squashed-id"
 
+    # the families of counters, the start of their type
+    FAMILY_TOTAL = "total-reporters"
+    FAMILY_GENDER = "gender"
+    FAMILY_BORN = "born"
+    FAMILY_OCCUPATION = "occupation"
+    FAMILY_REGISTERED_ON = "registered_on"
+    FAMILY_REGISTERED_GENDER = "registered_gender"
+    FAMILY_REGISTERED_BORN = "registered_born"
+    FAMILY_REGISTERED_STATE = "registered_state"
+    FAMILY_STATE = "state"
+    FAMILY_DISTRICT = "district"
+    FAMILY_WARD = "ward"
+
+    # the families whose counters are by date of registration, or by month of registration and a value
+    REGISTERED_FAMILIES = (
+        FAMILY_REGISTERED_ON,
+        FAMILY_REGISTERED_GENDER,
+        FAMILY_REGISTERED_BORN,
+        FAMILY_REGISTERED_STATE,
+    )
+
     org = models.ForeignKey(Org, on_delete=models.PROTECT, related_name="reporters_counters")
 
     type = models.CharField(max_length=255)
@@ -252,42 +301,27 @@ class ReportersCounter(models.Model):
                 last_squash = int(last_squash)
 
                 start = time.time()
-                squash_count = 0
 
+                # squash the counters one org at a time, each in a single statement
                 if last_squash < 1:
-                    counters = (
-                        ReportersCounter.objects.values("org_id", "type")
-                        .annotate(Count("id"))
-                        .filter(id__count__gt=1)
-                        .order_by("org_id", "type")
-                    )
-
+                    org_ids = ReportersCounter.objects.values_list("org_id", flat=True)
+                    squash_sql = SQUASH_ALL_REPORTERS_COUNTERS_SQL
                 else:
-                    counters = (
-                        ReportersCounter.objects.filter(id__gt=last_squash)
-                        .values("org_id", "type")
-                        .order_by("org_id", "type")
-                        .distinct("org_id", "type")
-                    )
-
-                total_counters = len(counters)
+                    org_ids = ReportersCounter.objects.filter(id__gt=last_squash).values_list("org_id", flat=True)
+                    squash_sql = SQUASH_REPORTERS_COUNTERS_SQL
 
-                # get all the new added counters
-                for counter in counters:
+                org_ids = list(org_ids.order_by("org_id").distinct("org_id"))
 
-                    # perform our atomic squash in SQL by calling our squash method
+                squash_count = 0
+                for org_id in org_ids:
                     with connection.cursor() as c:
-                        c.execute(
-                            "SELECT ureport_squash_reporterscounters(%s, %s);", (counter["org_id"], counter["type"])
-                        )
-
-                    squash_count += 1
+                        c.execute(squash_sql, dict(org_id=org_id, last_id=last_squash))
+                        squash_count += c.rowcount
 
-                    if squash_count % 100 == 0:
-                        logger.info(
-                            "Squashing progress ... %0.2f/100 in in %0.3fs"
-                            % (squash_count * 100 / total_counters, time.time() - start)
-                        )
+                    logger.info(
+                        "Squashed reporters counts for org #%d, %d types so far in %0.3fs"
+                        % (org_id, squash_count, time.time() - start)
+                    )
 
                 # insert our new top squashed id
                 max_id = ReportersCounter.objects.all().order_by("-id").first()
@@ -295,7 +329,8 @@ class ReportersCounter(models.Model):
                     r.set(ReportersCounter.LAST_SQUASHED_ID_KEY, max_id.id)
 
                 logger.info(
-                    "Squashed poll results counts for %d types in %0.3fs" % (squash_count, time.time() - start)
+                    "Squashed reporters counts for %d types of %d orgs in %0.3fs"
+                    % (squash_count, len(org_ids), time.time() - start)
                 )
 
     @classmethod
@@ -310,5 +345,42 @@ class ReportersCounter(models.Model):
 
         return {c["type"]: c["count_sum"] for c in counter_counts}
 
+    @classmethod
+    def parse_family_key(cls, family, key):
+        """
+        Parses the rest of the type of a counter of the given family, to a date for registered_on and to a
+        (month, value) pair for the other registered families
+        """
+        if family not in cls.REGISTERED_FAMILIES:
+            return key
+
+        date_key, _, value = key.partition(":")
+        registered = date(*[int(part) for part in date_key.split("-")])
+        if family == cls.FAMILY_REGISTERED_ON:
+            return registered
+
+        return registered, value
+
+    @classmethod
+    def get_family_counts(cls, org, family):
+        """
+        Gets the reporters counts of a single family of counters for the given org, by the parsed rest of their
+        type. The total of reporters has no rest so is keyed by an empty string
+        """
+        if family == cls.FAMILY_TOTAL:
+            counters = cls.objects.filter(org=org, type=family)
+        else:
+            counters = cls.objects.filter(org=org, type__startswith="%s:" % family)
+        counter_counts = counters.values("type").order_by("type").annotate(count_sum=Sum("count"))
+
+        return {cls.parse_family_key(family, c["type"][len(family) + 1 :]): c["count_sum"] for c in counter_counts}
+
     class Meta:
-        index_together = ("org", "type")
+        # the pattern operators let the families be read with an index scan on the start of their type
+        indexes = [
+            models.Index(
+                fields=["org", "type"],
+                name="contacts_reporters_org_prefix",
+                opclasses=["int4_ops", "varchar_pattern_ops"],
+            )
+        ]
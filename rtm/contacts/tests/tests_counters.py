@@ -0,0 +1,166 @@
+import random
+import uuid
+from collections import defaultdict
+from datetime import date, datetime
+
+from django_redis import get_redis_connection
+
+from django.core.cache import cache
+from django.db import connection
+from django.test import TransactionTestCase
+from django.utils import timezone
+
+from rtm.contacts.models import Contact, ReportersCounter
+from rtm.test import RTMTestMixin
+from rtm.utils import ORG_CONTACT_COUNT_KEY, get_org_contacts_counts
+
+
+class ReportersCounterSquashTestMixin(RTMTestMixin):
+    def setUp(self):
+        get_redis_connection().delete(ReportersCounter.LAST_SQUASHED_ID_KEY)
+
+    def tearDown(self):
+        get_redis_connection().delete(ReportersCounter.LAST_SQUASHED_ID_KEY)
+
+    @staticmethod
+    def add_counters(orgs, num_types, num_rows, seed=0):
+        """
+        Adds the same random rows of counters to each of the given orgs
+        """
+        rand = random.Random(seed)
+        rows = [("gender:%d" % rand.randrange(num_types), rand.choice((1, 1, 1, -1))) for i in range(num_rows)]
+        ReportersCounter.objects.bulk_create(
+            [ReportersCounter(org=org, type=counter_type, count=count) for org in orgs for counter_type, count in rows]
+        )
+
+    @staticmethod
+    def squash_with_function(org):
+        """
+        Squashes the counters of the org one by one with the SQL function used before the set based squash
+        """
+        counter_types = ReportersCounter.objects.filter(org=org).values_list("type", flat=True).distinct()
+        for counter_type in counter_types:
+            with connection.cursor() as c:
+                c.execute("SELECT ureport_squash_reporterscounters(%s, %s);", (org.pk, counter_type))
+
+    @staticmethod
+    def get_rows(org):
+        return sorted(ReportersCounter.objects.filter(org=org).values_list("type", "count"))
+
+
+class ReportersCounterSquashTest(ReportersCounterSquashTestMixin, TransactionTestCase):
+    def test_squash_matches_function(self):
+        org, expected_org = self.create_org(), self.create_org()
+
+        # the first squash takes the counters with more than one row
+        self.add_counters([org, expected_org], 20, 300)
+        ReportersCounter.objects.create(org=org, type="total-reporters", count=1)
+        ReportersCounter.objects.create(org=expected_org, type="total-reporters", count=1)
+
+        ReportersCounter.squash_counts()
+        self.squash_with_function(expected_org)
+
+        self.assertEqual(self.get_rows(org), self.get_rows(expected_org))
+        counter_types = [counter_type for counter_type, count in self.get_rows(org)]
+        self.assertEqual(len(counter_types), len(set(counter_types)))
+        self.assertEqual(ReportersCounter.get_counts(org), ReportersCounter.get_counts(expected_org))
+
+        # later squashes only take the counters with new rows, negative sums are floored at zero like before
+        self.add_counters([org, expected_org], 30, 200, seed=1)
+        ReportersCounter.objects.create(org=org, type="occupation:student", count=-1)
+        ReportersCounter.objects.create(org=expected_org, type="occupation:student", count=-1)
+
+        ReportersCounter.squash_counts()
+        self.squash_with_function(expected_org)
+
+        self.assertEqual(self.get_rows(org), self.get_rows(expected_org))
+        self.assertEqual(ReportersCounter.get_counts(org)["occupation:student"], 0)
+
+
+class ReportersCounterTriggersTest(RTMTestMixin, TransactionTestCase):
+    @staticmethod
+    def generate_expected(org):
+        counters = defaultdict(int)
+        for contact in Contact.objects.filter(org=org):
+            for counter_type, count in contact.generate_counters().items():
+                counters[counter_type] += count
+        return dict(counters)
+
+    @staticmethod
+    def get_counts(org):
+        return {counter_type: count for counter_type, count in ReportersCounter.get_counts(org).items() if count}
+
+    def test_statement_triggers(self):
+        org = self.create_org()
+
+        contacts = [
+            Contact(
+                org=org,
+                uuid=str(uuid.uuid4()),
+                gender=("M", "F", "O")[i % 3],
+                born=1980 + i % 25,
+                occupation=("Student", "Teacher")[i % 2],
+                registered_on=datetime(2019, 1 + i % 12, 1 + i % 28, i % 24, tzinfo=timezone.utc),
+                state=("R-LAGOS", "R-OYO")[i % 2],
+                district="R-IKEJA",
+                ward="R-WARD-%d" % (i % 4),
+            )
+            for i in range(200)
+        ]
+        Contact.objects.bulk_create(contacts)
+
+        # the bulk insert added a single row per counter
+        expected = self.generate_expected(org)
+        self.assertEqual(self.get_counts(org), expected)
+        self.assertEqual(ReportersCounter.objects.filter(org=org).count(), len(expected))
+
+        # bulk changes of values, of registration dates along with values, and deactivations
+        Contact.objects.filter(org=org, born__lt=1990).update(state="R-ABUJA", gender="F")
+        Contact.objects.filter(org=org, gender="M").update(
+            registered_on=datetime(2020, 2, 1, tzinfo=timezone.utc), born=2001, state="R-KANO"
+        )
+        Contact.objects.filter(org=org, occupation="Teacher", born__gt=2000).update(is_active=False)
+        self.assertEqual(self.get_counts(org), self.generate_expected(org))
+
+        Contact.objects.filter(org=org, ward="R-WARD-1").delete()
+        self.assertEqual(self.get_counts(org), self.generate_expected(org))
+
+
+class ReportersCounterFamiliesTest(RTMTestMixin, TransactionTestCase):
+    def test_family_counts(self):
+        org = self.create_org()
+        other_org = self.create_org()
+
+        for counter_type, count in (
+            ("total-reporters", 3),
+            ("total-reporters", -1),
+            ("gender:f", 2),
+            ("registered_on:2019-03-02", 1),
+            ("registered_on:2019-03-02", 1),
+            ("registered_gender:2019-03-01:f", 2),
+            ("registered_state:2019-03-01:R-LAGOS", 2),
+            ("state:R-LAGOS", 2),
+        ):
+            ReportersCounter.objects.create(org=org, type=counter_type, count=count)
+        ReportersCounter.objects.create(org=other_org, type="registered_on:2019-03-02", count=5)
+
+        self.assertEqual(ReportersCounter.get_family_counts(org, ReportersCounter.FAMILY_TOTAL), {"": 2})
+        self.assertEqual(ReportersCounter.get_family_counts(org, ReportersCounter.FAMILY_GENDER), {"f": 2})
+        self.assertEqual(
+            ReportersCounter.get_family_counts(org, ReportersCounter.FAMILY_REGISTERED_ON), {date(2019, 3, 2): 2}
+        )
+        self.assertEqual(
+            ReportersCounter.get_family_counts(org, ReportersCounter.FAMILY_REGISTERED_STATE),
+            {(date(2019, 3, 1), "R-LAGOS"): 2},
+        )
+        self.assertEqual(ReportersCounter.get_family_counts(org, ReportersCounter.FAMILY_STATE), {"R-LAGOS": 2})
+        self.assertEqual(ReportersCounter.get_family_counts(org, ReportersCounter.FAMILY_WARD), {})
+
+        # each family is cached on its own
+        for family in (ReportersCounter.FAMILY_GENDER, ReportersCounter.FAMILY_STATE):
+            cache.delete(ORG_CONTACT_COUNT_KEY % (org.pk, family))
+        self.assertEqual(get_org_contacts_counts(org, ReportersCounter.FAMILY_GENDER), {"f": 2})
+        ReportersCounter.objects.create(org=org, type="gender:f", count=1)
+        ReportersCounter.objects.create(org=org, type="state:R-LAGOS", count=1)
+        self.assertEqual(get_org_contacts_counts(org, ReportersCounter.FAMILY_GENDER), {"f": 2})
+        self.assertEqual(get_org_contacts_counts(org, ReportersCounter.FAMILY_STATE), {"R-LAGOS": 3})
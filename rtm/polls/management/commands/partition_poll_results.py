@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from dash.orgs.models import Org
+
+from django.core.management.base import BaseCommand
+
+from rtm.polls.partitions import create_org_partition, is_poll_results_partitioned, partition_poll_results
+
+
+class Command(BaseCommand):
+    help = (
+        "Partitions the poll results table by org, then creates the partitions of the orgs that do not have one yet. "
+        "The first run locks the poll results for the whole copy, later runs only move the results of new orgs out "
+        "of the default partition."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--check", action="store_true", help="Only report whether the table is partitioned")
+
+    def handle(self, *args, **options):
+        if options["check"]:
+            partitioned = is_poll_results_partitioned()
+            self.stdout.write("Poll results are %spartitioned by org" % ("" if partitioned else "not "))
+            return
+
+        org_ids = list(Org.objects.order_by("pk").values_list("pk", flat=True))
+
+        if partition_poll_results(org_ids):
+            self.stdout.write("Partitioned the poll results of %d orgs" % len(org_ids))
+
+        created = [org_id for org_id in org_ids if create_org_partition(org_id)]
+        self.stdout.write("Created the poll results partitions of %d new orgs" % len(created))
@@ -0,0 +1,12 @@
+from django.db import migrations
+
+from rtm.sql import InstallSQL
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("polls", "0063_auto_20200227_1624"),
+    ]
+
+    operations = [InstallSQL("polls_0064")]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from django.db import migrations
+
+# keep only the newest result of every contact for each question of a flow, the one the sync would have kept
+# language=SQL
+DELETE_DUPLICATE_POLL_RESULTS_SQL = """
+DELETE FROM polls_pollresult
+WHERE id IN (
+    SELECT id FROM (
+        SELECT id, row_number() OVER (
+            PARTITION BY org_id, flow, contact, ruleset ORDER BY date DESC NULLS LAST, id DESC
+        ) AS position
+        FROM polls_pollresult
+    ) AS results
+    WHERE results.position > 1
+)
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("polls", "0064_install_contact_activities_skip")]
+
+    operations = [
+        migrations.RunSQL(DELETE_DUPLICATE_POLL_RESULTS_SQL, migrations.RunSQL.noop),
+        migrations.AlterUniqueTogether(name="pollresult", unique_together={("org", "flow", "contact", "ruleset")}),
+    ]
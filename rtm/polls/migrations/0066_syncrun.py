@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("orgs", "0026_fix_org_config_rapidpro"), ("polls", "0065_pollresult_unique_key")]
+
+    operations = [
+        migrations.CreateModel(
+            name="SyncRun",
+            fields=[
+                ("id", models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("source", models.CharField(choices=[("A", "API"), ("R", "Archive")], max_length=1)),
+                ("started_on", models.DateTimeField(default=django.utils.timezone.now)),
+                ("ended_on", models.DateTimeField(null=True)),
+                ("duration", models.FloatField(default=0, help_text="Total time of the sync, in seconds")),
+                (
+                    "api_wait_time",
+                    models.FloatField(default=0, help_text="Time waiting for runs from the API, in seconds"),
+                ),
+                ("diff_time", models.FloatField(default=0, help_text="Time diffing the runs, in seconds")),
+                ("db_write_time", models.FloatField(default=0, help_text="Time writing the results, in seconds")),
+                ("num_fetches", models.IntegerField(default=0)),
+                ("num_runs", models.IntegerField(default=0)),
+                ("num_created", models.IntegerField(default=0)),
+                ("num_updated", models.IntegerField(default=0)),
+                ("num_ignored", models.IntegerField(default=0)),
+                (
+                    "pause_reason",
+                    models.CharField(
+                        choices=[("M", "Max runs"), ("L", "Lock expiry"), ("R", "Rate limit")], max_length=1, null=True
+                    ),
+                ),
+                (
+                    "peak_memory",
+                    models.BigIntegerField(help_text="Peak resident memory of the worker, in kilobytes", null=True),
+                ),
+                (
+                    "org",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.PROTECT, related_name="sync_runs", to="orgs.Org"
+                    ),
+                ),
+                (
+                    "poll",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE, related_name="sync_runs", to="polls.Poll"
+                    ),
+                ),
+            ],
+            options={"index_together": {("org", "started_on"), ("started_on", "duration")}},
+        ),
+    ]
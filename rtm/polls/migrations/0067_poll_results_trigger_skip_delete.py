@@ -0,0 +1,12 @@
+from django.db import migrations
+
+from rtm.sql import InstallSQL
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("polls", "0066_syncrun"),
+    ]
+
+    operations = [InstallSQL("polls_0067")]
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from django.db import migrations, models
+
+# splits the type of the existing counters, ruleset:<ruleset>:<counter>, into their kind, category and value.
+# The greedy category match keeps the last segment of a category containing colons as the segment counted, like
+# the counters were read
+# language=SQL
+POPULATE_COUNTERS_KIND_SQL = """
+UPDATE polls_pollresultscounter SET
+    kind = CASE
+        WHEN counter = 'total-ruleset-polled' THEN 'polled'
+        WHEN counter = 'total-ruleset-responded' THEN 'responded'
+        WHEN segment IS NOT NULL THEN segment[2]
+        ELSE 'category'
+    END,
+    category = CASE
+        WHEN counter LIKE 'category:%' THEN COALESCE(segment[1], substr(counter, 10))
+        ELSE ''
+    END,
+    value = COALESCE(segment[3], '')
+FROM (
+    SELECT id, counter, regexp_match(
+        counter, '^(?:nocategory|category:(.*)):(born|gender|state|district|ward):([^:]*)$'
+    ) AS segment
+    FROM (SELECT id, substr(type, length(ruleset) + 10) AS counter FROM polls_pollresultscounter) counters
+) parsed
+WHERE polls_pollresultscounter.id = parsed.id
+"""
+
+# the squash of a single counter by type, not used anymore
+# language=SQL
+DROP_SQUASH_FUNCTION_SQL = """
+DROP FUNCTION IF EXISTS ureport_squash_resultscounters(_org_id INT, _ruleset CHAR(36), _type VARCHAR)
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("polls", "0067_poll_results_trigger_skip_delete")]
+
+    operations = [
+        migrations.AddField(
+            model_name="pollresultscounter",
+            name="kind",
+            field=models.CharField(
+                choices=[
+                    ("polled", "Polled"),
+                    ("responded", "Responded"),
+                    ("category", "Category"),
+                    ("born", "Born"),
+                    ("gender", "Gender"),
+                    ("state", "State"),
+                    ("district", "District"),
+                    ("ward", "Ward"),
+                ],
+                default="",
+                max_length=16,
+            ),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name="pollresultscounter",
+            name="category",
+            field=models.CharField(
+                default="", help_text="The lowercase category counted, empty for no category", max_length=255
+            ),
+        ),
+        migrations.AddField(
+            model_name="pollresultscounter",
+            name="value",
+            field=models.CharField(
+                default="", help_text="The value of the segment counted, empty for the totals", max_length=255
+            ),
+        ),
+        migrations.RunSQL(POPULATE_COUNTERS_KIND_SQL, migrations.RunSQL.noop),
+        migrations.AlterIndexTogether(name="pollresultscounter", index_together={("org", "ruleset", "kind")}),
+        migrations.RemoveField(model_name="pollresultscounter", name="type"),
+        migrations.RunSQL(DROP_SQUASH_FUNCTION_SQL, migrations.RunSQL.noop),
+    ]
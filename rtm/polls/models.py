@@ -19,7 +19,7 @@ from xlrd import XLRDError
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.cache import cache
-from django.db import connection, models
+from django.db import connection, models, transaction
 from django.db.models import Count, Sum
 from django.utils import timezone
 from django.utils.text import slugify
@@ -38,6 +38,9 @@ BRICK_POLLS_CACHE_TIME = getattr(settings, "BRICK_POLLS_CACHE_TIME", 60 * 60 * 3
 
 POLL_RESULTS_CACHE_TIME = getattr(settings, "POLL_RESULTS_CACHE_TIME", 60 * 60 * 24)
 
+# syncs add the changes of the results they write to the counters instead of rebuilding them from all the results
+POLL_RESULTS_INCREMENTAL_COUNTS = getattr(settings, "POLL_RESULTS_INCREMENTAL_COUNTS", True)
+
 # big cache time for task cached data, we run more often the task to update the data
 UREPORT_ASYNC_FETCHED_DATA_CACHE_TIME = getattr(settings, "UREPORT_ASYNC_FETCHED_DATA_CACHE_TIME", 60 * 60 * 24 * 15)
 
@@ -60,6 +63,142 @@ CACHE_ORG_REGISTRATION_DATA_KEY = "org:%d:registration:%s"
 
 CACHE_ORG_OCCUPATION_DATA_KEY = "org:%d:occupation:%s"
 
+# the poll results of a flow normalized like PollResult.generate_counters and generate_poll_stats do
+POLL_RESULTS_NORMALIZED_SQL = """
+WITH results AS (
+    SELECT
+        org_id,
+        ruleset,
+        lower(ruleset) AS ruleset_key,
+        CASE
+            WHEN category <> '' AND lower(category) <> ALL(%(ignored)s) THEN lower(category) ELSE ''
+        END AS category,
+        COALESCE(
+            category IS NOT NULL AND lower(category) <> ALL(%(ignored)s)
+            AND (category <> '' OR (text <> '' AND text <> 'None')),
+            FALSE
+        ) AS responded,
+        COALESCE(upper(state), '') AS state,
+        COALESCE(upper(district), '') AS district,
+        COALESCE(upper(ward), '') AS ward,
+        CASE WHEN born <> 0 THEN born::text ELSE '' END AS born,
+        COALESCE(lower(gender), '') AS gender,
+        date
+    FROM polls_pollresult
+    WHERE org_id = %(org_id)s AND flow = %(flow)s AND flow <> '' AND ruleset <> ''
+)
+"""
+
+# aggregates the results of a flow once in a temporary table, grouped by everything the counters and the stats of
+# any of the polls of the flow depend on, so that they are all counted from it rather than from the results
+CREATE_FLOW_RESULTS_COUNTS_SQL = (
+    "CREATE TEMPORARY TABLE flow_results_counts ON COMMIT DROP AS "
+    + POLL_RESULTS_NORMALIZED_SQL
+    + """
+SELECT
+    org_id, ruleset, ruleset_key, category, responded, state, district, ward, born, gender,
+    date_trunc('day', date AT TIME ZONE 'UTC') AT TIME ZONE 'UTC' AS date,
+    COUNT(*) AS count
+FROM results
+GROUP BY org_id, ruleset, ruleset_key, category, responded, state, district, ward, born, gender, 11
+"""
+)
+
+# the counters of the rulesets of a flow to be replaced, those of its questions and those with results
+DELETE_FLOW_RESULTS_COUNTERS_SQL = """
+DELETE FROM polls_pollresultscounter
+WHERE org_id = %(org_id)s AND (
+    ruleset = ANY(%(rulesets)s) OR ruleset IN (SELECT DISTINCT ruleset FROM flow_results_counts)
+)
+"""
+
+# the counters of PollResult.generate_counters, counted over all the results of the flow, with the kinds of
+# PollResultsCounter
+INSERT_POLL_RESULTS_COUNTERS_SQL = """
+INSERT INTO polls_pollresultscounter (org_id, ruleset, kind, category, value, count)
+SELECT counted.org_id, counted.ruleset, counters.kind, counters.category, counters.value, SUM(counted.count)
+FROM flow_results_counts counted
+CROSS JOIN LATERAL (
+    VALUES
+        ('polled', '', ''),
+        (CASE WHEN counted.responded THEN 'responded' END, '', ''),
+        (CASE WHEN counted.category <> '' THEN 'category' END, counted.category, ''),
+        (CASE WHEN counted.born <> '' THEN 'born' END, counted.category, counted.born),
+        (CASE WHEN counted.gender <> '' THEN 'gender' END, counted.category, counted.gender),
+        (CASE WHEN counted.state <> '' THEN 'state' END, counted.category, counted.state),
+        (CASE WHEN counted.district <> '' THEN 'district' END, counted.category, counted.district),
+        (CASE WHEN counted.ward <> '' THEN 'ward' END, counted.category, counted.ward)
+) AS counters (kind, category, value)
+WHERE counters.kind IS NOT NULL
+GROUP BY counted.org_id, counted.ruleset, counters.kind, counters.category, counters.value
+"""
+
+# the stats of PollResult.generate_poll_stats projected on the questions of a poll of the flow, one row per
+# distinct stat like Poll.build_poll_stats
+INSERT_POLL_STATS_SQL = """
+INSERT INTO stats_pollstats (
+    org_id, question_id, category_id, age_segment_id, gender_segment_id, location_id, date, count
+)
+SELECT
+    stats.org_id,
+    questions.id,
+    (
+        SELECT MAX(c.id) FROM polls_pollresponsecategory c
+        WHERE c.question_id = questions.id AND lower(c.category) = stats.category
+    ),
+    CASE WHEN stats.born <> '' THEN (
+        SELECT MAX(a.id) FROM stats_agesegment a WHERE a.min_age = (
+            SELECT MAX(min_age) FROM unnest(%(min_ages)s::int[]) min_age
+            WHERE min_age <= GREATEST(%(poll_year)s - stats.born::int, 0)
+        )
+    ) END,
+    CASE WHEN stats.gender <> '' THEN (
+        SELECT MAX(g.id) FROM stats_gendersegment g WHERE lower(g.gender) = stats.gender
+    ) END,
+    (
+        SELECT MAX(b.id) FROM locations_boundary b
+        WHERE b.org_id = stats.org_id AND upper(b.osm_id) = COALESCE(
+            NULLIF(stats.ward, ''), NULLIF(stats.district, ''), NULLIF(stats.state, '')
+        )
+    ),
+    stats.date,
+    stats.count
+FROM (
+    SELECT org_id, ruleset_key, category, born, gender, state, district, ward, date, SUM(count) AS count
+    FROM flow_results_counts
+    GROUP BY org_id, ruleset_key, category, born, gender, state, district, ward, date
+) stats
+JOIN (
+    SELECT ruleset_uuid, MAX(id) AS id FROM polls_pollquestion WHERE poll_id = %(poll_id)s GROUP BY ruleset_uuid
+) questions ON questions.ruleset_uuid = stats.ruleset_key
+"""
+
+# replaces the rows of each counter with a single one holding their sum, in one statement so readers never see
+# a partial sum
+SQUASH_POLL_RESULTS_COUNTERS_SQL = """
+WITH removed AS (
+    DELETE FROM polls_pollresultscounter WHERE org_id = %s AND ruleset = ANY(%s)
+    RETURNING org_id, ruleset, kind, category, value, count
+)
+INSERT INTO polls_pollresultscounter (org_id, ruleset, kind, category, value, count)
+SELECT org_id, ruleset, kind, category, value, SUM(count) FROM removed
+GROUP BY org_id, ruleset, kind, category, value HAVING SUM(count) <> 0
+"""
+
+SQUASH_POLL_STATS_SQL = """
+WITH removed AS (
+    DELETE FROM stats_pollstats WHERE org_id = %s AND question_id = ANY(%s)
+    RETURNING org_id, question_id, category_id, age_segment_id, gender_segment_id, location_id, date, count
+)
+INSERT INTO stats_pollstats (
+    org_id, question_id, category_id, age_segment_id, gender_segment_id, location_id, date, count
+)
+SELECT org_id, question_id, category_id, age_segment_id, gender_segment_id, location_id, date, SUM(count)
+FROM removed
+GROUP BY org_id, question_id, category_id, age_segment_id, gender_segment_id, location_id, date
+HAVING SUM(count) <> 0
+"""
+
 
 @six.python_2_unicode_compatible
 class PollCategory(SmartModel):
@@ -97,6 +236,8 @@ class Poll(SmartModel):
 
     POLL_RESULTS_LAST_PULL_CURSOR = "last:poll_pull_results_cursor:org:%d:poll:%s"
 
+    POLL_RESULTS_PAUSED_UNTIL_CACHE_KEY = "last:poll_pull_results_paused_until:org:%d:poll:%s"
+
     POLL_RESULTS_LAST_OTHER_POLLS_SYNCED_CACHE_KEY = "last:poll_last_other_polls_sync:org:%d:poll:%s"
 
     POLL_RESULTS_LAST_OTHER_POLLS_SYNCED_CACHE_TIMEOUT = 60 * 60 * 24 * 2
@@ -178,9 +319,34 @@ class Poll(SmartModel):
 
     @classmethod
     def pull_results_from_archives(cls, poll_id):
+        from celery import chord
+        from rtm.polls.tasks import pull_refresh_from_archive, pull_refresh_from_archives_completed
+
+        poll = Poll.objects.get(pk=poll_id)
+        backend = poll.org.get_backend(backend_slug=poll.backend.slug)
+
+        archives = backend.get_poll_archives(poll)
+        if not archives:
+            return Poll.complete_pull_results_from_archives([], poll_id)
+
+        # process every archive on its own worker and rebuild the counts once they are all done
+        chord(pull_refresh_from_archive.s(poll_id, archive_json).set(queue="sync") for archive_json in archives)(
+            pull_refresh_from_archives_completed.s(poll_id).set(queue="sync")
+        )
+
+    @classmethod
+    def pull_results_from_archive(cls, poll_id, archive_json):
         poll = Poll.objects.get(pk=poll_id)
         backend = poll.org.get_backend(backend_slug=poll.backend.slug)
 
+        return backend.pull_results_from_archive(poll, archive_json)
+
+    @classmethod
+    def complete_pull_results_from_archives(cls, archives_results, poll_id):
+        poll = Poll.objects.get(pk=poll_id)
+
+        # sum the counts of all the archives, tuples come back from the chord as lists
+        totals = [sum(counts) for counts in zip(*archives_results)] or [0] * 6
         (
             num_val_created,
             num_val_updated,
@@ -188,10 +354,10 @@ class Poll(SmartModel):
             num_path_created,
             num_path_updated,
             num_path_ignored,
-        ) = backend.pull_results_from_archives(poll)
+        ) = totals
 
         if num_val_created + num_val_updated + num_path_created + num_path_updated != 0:
-            poll.rebuild_poll_results_counts()
+            poll.update_poll_results_counts()
 
         Poll.objects.filter(org=poll.org_id, flow_uuid=poll.flow_uuid).update(has_synced=True)
 
@@ -212,7 +378,7 @@ class Poll(SmartModel):
         ) = backend.pull_results(poll, None, None)
 
         if num_val_created + num_val_updated + num_path_created + num_path_updated != 0:
-            poll.rebuild_poll_results_counts()
+            poll.update_poll_results_counts()
 
         Poll.objects.filter(org=poll.org_id, flow_uuid=poll.flow_uuid).update(has_synced=True)
 
@@ -235,50 +401,37 @@ class Poll(SmartModel):
         return after, before, latest_synced_obj_time, batches_latest, resume_cursor, pull_after_delete
 
     def delete_poll_stats(self):
-        from rtm.utils import chunk_list
         from rtm.stats.models import PollStats
 
         question_ids = self.questions.all().values_list("id", flat=True)
 
-        poll_stats_ids = PollStats.objects.filter(org_id=self.org_id, question_id__in=question_ids)
-        poll_stats_ids = poll_stats_ids.values_list("pk", flat=True)
-
-        poll_stats_ids_count = len(poll_stats_ids)
-
-        for batch in chunk_list(poll_stats_ids, 1000):
-            PollStats.objects.filter(pk__in=batch).delete()
+        # a single set based delete, nothing cascades from the poll stats
+        poll_stats_ids_count, _ = PollStats.objects.filter(org_id=self.org_id, question_id__in=question_ids).delete()
 
         logger.info("Deleted %d poll stats for poll #%d on org #%d" % (poll_stats_ids_count, self.pk, self.org_id))
 
     def delete_poll_results_counter(self):
-        from rtm.utils import chunk_list
-
         rulesets = self.questions.all().values_list("ruleset_uuid", flat=True)
 
-        counters_ids = PollResultsCounter.objects.filter(org_id=self.org_id, ruleset__in=rulesets)
-        counters_ids = counters_ids.values_list("pk", flat=True)
-
-        counters_ids_count = len(counters_ids)
-
-        for batch in chunk_list(counters_ids, 1000):
-            PollResultsCounter.objects.filter(pk__in=batch).delete()
+        counters = PollResultsCounter.objects.filter(org_id=self.org_id, ruleset__in=rulesets)
+        counters_ids_count, _ = counters.delete()
 
         logger.info(
             "Deleted %d poll results counters for poll #%d on org #%d" % (counters_ids_count, self.pk, self.org_id)
         )
 
     def delete_poll_results(self):
-        from rtm.utils import chunk_list
-
-        results_ids = PollResult.objects.filter(org_id=self.org_id, flow=self.flow_uuid).values_list("pk", flat=True)
-
-        results_ids_count = len(results_ids)
+        from rtm.polls.purge import purge_flow_results
 
-        for batch in chunk_list(results_ids, 1000):
-            PollResult.objects.filter(pk__in=batch).delete()
+        results_ids_count = purge_flow_results(self.org_id, self.flow_uuid)
 
         logger.info("Deleted %d poll results for poll #%d on org #%d" % (results_ids_count, self.pk, self.org_id))
 
+        # the results are pulled again from scratch, their counts will be added back as they are written
+        for poll in self.get_flow_polls():
+            poll.delete_poll_results_counter()
+            poll.delete_poll_stats()
+
         cache.delete(Poll.POLL_PULL_ALL_RESULTS_AFTER_DELETE_FLAG % (self.org_id, self.pk))
         cache.delete(Poll.POLL_RESULTS_CURSOR_AFTER_CACHE_KEY % (self.org.pk, self.flow_uuid))
         cache.delete(Poll.POLL_RESULTS_CURSOR_BEFORE_CACHE_KEY % (self.org.pk, self.flow_uuid))
@@ -312,144 +465,219 @@ class Poll(SmartModel):
 
         Poll.pull_poll_results_task(self)
 
-    def rebuild_poll_results_counts(self):
-        from rtm.utils import chunk_list
-        from rtm.stats.models import PollStats, AgeSegment, GenderSegment
+    def get_poll_stats_lookups(self):
+        """
+        Gets the ids of the questions, categories, segments and locations the poll stats of this poll refer to
+        """
+        from rtm.stats.models import AgeSegment, GenderSegment
         from rtm.locations.models import Boundary
+
+        questions_dict = dict()
+        for qsn in self.questions.all().prefetch_related("response_categories"):
+            categories = qsn.response_categories.all()
+            categoryies_dict = {elt.category.lower(): elt.id for elt in categories}
+            questions_dict[qsn.ruleset_uuid] = dict(id=qsn.id, categories=categoryies_dict)
+
+        return dict(
+            questions=questions_dict,
+            genders={elt.gender.lower(): elt.id for elt in GenderSegment.objects.all()},
+            ages={elt.min_age: elt.id for elt in AgeSegment.objects.all()},
+            locations={elt.osm_id.upper(): elt.id for elt in Boundary.objects.filter(org_id=self.org_id)},
+        )
+
+    def build_poll_stats(self, stats_dict, lookups):
+        """
+        Builds the poll stats objects for the counts of the given stat tuples, as generated by the poll results
+        """
+        from rtm.stats.models import PollStats, AgeSegment
+
+        poll_year = self.poll_date.year
+        questions_dict = lookups["questions"]
+        gender_dict = lookups["genders"]
+        age_dict = lookups["ages"]
+        location_dict = lookups["locations"]
+
+        poll_stats_obj_to_insert = []
+        for stat_tuple in stats_dict.keys():
+            org_id, ruleset, category, born, gender, state, district, ward, date = stat_tuple
+            count = stats_dict.get(stat_tuple)
+            stat_kwargs = dict(org_id=org_id, count=count, date=date)
+
+            if ruleset not in questions_dict:
+                continue
+
+            question_id = questions_dict[ruleset].get("id")
+            if not question_id:
+                continue
+
+            category_id = questions_dict[ruleset].get("categories", dict()).get(category)
+
+            gender_id = None
+            if gender:
+                gender_id = gender_dict.get(gender, gender_dict.get("O"))
+
+            age_id = None
+            if born:
+                age_id = age_dict.get(AgeSegment.get_age_segment_min_age(max(poll_year - int(born), 0)))
+
+            location_id = None
+            if ward:
+                location_id = location_dict.get(ward)
+            elif district:
+                location_id = location_dict.get(district)
+            elif state:
+                location_id = location_dict.get(state)
+
+            if question_id:
+                stat_kwargs["question_id"] = question_id
+            if category_id:
+                stat_kwargs["category_id"] = category_id
+            if age_id:
+                stat_kwargs["age_segment_id"] = age_id
+            if gender_id:
+                stat_kwargs["gender_segment_id"] = gender_id
+            if location_id:
+                stat_kwargs["location_id"] = location_id
+
+            poll_stats_obj_to_insert.append(PollStats(**stat_kwargs))
+
+        return poll_stats_obj_to_insert
+
+    def apply_poll_results_counts_delta(self, counters_dict, stats_dict, lookups=None):
+        """
+        Adds the changes to the counters and poll stats of the given results as additive rows, the readers sum
+        all the rows of a counter so they are squashed later on
+        """
+        from rtm.stats.models import PollStats
+
+        if lookups is None:
+            lookups = self.get_poll_stats_lookups()
+
+        counters_to_insert = [
+            PollResultsCounter(org_id=org_id, ruleset=ruleset, kind=kind, category=category, value=value, count=count)
+            for (org_id, ruleset, (kind, category, value)), count in counters_dict.items()
+            if count
+        ]
+        stats_to_insert = self.build_poll_stats({key: count for key, count in stats_dict.items() if count}, lookups)
+
+        PollResultsCounter.objects.bulk_create(counters_to_insert)
+        PollStats.objects.bulk_create(stats_to_insert)
+
+    def squash_poll_results_counts(self):
+        """
+        Squashes the rows of every counter and poll stat of the flow of this poll into one, dropping the ones
+        summing to zero
+        """
+        questions = PollQuestion.objects.filter(poll__in=self.get_flow_polls())
+        rulesets = list(questions.values_list("ruleset_uuid", flat=True).distinct())
+        question_ids = list(questions.values_list("id", flat=True))
+
+        with connection.cursor() as cursor:
+            cursor.execute(SQUASH_POLL_RESULTS_COUNTERS_SQL, [self.org_id, rulesets])
+            cursor.execute(SQUASH_POLL_STATS_SQL, [self.org_id, question_ids])
+
+    def update_poll_results_counts(self):
+        """
+        Brings the counters of this poll up to date after a sync, squashing the deltas the sync added to them or
+        requesting a rebuild from all the results when incremental counts are disabled
+        """
+        from rtm.polls.rebuilds import request_rebuild
+
+        if not POLL_RESULTS_INCREMENTAL_COUNTS:
+            return request_rebuild(self.org_id, self.flow_uuid)
+
+        self.squash_poll_results_counts()
+        for poll in self.get_flow_polls():
+            poll.update_questions_results_cache()
+
+    def get_poll_results_counts_sql_params(self):
+        from rtm.stats.models import AgeSegment
+
+        return dict(
+            org_id=self.org_id,
+            flow=self.flow_uuid,
+            poll_id=self.pk,
+            poll_year=self.poll_date.year,
+            ignored=PollResponseCategory.IGNORED_CATEGORY_RULES,
+            min_ages=AgeSegment.MIN_AGES,
+        )
+
+    def get_flow_polls(self):
+        """
+        Gets the polls sharing the flow of this poll, this one included, they share its results and counters
+        """
+        return Poll.objects.filter(org_id=self.org_id, flow_uuid=self.flow_uuid).order_by("pk")
+
+    def rebuild_poll_results_counts(self):
+        """
+        Rebuilds the counters and poll stats of the flow of this poll from all of its results, to repair them. The
+        results of the flow are aggregated once in the db, matching PollResult.generate_counters and
+        generate_poll_stats, then the stats are projected on the questions of each poll of the flow
+        """
         import time
+        from rtm.polls.rebuilds import clear_flow_dirty, request_rebuild
+        from rtm.stats.models import PollStats
 
         start = time.time()
 
         poll_id = self.pk
         org_id = self.org_id
         flow = self.flow_uuid
-        poll_year = self.poll_date.year
 
         r = get_redis_connection()
 
         key = Poll.POLL_REBUILD_COUNTS_LOCK % (org_id, flow)
 
         if r.get(key):
-            logger.info("Already rebuilding counts for poll #%d on org #%d" % (poll_id, org_id))
+            # rebuild again once this one is done to pick up whatever changed since it started
+            request_rebuild(org_id, flow)
+            logger.info("Already rebuilding counts for poll #%d on org #%d, requested a follow-up" % (poll_id, org_id))
 
         else:
             with r.lock(key, timeout=Poll.POLL_SYNC_LOCK_TIMEOUT):
-                poll_results_ids = PollResult.objects.filter(org_id=org_id, flow=flow).values_list("pk", flat=True)
-
-                poll_results_ids_count = len(poll_results_ids)
-
-                questions = self.questions.all().prefetch_related("response_categories")
-                questions_dict = dict()
+                # results changed from now on mark the flow dirty again, a flow without questions has nothing to
+                # rebuild so it is not left dirty either
+                clear_flow_dirty(org_id, flow)
 
+                polls = list(self.get_flow_polls())
+                questions = PollQuestion.objects.filter(poll__in=polls)
                 if not questions.exists():
                     return
 
-                for qsn in questions:
-                    categories = qsn.response_categories.all()
-                    categoryies_dict = {elt.category.lower(): elt.id for elt in categories}
-                    questions_dict[qsn.ruleset_uuid] = dict(id=qsn.id, categories=categoryies_dict)
+                rulesets = list(questions.values_list("ruleset_uuid", flat=True).distinct())
+                question_ids = list(questions.values_list("id", flat=True))
 
-                gender_dict = {elt.gender.lower(): elt.id for elt in GenderSegment.objects.all()}
-                age_dict = {elt.min_age: elt.id for elt in AgeSegment.objects.all()}
+                # replace the counters in a single transaction, readers see the old counters until the new ones
+                # are all in and never an empty or partial set, the old rows are reclaimed by vacuum afterwards
+                with transaction.atomic():
+                    with connection.cursor() as cursor:
+                        params = self.get_poll_results_counts_sql_params()
 
-                boundaries = Boundary.objects.filter(org_id=org_id)
-                location_dict = {elt.osm_id.upper(): elt.id for elt in boundaries}
+                        cursor.execute(CREATE_FLOW_RESULTS_COUNTS_SQL, params)
 
-                logger.info("Results query time for pair %s, %s took %ds" % (org_id, flow, time.time() - start))
+                        cursor.execute(DELETE_FLOW_RESULTS_COUNTERS_SQL, dict(org_id=org_id, rulesets=rulesets))
+                        PollStats.objects.filter(org_id=org_id, question_id__in=question_ids).delete()
 
-                logger.info("Results query time for pair %s, %s took %ds" % (org_id, flow, time.time() - start))
+                        cursor.execute(INSERT_POLL_RESULTS_COUNTERS_SQL, params)
+                        num_counters = cursor.rowcount
 
-                processed_results = 0
-                counters_dict = defaultdict(int)
-                stats_dict = defaultdict(int)
-
-                for batch in chunk_list(poll_results_ids, 1000):
-                    poll_results = list(PollResult.objects.filter(pk__in=batch))
-
-                    for result in poll_results:
-                        gen_counters = result.generate_counters()
-                        for dict_key in gen_counters.keys():
-                            counters_dict[(result.org_id, result.ruleset, dict_key)] += gen_counters[dict_key]
-
-                        gen_stats = result.generate_poll_stats()
-                        for dict_key in gen_stats.keys():
-                            stats_dict[dict_key] += gen_stats[dict_key]
-
-                        processed_results += 1
+                        num_stats = 0
+                        for poll in polls:
+                            cursor.execute(INSERT_POLL_STATS_SQL, poll.get_poll_results_counts_sql_params())
+                            num_stats += cursor.rowcount
 
                 logger.info(
-                    "Rebuild counts progress... build counters dict for pair %s, %s, processed %d of %d in %ds"
-                    % (org_id, flow, processed_results, poll_results_ids_count, time.time() - start)
-                )
-
-                counters_to_insert = []
-                for counter_tuple in counters_dict.keys():
-                    org_id, ruleset, counter_type = counter_tuple
-                    count = counters_dict[counter_tuple]
-                    counters_to_insert.append(
-                        PollResultsCounter(org_id=org_id, ruleset=ruleset, type=counter_type, count=count)
-                    )
-
-                poll_stats_obj_to_insert = []
-                for stat_tuple in stats_dict.keys():
-                    org_id, ruleset, category, born, gender, state, district, ward, date = stat_tuple
-                    count = stats_dict.get(stat_tuple)
-                    stat_kwargs = dict(org_id=org_id, count=count, date=date)
-
-                    if ruleset not in questions_dict:
-                        continue
-
-                    question_id = questions_dict[ruleset].get("id")
-                    if not question_id:
-                        continue
-
-                    category_id = questions_dict[ruleset].get("categories", dict()).get(category)
-
-                    gender_id = None
-                    if gender:
-                        gender_id = gender_dict.get(gender, gender_dict.get("O"))
-
-                    age_id = None
-                    if born:
-                        age_id = age_dict.get(AgeSegment.get_age_segment_min_age(max(poll_year - int(born), 0)))
-
-                    location_id = None
-                    if ward:
-                        location_id = location_dict.get(ward)
-                    elif district:
-                        location_id = location_dict.get(district)
-                    elif state:
-                        location_id = location_dict.get(state)
-
-                    if question_id:
-                        stat_kwargs["question_id"] = question_id
-                    if category_id:
-                        stat_kwargs["category_id"] = category_id
-                    if age_id:
-                        stat_kwargs["age_segment_id"] = age_id
-                    if gender_id:
-                        stat_kwargs["gender_segment_id"] = gender_id
-                    if location_id:
-                        stat_kwargs["location_id"] = location_id
-
-                    poll_stats_obj_to_insert.append(PollStats(**stat_kwargs))
-
-                # Delete existing counters and then create new counters
-                self.delete_poll_results_counter()
-                self.delete_poll_stats()
-
-                PollStats.objects.bulk_create(poll_stats_obj_to_insert)
-                PollResultsCounter.objects.bulk_create(counters_to_insert)
-                logger.info(
-                    "Finished Rebuilding the counters for poll #%d on org #%d in %ds, inserted %d counters objects for %s results"
-                    % (poll_id, org_id, time.time() - start, len(counters_to_insert), poll_results_ids_count)
+                    "Finished Rebuilding the counters for %d polls of poll #%d flow on org #%d in %ds, inserted %d "
+                    "counters and %d stats"
+                    % (len(polls), poll_id, org_id, time.time() - start, num_counters, num_stats)
                 )
 
                 start_update_cache = time.time()
-                self.update_questions_results_cache()
+                for poll in polls:
+                    poll.update_questions_results_cache()
                 logger.info(
-                    "Calculated questions results and updated the cache for poll #%d on org #%d in %ds"
-                    % (poll_id, org_id, time.time() - start_update_cache)
+                    "Calculated questions results and updated the cache for %d polls of poll #%d flow on org #%d "
+                    "in %ds" % (len(polls), poll_id, org_id, time.time() - start_update_cache)
                 )
 
                 logger.info(
@@ -984,7 +1212,6 @@ class PollQuestion(SmartModel):
             categories_label = (
                 self.response_categories.filter(is_active=True).order_by("pk").values_list("category", flat=True)
             )
-            question_results = self.get_question_results()
 
             if segment:
 
@@ -995,22 +1222,17 @@ class PollQuestion(SmartModel):
                 if location_part in ["state", "district", "ward"]:
 
                     location_boundaries = org.get_segment_org_boundaries(segment)
+                    question_results = self.get_question_results([location_part])
 
                     for boundary in location_boundaries:
                         categories = []
                         osm_id = boundary.get("osm_id").upper()
                         set_count = 0
-                        unset_count_key = "ruleset:%s:nocategory:%s:%s" % (self.ruleset_uuid, location_part, osm_id)
-                        unset_count = question_results.get(unset_count_key, 0)
+                        unset_count = question_results.get((location_part, "", osm_id), 0)
 
                         for categorie_label in categories_label:
                             if categorie_label.lower() not in PollResponseCategory.IGNORED_CATEGORY_RULES:
-                                category_count_key = "ruleset:%s:category:%s:%s:%s" % (
-                                    self.ruleset_uuid,
-                                    categorie_label.lower(),
-                                    location_part,
-                                    osm_id,
-                                )
+                                category_count_key = (location_part, categorie_label.lower(), osm_id)
                                 category_count = question_results.get(category_count_key, 0)
                                 set_count += category_count
                                 categories.append(dict(count=category_count, label=categorie_label))
@@ -1028,7 +1250,7 @@ class PollQuestion(SmartModel):
                 elif age_part:
                     poll_year = self.poll.poll_date.year
 
-                    born_results = {k: v for k, v in question_results.items() if k[-9:-5] == "born"}
+                    born_results = self.get_question_results([PollResultsCounter.KIND_BORN])
 
                     age_intervals = dict()
                     age_intervals["35+"] = (35, 2000)
@@ -1047,18 +1269,16 @@ class PollQuestion(SmartModel):
                             if categorie_label.lower() not in PollResponseCategory.IGNORED_CATEGORY_RULES:
                                 categories_count[categorie_label] = 0
 
-                        for result_key, result_count in born_results.items():
-                            age = poll_year - int(result_key[-4:])
+                        for (_kind, category, born), result_count in born_results.items():
+                            age = poll_year - int(born)
 
                             if lower_bound <= age < upper_bound:
-                                if "nocategory" in result_key:
+                                if not category:
                                     unset_count += result_count
 
                                 for categorie_label in categories_label:
                                     if categorie_label.lower() not in PollResponseCategory.IGNORED_CATEGORY_RULES:
-                                        if result_key.startswith(
-                                            "ruleset:%s:category:%s:" % (self.ruleset_uuid, categorie_label.lower())
-                                        ):
+                                        if category == categorie_label.lower():
                                             categories_count[categorie_label] += result_count
 
                         categories = [dict(count=v, label=k) for k, v in categories_count.items()]
@@ -1078,19 +1298,15 @@ class PollQuestion(SmartModel):
                         genders.append("o")
                         gender_labels["o"] = "Other"
 
+                    question_results = self.get_question_results([PollResultsCounter.KIND_GENDER])
+
                     for gender in genders:
                         categories = []
                         set_count = 0
-                        unset_count_key = "ruleset:%s:nocategory:%s:%s" % (self.ruleset_uuid, "gender", gender)
-                        unset_count = question_results.get(unset_count_key, 0)
+                        unset_count = question_results.get((PollResultsCounter.KIND_GENDER, "", gender), 0)
 
                         for categorie_label in categories_label:
-                            category_count_key = "ruleset:%s:category:%s:%s:%s" % (
-                                self.ruleset_uuid,
-                                categorie_label.lower(),
-                                "gender",
-                                gender,
-                            )
+                            category_count_key = (PollResultsCounter.KIND_GENDER, categorie_label.lower(), gender)
                             if categorie_label.lower() not in PollResponseCategory.IGNORED_CATEGORY_RULES:
                                 category_count = question_results.get(category_count_key, 0)
                                 set_count += category_count
@@ -1106,9 +1322,11 @@ class PollQuestion(SmartModel):
                         )
 
             else:
+                question_results = self.get_question_results([PollResultsCounter.KIND_CATEGORY])
+
                 categories = []
                 for categorie_label in categories_label:
-                    category_count_key = "ruleset:%s:category:%s" % (self.ruleset_uuid, categorie_label.lower())
+                    category_count_key = (PollResultsCounter.KIND_CATEGORY, categorie_label.lower(), "")
                     if categorie_label.lower() not in PollResponseCategory.IGNORED_CATEGORY_RULES:
                         category_count = question_results.get(category_count_key, 0)
                         categories.append(dict(count=category_count, label=categorie_label))
@@ -1144,21 +1362,19 @@ class PollQuestion(SmartModel):
             return cached_results[0]
         return dict()
 
-    def get_question_results(self):
-        return PollResultsCounter.get_question_results(self)
+    def get_question_results(self, kinds=None):
+        return PollResultsCounter.get_question_results(self, kinds)
 
     def is_open_ended(self):
         return self.response_categories.filter(is_active=True).exclude(category__icontains="no response").count() == 1
 
     def get_responded(self):
-        results = self.get_question_results()
-        key = "ruleset:%s:total-ruleset-responded" % self.ruleset_uuid
-        return results.get(key, 0)
+        results = self.get_question_results([PollResultsCounter.KIND_RESPONDED])
+        return results.get((PollResultsCounter.KIND_RESPONDED, "", ""), 0)
 
     def get_polled(self):
-        results = self.get_question_results()
-        key = "ruleset:%s:total-ruleset-polled" % self.ruleset_uuid
-        return results.get(key, 0)
+        results = self.get_question_results([PollResultsCounter.KIND_POLLED])
+        return results.get((PollResultsCounter.KIND_POLLED, "", ""), 0)
 
     def get_response_percentage(self):
         polled = self.get_polled()
@@ -1222,6 +1438,10 @@ class PollResponseCategory(models.Model):
 
 class PollResult(models.Model):
 
+    SYNC_UPDATE_FIELDS = ["category", "text", "state", "district", "ward", "date", "born", "gender", "completed"]
+
+    SYNC_UPDATE_BATCH_SIZE = 1000
+
     org = models.ForeignKey(Org, on_delete=models.PROTECT, related_name="poll_results", db_index=False)
 
     flow = models.CharField(max_length=36)
@@ -1311,12 +1531,14 @@ class PollResult(models.Model):
         return generated_stats
 
     def generate_counters(self):
+        """
+        Generates the counters of this result, keyed by the (kind, category, value) of PollResultsCounter
+        """
         generated_counters = dict()
 
         if not self.org_id or not self.flow or not self.ruleset:
             return generated_counters
 
-        ruleset = ""
         category = ""
         state = ""
         district = ""
@@ -1328,9 +1550,6 @@ class PollResult(models.Model):
         if self.text and self.text != "None":
             text = self.text
 
-        if self.ruleset:
-            ruleset = self.ruleset.lower()
-
         if self.category and self.category.lower() not in PollResponseCategory.IGNORED_CATEGORY_RULES:
             category = self.category.lower()
 
@@ -1344,59 +1563,75 @@ class PollResult(models.Model):
             ward = self.ward.upper()
 
         if self.born:
-            born = self.born
+            born = six.text_type(self.born)
 
         if self.gender:
             gender = self.gender.lower()
 
-        generated_counters["ruleset:%s:total-ruleset-polled" % ruleset] = 1
+        generated_counters[(PollResultsCounter.KIND_POLLED, "", "")] = 1
 
         if category or (
             self.category is not None
             and self.category.lower() not in PollResponseCategory.IGNORED_CATEGORY_RULES
             and text
         ):
-            generated_counters["ruleset:%s:total-ruleset-responded" % ruleset] = 1
+            generated_counters[(PollResultsCounter.KIND_RESPONDED, "", "")] = 1
 
         if category:
-            generated_counters["ruleset:%s:category:%s" % (ruleset, category)] = 1
-
-        if category and born:
-            generated_counters["ruleset:%s:category:%s:born:%s" % (ruleset, category, born)] = 1
-        elif born:
-            generated_counters["ruleset:%s:nocategory:born:%s" % (ruleset, born)] = 1
+            generated_counters[(PollResultsCounter.KIND_CATEGORY, category, "")] = 1
 
-        if category and gender:
-            generated_counters["ruleset:%s:category:%s:gender:%s" % (ruleset, category, gender)] = 1
-        elif gender:
-            generated_counters["ruleset:%s:nocategory:gender:%s" % (ruleset, gender)] = 1
+        # the segments are counted for the category, or for no category
+        if born:
+            generated_counters[(PollResultsCounter.KIND_BORN, category, born)] = 1
 
-        if state and category:
-            generated_counters["ruleset:%s:category:%s:state:%s" % (ruleset, category, state)] = 1
+        if gender:
+            generated_counters[(PollResultsCounter.KIND_GENDER, category, gender)] = 1
 
-        elif state:
+        if state:
+            generated_counters[(PollResultsCounter.KIND_STATE, category, state)] = 1
 
-            generated_counters["ruleset:%s:nocategory:state:%s" % (ruleset, state)] = 1
+        if district:
+            generated_counters[(PollResultsCounter.KIND_DISTRICT, category, district)] = 1
 
-        if district and category:
-            generated_counters["ruleset:%s:category:%s:district:%s" % (ruleset, category, district)] = 1
-
-        elif district:
-            generated_counters["ruleset:%s:nocategory:district:%s" % (ruleset, district)] = 1
-
-        if ward and category:
-            generated_counters["ruleset:%s:category:%s:ward:%s" % (ruleset, category, ward)] = 1
-
-        elif ward:
-            generated_counters["ruleset:%s:nocategory:ward:%s" % (ruleset, ward)] = 1
+        if ward:
+            generated_counters[(PollResultsCounter.KIND_WARD, category, ward)] = 1
 
         return generated_counters
 
     class Meta:
         index_together = [["org", "flow"], ["org", "flow", "ruleset", "text"]]
+        unique_together = ("org", "flow", "contact", "ruleset")
 
 
 class PollResultsCounter(models.Model):
+    """
+    Count of the results of a ruleset, in total or for one of its categories by a segment of the contacts
+    """
+
+    # the results of the ruleset, and the ones responded
+    KIND_POLLED = "polled"
+    KIND_RESPONDED = "responded"
+
+    # the results of each category
+    KIND_CATEGORY = "category"
+
+    # the results of each category, or of no category, by segment
+    KIND_BORN = "born"
+    KIND_GENDER = "gender"
+    KIND_STATE = "state"
+    KIND_DISTRICT = "district"
+    KIND_WARD = "ward"
+
+    KIND_CHOICES = (
+        (KIND_POLLED, _("Polled")),
+        (KIND_RESPONDED, _("Responded")),
+        (KIND_CATEGORY, _("Category")),
+        (KIND_BORN, _("Born")),
+        (KIND_GENDER, _("Gender")),
+        (KIND_STATE, _("State")),
+        (KIND_DISTRICT, _("District")),
+        (KIND_WARD, _("Ward")),
+    )
 
     id = models.BigAutoField(auto_created=True, primary_key=True, verbose_name="ID")
 
@@ -1404,37 +1639,158 @@ class PollResultsCounter(models.Model):
 
     ruleset = models.CharField(max_length=36)
 
-    type = models.CharField(max_length=255)
+    kind = models.CharField(max_length=16, choices=KIND_CHOICES)
+
+    category = models.CharField(
+        max_length=255, default="", help_text=_("The lowercase category counted, empty for no category")
+    )
+
+    value = models.CharField(
+        max_length=255, default="", help_text=_("The value of the segment counted, empty for the totals")
+    )
 
     count = models.IntegerField(default=0, help_text=_("Number of items with this counter"))
 
     @classmethod
-    def get_poll_results(cls, poll, types=None):
+    def get_poll_results(cls, poll, kinds=None):
         """
-        Get the poll results counts by counter type for a given poll
+        Get the poll results counts by (ruleset, kind, category, value) for a given poll
         """
         poll_rulesets = poll.questions.all().values_list("ruleset_uuid", flat=True)
 
-        counters = cls.objects.filter(org=poll.org, ruleset__in=poll_rulesets)
-        if types:
-            counters = counters.filter(type__in=types)
+        counters = cls.objects.filter(org_id=poll.org_id, ruleset__in=poll_rulesets)
+        if kinds:
+            counters = counters.filter(kind__in=kinds)
 
-        results = counters.values("type").order_by("type").annotate(count_sum=Sum("count"))
+        results = counters.values_list("ruleset", "kind", "category", "value").order_by().annotate(Sum("count"))
 
-        return {c["type"]: c["count_sum"] for c in results}
+        return {(ruleset, kind, category, value): count for ruleset, kind, category, value, count in results}
 
     @classmethod
-    def get_question_results(cls, question, types=None):
+    def get_question_results(cls, question, kinds=None):
         """
-        Get the poll question results counts by counter type for a given poll
+        Get the poll question results counts by (kind, category, value) for a given question, only of the given
+        kinds if any
         """
-        counters = cls.objects.filter(org=question.poll.org, ruleset=question.ruleset_uuid)
-        if types:
-            counters = counters.filter(type__in=types)
+        counters = cls.objects.filter(org_id=question.poll.org_id, ruleset=question.ruleset_uuid)
+        if kinds:
+            counters = counters.filter(kind__in=kinds)
+
+        results = counters.values_list("kind", "category", "value").order_by().annotate(Sum("count"))
 
-        results = counters.values("type").order_by("type").annotate(count_sum=Sum("count"))
+        return {(kind, category, value): count for kind, category, value, count in results}
 
-        return {c["type"]: c["count_sum"] for c in results}
+    class Meta:
+        index_together = ["org", "ruleset", "kind"]
+
+
+class SyncRun(models.Model):
+    """
+    Telemetry of a single pull of poll results, from the API or from an archive
+    """
+
+    SOURCE_API = "A"
+    SOURCE_ARCHIVE = "R"
+
+    SOURCE_CHOICES = ((SOURCE_API, _("API")), (SOURCE_ARCHIVE, _("Archive")))
+
+    PAUSE_MAX_RUNS = "M"
+    PAUSE_LOCK_EXPIRY = "L"
+    PAUSE_RATE_LIMIT = "R"
+
+    PAUSE_REASON_CHOICES = (
+        (PAUSE_MAX_RUNS, _("Max runs")),
+        (PAUSE_LOCK_EXPIRY, _("Lock expiry")),
+        (PAUSE_RATE_LIMIT, _("Rate limit")),
+    )
+
+    org = models.ForeignKey(Org, on_delete=models.PROTECT, related_name="sync_runs")
+
+    poll = models.ForeignKey(Poll, on_delete=models.CASCADE, related_name="sync_runs")
+
+    source = models.CharField(max_length=1, choices=SOURCE_CHOICES)
+
+    started_on = models.DateTimeField(default=timezone.now)
+
+    ended_on = models.DateTimeField(null=True)
+
+    duration = models.FloatField(default=0, help_text=_("Total time of the sync, in seconds"))
+
+    api_wait_time = models.FloatField(default=0, help_text=_("Time waiting for runs from the API, in seconds"))
+
+    diff_time = models.FloatField(default=0, help_text=_("Time diffing the runs, in seconds"))
+
+    db_write_time = models.FloatField(default=0, help_text=_("Time writing the results, in seconds"))
+
+    num_fetches = models.IntegerField(default=0)
+
+    num_runs = models.IntegerField(default=0)
+
+    num_created = models.IntegerField(default=0)
+
+    num_updated = models.IntegerField(default=0)
+
+    num_ignored = models.IntegerField(default=0)
+
+    pause_reason = models.CharField(max_length=1, null=True, choices=PAUSE_REASON_CHOICES)
+
+    peak_memory = models.BigIntegerField(null=True, help_text=_("Peak resident memory of the worker, in kilobytes"))
+
+    @classmethod
+    def start(cls, poll, source):
+        return cls(org_id=poll.org_id, poll=poll, source=source, started_on=timezone.now())
+
+    def add_fetch(self, num_runs, api_wait_time, diff_time, db_write_time):
+        self.num_fetches += 1
+        self.num_runs += num_runs
+        self.api_wait_time += api_wait_time
+        self.diff_time += diff_time
+        self.db_write_time += db_write_time
+
+    def finish(self, stats_dict, pause_reason=None):
+        import resource
+
+        self.ended_on = timezone.now()
+        self.duration = (self.ended_on - self.started_on).total_seconds()
+        self.num_created = stats_dict["num_val_created"] + stats_dict["num_path_created"]
+        self.num_updated = stats_dict["num_val_updated"] + stats_dict["num_path_updated"]
+        self.num_ignored = stats_dict["num_val_ignored"] + stats_dict["num_path_ignored"]
+        self.pause_reason = pause_reason
+
+        # ru_maxrss is the peak of the whole worker process, in kilobytes on Linux
+        self.peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        self.save()
+
+    @classmethod
+    def get_slowest(cls, org=None, since=None, limit=20):
+        sync_runs = cls.objects.exclude(ended_on=None).select_related("poll")
+        if org is not None:
+            sync_runs = sync_runs.filter(org=org)
+        if since is not None:
+            sync_runs = sync_runs.filter(started_on__gte=since)
+
+        return sync_runs.order_by("-duration")[:limit]
+
+    def as_json(self):
+        return dict(
+            id=self.pk,
+            org=self.org_id,
+            poll=dict(id=self.poll_id, title=self.poll.title, flow_uuid=self.poll.flow_uuid),
+            source=self.get_source_display(),
+            started_on=self.started_on.isoformat(),
+            ended_on=self.ended_on.isoformat() if self.ended_on else None,
+            duration=self.duration,
+            api_wait_time=self.api_wait_time,
+            diff_time=self.diff_time,
+            db_write_time=self.db_write_time,
+            num_fetches=self.num_fetches,
+            num_runs=self.num_runs,
+            num_created=self.num_created,
+            num_updated=self.num_updated,
+            num_ignored=self.num_ignored,
+            pause_reason=self.get_pause_reason_display() if self.pause_reason else None,
+            peak_memory=self.peak_memory,
+        )
 
     class Meta:
-        index_together = ["org", "ruleset", "type"]
+        index_together = [["org", "started_on"], ["started_on", "duration"]]
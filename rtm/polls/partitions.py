@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import logging
+import os
+import time
+
+from django.db import connection, transaction
+
+logger = logging.getLogger(__name__)
+
+POLL_RESULTS_TABLE = "polls_pollresult"
+POLL_RESULTS_ORG_PARTITION = "polls_pollresult_org_%d"
+
+# the SQL installing the contact activities triggers of the poll results, their functions take a row of the table
+# so they are dropped along with the unpartitioned table and installed again on the partitioned one
+POLL_RESULTS_TRIGGERS_SQL_FILES = ("polls_0055", "polls_0064", "polls_0067")
+
+IS_PARTITIONED_SQL = """
+SELECT EXISTS (
+    SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid
+    WHERE c.relname = %s AND c.relnamespace = 'public'::regnamespace
+)
+"""
+
+PARTITION_EXISTS_SQL = "SELECT to_regclass(%s) IS NOT NULL"
+
+# the results are copied to a new table partitioned by org, with a partition for each existing org and a default
+# partition holding the results of orgs created later until they get their own
+CREATE_PARTITIONED_TABLE_SQL = """
+LOCK TABLE polls_pollresult IN ACCESS EXCLUSIVE MODE;
+ALTER TABLE polls_pollresult RENAME TO polls_pollresult_unpartitioned;
+
+CREATE TABLE polls_pollresult (LIKE polls_pollresult_unpartitioned INCLUDING DEFAULTS) PARTITION BY LIST (org_id);
+ALTER SEQUENCE polls_pollresult_id_seq OWNED BY polls_pollresult.id;
+
+CREATE TABLE polls_pollresult_default PARTITION OF polls_pollresult DEFAULT;
+"""
+
+COPY_RESULTS_SQL = "INSERT INTO polls_pollresult SELECT * FROM polls_pollresult_unpartitioned"
+
+# built once the results are copied, each on the parent so that every partition, existing or attached later, gets
+# its own. The partition key has to be part of the primary key and of the unique key, the unique key also serves
+# the lookups of the (org_id, flow, contact) index of the unpartitioned table
+CREATE_PARTITIONED_INDEXES_SQL = """
+ALTER TABLE polls_pollresult ADD CONSTRAINT polls_pollresult_partitioned_pkey PRIMARY KEY (id, org_id);
+ALTER TABLE polls_pollresult ADD CONSTRAINT polls_pollresult_partitioned_org_id_fk_orgs_org_id
+    FOREIGN KEY (org_id) REFERENCES orgs_org (id) DEFERRABLE INITIALLY DEFERRED;
+ALTER TABLE polls_pollresult ADD CONSTRAINT polls_pollresult_partitioned_org_flow_contact_ruleset_uniq
+    UNIQUE (org_id, flow, contact, ruleset);
+CREATE INDEX polls_pollresult_partitioned_org_flow ON polls_pollresult (org_id, flow);
+CREATE INDEX polls_pollresult_partitioned_org_flow_ruleset_text ON polls_pollresult (org_id, flow, ruleset, text);
+CREATE INDEX polls_pollresult_partitioned_contact ON polls_pollresult (contact);
+"""
+
+DROP_UNPARTITIONED_TABLE_SQL = """
+DROP TRIGGER IF EXISTS ureport_when_poll_result_contact_activities ON polls_pollresult_unpartitioned;
+DROP TRIGGER IF EXISTS ureport_when_poll_results_truncate_then_update_contact_activities
+    ON polls_pollresult_unpartitioned;
+DROP FUNCTION IF EXISTS generate_contact_activities_for_latest_poll_result(polls_pollresult_unpartitioned);
+DROP FUNCTION IF EXISTS ureport_insert_missing_contact_activities(polls_pollresult_unpartitioned);
+DROP TABLE polls_pollresult_unpartitioned;
+"""
+
+# the results of the org already in the default partition are moved to the new partition before it is attached,
+# the check constraint saves the scan of the partition when attaching it
+CREATE_ORG_PARTITION_SQL = """
+CREATE TABLE %(partition)s (LIKE polls_pollresult INCLUDING DEFAULTS);
+ALTER TABLE %(partition)s ADD CONSTRAINT %(partition)s_org_check CHECK (org_id = %(org_id)d);
+INSERT INTO %(partition)s SELECT * FROM polls_pollresult_default WHERE org_id = %(org_id)d;
+DELETE FROM polls_pollresult_default WHERE org_id = %(org_id)d;
+ALTER TABLE polls_pollresult ATTACH PARTITION %(partition)s FOR VALUES IN (%(org_id)d);
+ALTER TABLE %(partition)s DROP CONSTRAINT %(partition)s_org_check;
+"""
+
+
+def read_sql(filename):
+    sql_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), "sql", "%s.sql" % filename)
+    with open(sql_path) as sql_file:
+        return sql_file.read()
+
+
+def is_poll_results_partitioned():
+    with connection.cursor() as cursor:
+        cursor.execute(IS_PARTITIONED_SQL, [POLL_RESULTS_TABLE])
+        return cursor.fetchone()[0]
+
+
+def has_org_partition(org_id):
+    with connection.cursor() as cursor:
+        cursor.execute(PARTITION_EXISTS_SQL, [POLL_RESULTS_ORG_PARTITION % org_id])
+        return cursor.fetchone()[0]
+
+
+def partition_poll_results(org_ids):
+    """
+    Converts the poll results table to one partitioned by org, in a single transaction holding an exclusive lock on
+    the table for the whole copy so it has to run in a maintenance window. Returns whether it was converted, which
+    it is not when already partitioned.
+
+    The index_together and unique_together of PollResult and the contact indexes are recreated on the partitioned
+    table, as well as the contact activities triggers, which fire for the rows of every partition.
+    """
+    if is_poll_results_partitioned():
+        return False
+
+    start = time.time()
+
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(CREATE_PARTITIONED_TABLE_SQL)
+            for org_id in org_ids:
+                cursor.execute(
+                    "CREATE TABLE %s PARTITION OF polls_pollresult FOR VALUES IN (%d)"
+                    % (POLL_RESULTS_ORG_PARTITION % org_id, org_id)
+                )
+
+            cursor.execute(COPY_RESULTS_SQL)
+            num_results = cursor.rowcount
+            logger.info("Copied %d poll results to their partitions in %ds" % (num_results, time.time() - start))
+
+            cursor.execute(CREATE_PARTITIONED_INDEXES_SQL)
+            cursor.execute(DROP_UNPARTITIONED_TABLE_SQL)
+
+            for filename in POLL_RESULTS_TRIGGERS_SQL_FILES:
+                cursor.execute(read_sql(filename))
+
+    with connection.cursor() as cursor:
+        cursor.execute("ANALYZE polls_pollresult")
+
+    logger.info(
+        "Partitioned %d poll results of %d orgs by org in %ds" % (num_results, len(org_ids), time.time() - start)
+    )
+    return True
+
+
+def create_org_partition(org_id):
+    """
+    Creates the partition of the poll results of an org, moving its results out of the default partition. Returns
+    whether it was created, which it is not when the table is not partitioned or the org already has one.
+    """
+    if not is_poll_results_partitioned() or has_org_partition(org_id):
+        return False
+
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(
+                CREATE_ORG_PARTITION_SQL % dict(partition=POLL_RESULTS_ORG_PARTITION % org_id, org_id=org_id)
+            )
+
+    logger.info("Created the poll results partition of org #%d" % org_id)
+    return True
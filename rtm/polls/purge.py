@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import logging
+import time
+
+from django.conf import settings
+from django.db import connection, transaction
+
+logger = logging.getLogger(__name__)
+
+# number of poll results deleted by each statement of a purge, each in its own transaction
+POLL_RESULTS_PURGE_BATCH_SIZE = getattr(settings, "POLL_RESULTS_PURGE_BATCH_SIZE", 10000)
+
+# deletes a batch of the results of a flow by their physical location, the outer filter keeps the tuple ids to the
+# partition of the org when the table is partitioned
+PURGE_POLL_RESULTS_BATCH_SQL = """
+DELETE FROM polls_pollresult
+WHERE org_id = %(org_id)s AND flow = %(flow)s AND ctid = ANY(ARRAY(
+    SELECT ctid FROM polls_pollresult WHERE org_id = %(org_id)s AND flow = %(flow)s LIMIT %(batch_size)s
+))
+"""
+
+
+def purge_flow_results(org_id, flow_uuid, batch_size=None, progress=None):
+    """
+    Deletes all the poll results of a flow in set based batches, each committed on its own so that no lock or
+    transaction is held for the whole purge. The contact activities trigger does not fire on deletes, their contact
+    activities are kept like the row by row delete did.
+
+    The progress callback, if any, is called with the number of results deleted so far after each batch.
+    """
+    batch_size = batch_size or POLL_RESULTS_PURGE_BATCH_SIZE
+    params = dict(org_id=org_id, flow=flow_uuid, batch_size=batch_size)
+
+    start = time.time()
+    num_deleted = 0
+
+    while True:
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute(PURGE_POLL_RESULTS_BATCH_SQL, params)
+                num_batch = cursor.rowcount
+
+        num_deleted += num_batch
+
+        if progress is not None:
+            progress(num_deleted)
+
+        logger.info(
+            "Purged %d poll results of flow %s on org #%d in %ds"
+            % (num_deleted, flow_uuid, org_id, time.time() - start)
+        )
+
+        if num_batch < batch_size:
+            return num_deleted
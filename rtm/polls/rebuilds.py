@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import logging
+import time
+from collections import defaultdict
+
+from django_redis import get_redis_connection
+
+from django.conf import settings
+from django.db.models import Q
+
+logger = logging.getLogger(__name__)
+
+# maximum number of rebuilds of poll counters running at the same time, across all orgs
+POLL_RESULTS_REBUILD_CONCURRENCY = getattr(settings, "POLL_RESULTS_REBUILD_CONCURRENCY", 4)
+
+# sorted set of the flows whose results changed since their counters were last rebuilt, scored by the first change
+POLL_RESULTS_DIRTY_FLOWS_KEY = "poll-results-dirty-flows"
+
+# how long a requested rebuild waits for more requests of the same flow before running
+POLL_RESULTS_REBUILD_DEBOUNCE = getattr(settings, "POLL_RESULTS_REBUILD_DEBOUNCE", 60)
+
+# longest a rebuild can be pushed back by requests that keep coming, from the first of them
+POLL_RESULTS_REBUILD_MAX_DELAY = getattr(settings, "POLL_RESULTS_REBUILD_MAX_DELAY", 60 * 10)
+
+# sorted set of the flows with a rebuild requested, scored by when it is due, and the time of their first request
+POLL_RESULTS_REBUILD_REQUESTS_KEY = "poll-results-rebuild-requests"
+POLL_RESULTS_REBUILD_FIRST_REQUESTS_KEY = "poll-results-rebuild-first-requests"
+
+# pushes back the rebuild of a flow already requested, up to the max delay from its first request
+REQUEST_REBUILD_SCRIPT = """
+local now = tonumber(ARGV[2])
+local first = tonumber(redis.call('HGET', KEYS[2], ARGV[1]))
+if not first then
+    first = now
+    redis.call('HSET', KEYS[2], ARGV[1], tostring(now))
+end
+
+local due = math.min(now + tonumber(ARGV[3]), first + tonumber(ARGV[4]))
+redis.call('ZADD', KEYS[1], due, ARGV[1])
+
+return tostring(due)
+"""
+
+# takes the flows with a rebuild due, so that a request made from now on is queued again
+POP_DUE_REBUILDS_SCRIPT = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+if #due > 0 then
+    redis.call('ZREM', KEYS[1], unpack(due))
+    redis.call('HDEL', KEYS[2], unpack(due))
+end
+return due
+"""
+
+
+def get_flow_member(org_id, flow_uuid):
+    return "%d:%s" % (org_id, flow_uuid)
+
+
+def parse_flow_member(member):
+    org_id, flow_uuid = member.decode("utf-8").split(":", 1)
+    return int(org_id), flow_uuid
+
+
+def mark_flows_dirty(flows):
+    """
+    Marks the given (org_id, flow_uuid) pairs as having results changed since their counters were last rebuilt
+    """
+    members = {get_flow_member(org_id, flow_uuid): time.time() for org_id, flow_uuid in set(flows) if flow_uuid}
+    if members:
+        # keep the time of the first change of flows already dirty
+        get_redis_connection().zadd(POLL_RESULTS_DIRTY_FLOWS_KEY, members, nx=True)
+
+
+def mark_flow_dirty(org_id, flow_uuid):
+    mark_flows_dirty([(org_id, flow_uuid)])
+
+
+def clear_flow_dirty(org_id, flow_uuid):
+    """
+    Clears the flow before its counters are rebuilt, results changed during the rebuild mark it dirty again
+    """
+    get_redis_connection().zrem(POLL_RESULTS_DIRTY_FLOWS_KEY, get_flow_member(org_id, flow_uuid))
+
+
+def get_dirty_flows(org_id=None):
+    """
+    Gets the (org_id, flow_uuid) pairs of the flows with results changed since their counters were last rebuilt
+    """
+    members = get_redis_connection().zrange(POLL_RESULTS_DIRTY_FLOWS_KEY, 0, -1)
+    flows = [parse_flow_member(member) for member in members]
+    if org_id is not None:
+        flows = [(flow_org_id, flow_uuid) for flow_org_id, flow_uuid in flows if flow_org_id == org_id]
+    return flows
+
+
+def get_dirty_polls(polls, org_id=None):
+    """
+    Filters the given polls to those of the flows with results changed since their counters were last rebuilt
+    """
+    flows_by_org = defaultdict(set)
+    for flow_org_id, flow_uuid in get_dirty_flows(org_id):
+        flows_by_org[flow_org_id].add(flow_uuid)
+
+    if not flows_by_org:
+        return polls.none()
+
+    dirty = Q()
+    for flow_org_id, flow_uuids in flows_by_org.items():
+        dirty |= Q(org_id=flow_org_id, flow_uuid__in=flow_uuids)
+
+    return polls.filter(dirty)
+
+
+def clear_dirty_flows_without_polls(polls):
+    """
+    Clears the dirty flows with none of the given polls, the counters of those flows are not rebuilt so they would
+    otherwise stay dirty forever
+    """
+    flows = set(get_dirty_polls(polls).values_list("org_id", "flow_uuid"))
+    members = [
+        get_flow_member(org_id, flow_uuid)
+        for org_id, flow_uuid in get_dirty_flows()
+        if (org_id, flow_uuid) not in flows
+    ]
+    if members:
+        get_redis_connection().zrem(POLL_RESULTS_DIRTY_FLOWS_KEY, *members)
+
+    return len(members)
+
+
+def schedule_rebuilds(polls):
+    """
+    Dispatches the rebuild of the counters of the flows of the given polls, split in as many lanes as rebuilds allowed
+    to run at the same time. Each lane rebuilds its flows one after the other, so the db is never hit by more than
+    the cap
+    """
+    from .tasks import rebuild_polls_counts
+
+    # a rebuild covers every poll of the flow so one poll per flow is enough
+    flow_polls = dict()
+    for poll_id, org_id, flow_uuid in polls.order_by("org_id", "flow_uuid", "pk").values_list(
+        "pk", "org_id", "flow_uuid"
+    ):
+        flow_polls.setdefault((org_id, flow_uuid), poll_id)
+
+    poll_ids = list(flow_polls.values())
+    lanes = [poll_ids[i::POLL_RESULTS_REBUILD_CONCURRENCY] for i in range(POLL_RESULTS_REBUILD_CONCURRENCY)]
+    lanes = [lane for lane in lanes if lane]
+
+    for lane in lanes:
+        rebuild_polls_counts.delay(lane)
+
+    logger.info("Scheduled rebuilds of the counters of %d flows in %d lanes" % (len(flow_polls), len(lanes)))
+
+    return lanes
+
+
+def request_rebuild(org_id, flow_uuid):
+    """
+    Requests a rebuild of the counters of the polls of the flow, requests coming in a burst are coalesced into a
+    single rebuild run once no request came for the debounce window
+    """
+    r = get_redis_connection()
+    r.eval(
+        REQUEST_REBUILD_SCRIPT,
+        2,
+        POLL_RESULTS_REBUILD_REQUESTS_KEY,
+        POLL_RESULTS_REBUILD_FIRST_REQUESTS_KEY,
+        get_flow_member(org_id, flow_uuid),
+        repr(time.time()),
+        POLL_RESULTS_REBUILD_DEBOUNCE,
+        POLL_RESULTS_REBUILD_MAX_DELAY,
+    )
+
+
+def pop_due_rebuilds(limit=1000):
+    """
+    Takes the (org_id, flow_uuid) pairs of the flows with a requested rebuild due
+    """
+    r = get_redis_connection()
+    members = r.eval(
+        POP_DUE_REBUILDS_SCRIPT,
+        2,
+        POLL_RESULTS_REBUILD_REQUESTS_KEY,
+        POLL_RESULTS_REBUILD_FIRST_REQUESTS_KEY,
+        repr(time.time()),
+        limit,
+    )
+    return [parse_flow_member(member) for member in members]
+
+
+def run_requested_rebuilds():
+    """
+    Dispatches the rebuilds that are due. A flow still being rebuilt when its turn comes, or getting a request while
+    it is rebuilt, is requested again by the rebuild so that the changes of the request are not lost
+    """
+    from .models import Poll
+
+    flows_by_org = defaultdict(set)
+    for org_id, flow_uuid in pop_due_rebuilds():
+        flows_by_org[org_id].add(flow_uuid)
+
+    if not flows_by_org:
+        return []
+
+    requested = Q()
+    for org_id, flow_uuids in flows_by_org.items():
+        requested |= Q(org_id=org_id, flow_uuid__in=flow_uuids)
+
+    return schedule_rebuilds(Poll.objects.filter(requested))
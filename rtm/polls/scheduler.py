@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import logging
+import math
+import time
+from collections import namedtuple
+from datetime import timedelta
+
+from django_redis import get_redis_connection
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from rtm.utils import json_date_to_datetime
+
+logger = logging.getLogger(__name__)
+
+# the kinds of polls we pull results for, a flow used by several polls gets the highest priority among them
+PULL_PRIORITY_MAIN = 5
+PULL_PRIORITY_RECENT = 4
+PULL_PRIORITY_BRICK = 3
+PULL_PRIORITY_BACKFILL = 2
+PULL_PRIORITY_OTHER = 1
+
+# how long the results of a flow can go without a pull for each priority
+PULL_INTERVALS = {
+    PULL_PRIORITY_MAIN: timedelta(minutes=20),
+    PULL_PRIORITY_RECENT: timedelta(hours=1),
+    PULL_PRIORITY_BRICK: timedelta(hours=1),
+    PULL_PRIORITY_BACKFILL: timedelta(minutes=10),
+    PULL_PRIORITY_OTHER: timedelta(hours=24),
+}
+
+# only the most recent brick polls are kept fresh, the others are pulled like any other poll
+PULL_BRICK_POLLS_LIMIT = 5
+
+# maximum number of flows being pulled at the same time, across all orgs
+POLL_RESULTS_PULL_CONCURRENCY = getattr(settings, "POLL_RESULTS_PULL_CONCURRENCY", 8)
+
+# sorted set of the flows being pulled, scored by when their slot expires if the pull never releases it
+POLL_RESULTS_PULL_SLOTS_KEY = "poll-results-pull-slots"
+
+POLL_RESULTS_PULL_SCHEDULE_LOCK = "poll-results-pull-schedule-lock"
+
+PullCandidate = namedtuple("PullCandidate", ("org_id", "flow_uuid", "poll_id", "priority", "score"))
+
+
+def get_pull_slot(org_id, flow_uuid):
+    return "%d:%s" % (org_id, flow_uuid)
+
+
+def take_pull_slot(org_id, flow_uuid, timeout):
+    """
+    Takes the slot of the flow until its pull releases it, or for the given seconds if the pull never does
+    """
+    slot = get_pull_slot(org_id, flow_uuid)
+    get_redis_connection().zadd(POLL_RESULTS_PULL_SLOTS_KEY, {slot: time.time() + timeout})
+    return slot
+
+
+def release_pull_slot(slot):
+    """
+    Releases the slot of a pull once it is done, a pull that paused keeps it for the pull resuming it
+    """
+    from .models import Poll
+
+    org_id, flow_uuid = slot.split(":", 1)
+    if cache.get(Poll.POLL_RESULTS_PAUSED_UNTIL_CACHE_KEY % (int(org_id), flow_uuid)):
+        return
+
+    get_redis_connection().zrem(POLL_RESULTS_PULL_SLOTS_KEY, slot)
+
+
+def get_flow_priorities(org):
+    """
+    Gets the poll to pull and its priority for each distinct flow of the org with results to pull
+    """
+    from .models import Poll
+
+    now = timezone.now()
+    flow_polls = dict()
+
+    def add_polls(polls, priority):
+        for poll_id, flow_uuid in polls.exclude(flow_uuid="").values_list("id", "flow_uuid"):
+            if flow_uuid not in flow_polls or flow_polls[flow_uuid][1] < priority:
+                flow_polls[flow_uuid] = (poll_id, priority)
+
+    main_poll = Poll.get_main_poll(org)
+    if main_poll:
+        add_polls(Poll.objects.filter(pk=main_poll.pk), PULL_PRIORITY_MAIN)
+
+    add_polls(Poll.get_recent_polls(org), PULL_PRIORITY_RECENT)
+
+    brick_polls_ids = Poll.get_brick_polls_ids(org)[:PULL_BRICK_POLLS_LIMIT]
+    add_polls(Poll.objects.filter(pk__in=brick_polls_ids), PULL_PRIORITY_BRICK)
+
+    add_polls(Poll.objects.filter(org=org, has_synced=False).exclude(is_active=False), PULL_PRIORITY_BACKFILL)
+
+    # polls of the last week are already recent polls
+    add_polls(Poll.get_other_polls(org).exclude(created_on__gt=now - timedelta(days=7)), PULL_PRIORITY_OTHER)
+
+    return flow_polls
+
+
+def get_pull_candidates(org, now=None):
+    """
+    Gets the flows of the org due for a pull, scored by how overdue they are and how many runs their last pull got.
+    Flows with a paused pull are left to resume it with the slot it kept.
+    """
+    from .models import Poll, SyncRun
+
+    now = now or timezone.now()
+    flow_polls = get_flow_priorities(org)
+    if not flow_polls:
+        return []
+
+    sync_time_keys = {
+        Poll.POLL_RESULTS_LAST_SYNC_TIME_CACHE_KEY % (org.pk, flow_uuid): flow_uuid for flow_uuid in flow_polls
+    }
+    last_sync_times = {
+        sync_time_keys[key]: json_date_to_datetime(value)
+        for key, value in cache.get_many(list(sync_time_keys.keys())).items()
+        if value
+    }
+
+    # paused pulls resume on their own once the countdown they got is over
+    paused_keys = {
+        Poll.POLL_RESULTS_PAUSED_UNTIL_CACHE_KEY % (org.pk, flow_uuid): flow_uuid for flow_uuid in flow_polls
+    }
+    paused_flows = {
+        paused_keys[key]
+        for key, value in cache.get_many(list(paused_keys.keys())).items()
+        if value and json_date_to_datetime(value) > now
+    }
+
+    last_volumes = dict(
+        SyncRun.objects.filter(org=org, poll__flow_uuid__in=list(flow_polls.keys()))
+        .order_by("poll__flow_uuid", "-started_on")
+        .distinct("poll__flow_uuid")
+        .values_list("poll__flow_uuid", "num_runs")
+    )
+
+    candidates = []
+    for flow_uuid, (poll_id, priority) in flow_polls.items():
+        if flow_uuid in paused_flows:
+            continue
+
+        interval = PULL_INTERVALS[priority]
+        last_sync_time = last_sync_times.get(flow_uuid)
+
+        if last_sync_time is None:
+            staleness = 2.0
+        else:
+            staleness = (now - last_sync_time).total_seconds() / interval.total_seconds()
+            if staleness < 1:
+                continue
+
+        # flows that got runs last time are likely to keep getting them
+        score = min(staleness, 10.0) * (1 + math.log10(1 + last_volumes.get(flow_uuid, 0)))
+        candidates.append(PullCandidate(org.pk, flow_uuid, poll_id, priority, score))
+
+    return candidates
+
+
+def schedule_pulls(orgs):
+    """
+    Dispatches the pulls of the flows most in need of one across the given orgs, as many as there are free slots.
+    Flows are taken by priority first, then by score, and a flow is never pulled twice at the same time.
+    """
+    from .models import Poll
+    from .tasks import pull_poll_results
+
+    r = get_redis_connection()
+    now = time.time()
+
+    # forget the slots of pulls that died without releasing them
+    r.zremrangebyscore(POLL_RESULTS_PULL_SLOTS_KEY, "-inf", now)
+
+    running = set(slot.decode("utf-8") for slot in r.zrange(POLL_RESULTS_PULL_SLOTS_KEY, 0, -1))
+    free_slots = POLL_RESULTS_PULL_CONCURRENCY - len(running)
+    if free_slots <= 0:
+        return []
+
+    candidates = []
+    for org in orgs:
+        candidates += get_pull_candidates(org)
+
+    candidates.sort(key=lambda c: (c.priority, c.score), reverse=True)
+
+    dispatched = []
+    for candidate in candidates:
+        if len(dispatched) >= free_slots:
+            break
+
+        if get_pull_slot(candidate.org_id, candidate.flow_uuid) in running:
+            continue
+
+        slot = take_pull_slot(candidate.org_id, candidate.flow_uuid, Poll.POLL_SYNC_LOCK_TIMEOUT)
+        pull_poll_results.apply_async((candidate.poll_id, slot), queue="sync")
+        dispatched.append(candidate)
+
+    logger.info(
+        "Scheduled results pulls of %d flows out of %d due, %d already running"
+        % (len(dispatched), len(candidates), len(running))
+    )
+
+    return dispatched
@@ -3,14 +3,13 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 import logging
 import time
+import zlib
 from datetime import timedelta
 
+import requests
 from dash.orgs.models import Org
-from dash.orgs.tasks import org_task
 from django_redis import get_redis_connection
-from temba_client.exceptions import TembaRateExceededError
 
-from django.core.cache import cache
 from django.utils import timezone
 
 from rtm.celery import app
@@ -24,177 +23,27 @@ from rtm.utils import (
 logger = logging.getLogger(__name__)
 
 
-@org_task("backfill-poll-results", 60 * 60 * 3)
-def backfill_poll_results(org, since, until):
-    from .models import Poll
+@app.task(name="polls.schedule_poll_results_pulls")
+def schedule_poll_results_pulls():
+    from .scheduler import POLL_RESULTS_PULL_SCHEDULE_LOCK, schedule_pulls
 
-    results_log = dict()
-
-    for poll in (
-        Poll.objects.filter(org=org, has_synced=False)
-        .exclude(is_active=False)
-        .exclude(flow_uuid="")
-        .distinct("flow_uuid")
-    ):
-        (
-            num_val_created,
-            num_val_updated,
-            num_val_ignored,
-            num_path_created,
-            num_path_updated,
-            num_path_ignored,
-        ) = Poll.pull_results(poll.id)
-        results_log["flow-%s" % poll.flow_uuid] = {
-            "num_val_created": num_val_created,
-            "num_val_updated": num_val_updated,
-            "num_val_ignored": num_val_ignored,
-            "num_path_created": num_path_created,
-            "num_path_updated": num_path_updated,
-            "num_path_ignored": num_path_ignored,
-        }
-
-    return results_log
-
-
-@org_task("results-pull-main-poll", 60 * 60 * 2)
-def pull_results_main_poll(org, since, until):
-    from .models import Poll
+    r = get_redis_connection()
 
-    results_log = dict()
-    main_poll = Poll.get_main_poll(org)
-    if main_poll:
-        (
-            num_val_created,
-            num_val_updated,
-            num_val_ignored,
-            num_path_created,
-            num_path_updated,
-            num_path_ignored,
-        ) = Poll.pull_results(main_poll.id)
-        results_log["flow-%s" % main_poll.flow_uuid] = {
-            "num_val_created": num_val_created,
-            "num_val_updated": num_val_updated,
-            "num_val_ignored": num_val_ignored,
-            "num_path_created": num_path_created,
-            "num_path_updated": num_path_updated,
-            "num_path_ignored": num_path_ignored,
-        }
-
-    return results_log
-
-
-@org_task("results-pull-brick-polls", 60 * 60 * 24)
-def pull_results_brick_polls(org, since, until):
-    from .models import Poll
+    if not r.get(POLL_RESULTS_PULL_SCHEDULE_LOCK):
+        with r.lock(POLL_RESULTS_PULL_SCHEDULE_LOCK, timeout=300):
+            schedule_pulls(Org.objects.filter(is_active=True).order_by("pk"))
 
-    results_log = dict()
-
-    brick_polls_ids_list = Poll.get_brick_polls_ids(org)
-    brick_polls_ids_list = [poll_id for poll_id in brick_polls_ids_list]
-
-    brick_polls_ids = (
-        Poll.objects.filter(id__in=brick_polls_ids_list)
-        .order_by("flow_uuid")
-        .distinct("flow_uuid")
-        .values_list("id", flat=True)
-    )
-
-    brick_polls = list(Poll.objects.filter(id__in=brick_polls_ids).order_by("-created_on"))[:5]
-    for poll in brick_polls:
-
-        key = Poll.POLL_RESULTS_LAST_OTHER_POLLS_SYNCED_CACHE_KEY % (org.id, poll.flow_uuid)
-        if not cache.get(key):
-            try:
-                (
-                    num_val_created,
-                    num_val_updated,
-                    num_val_ignored,
-                    num_path_created,
-                    num_path_updated,
-                    num_path_ignored,
-                ) = Poll.pull_results(poll.id)
-                results_log["flow-%s" % poll.flow_uuid] = {
-                    "num_val_created": num_val_created,
-                    "num_val_updated": num_val_updated,
-                    "num_val_ignored": num_val_ignored,
-                    "num_path_created": num_path_created,
-                    "num_path_updated": num_path_updated,
-                    "num_path_ignored": num_path_ignored,
-                }
-
-            except TembaRateExceededError:
-                pass
-    return results_log
-
-
-@org_task("results-pull-other-polls", 60 * 60 * 24)
-def pull_results_other_polls(org, since, until):
-    from .models import Poll
 
-    now = timezone.now()
-    recent_window = now - timedelta(days=7)
-
-    results_log = dict()
-    other_polls_ids = Poll.get_other_polls(org).exclude(created_on__gt=recent_window)
-    other_polls_ids = other_polls_ids.order_by("flow_uuid").distinct("flow_uuid").values_list("id", flat=True)
-    other_polls = Poll.objects.filter(id__in=other_polls_ids).order_by("-created_on")
-    for poll in other_polls:
-
-        key = Poll.POLL_RESULTS_LAST_OTHER_POLLS_SYNCED_CACHE_KEY % (org.id, poll.flow_uuid)
-        if not cache.get(key):
-            try:
-                (
-                    num_val_created,
-                    num_val_updated,
-                    num_val_ignored,
-                    num_path_created,
-                    num_path_updated,
-                    num_path_ignored,
-                ) = Poll.pull_results(poll.id)
-
-                results_log["flow-%s" % poll.flow_uuid] = {
-                    "num_val_created": num_val_created,
-                    "num_val_updated": num_val_updated,
-                    "num_val_ignored": num_val_ignored,
-                    "num_path_created": num_path_created,
-                    "num_path_updated": num_path_updated,
-                    "num_path_ignored": num_path_ignored,
-                }
-
-            except TembaRateExceededError:
-                pass
-
-    return results_log
-
-
-@org_task("results-pull-recent-polls", 60 * 60 * 6)
-def pull_results_recent_polls(org, since, until):
+@app.task(name="polls.pull_poll_results")
+def pull_poll_results(poll_id, slot):
     from .models import Poll
+    from .scheduler import release_pull_slot
 
-    results_log = dict()
-    recent_polls_ids = Poll.get_recent_polls(org).order_by("flow_uuid")
-    recent_polls_ids = recent_polls_ids.distinct("flow_uuid").values_list("id", flat=True)
-
-    recent_polls = Poll.objects.filter(id__in=recent_polls_ids).order_by("-created_on")
-    for poll in recent_polls:
-        (
-            num_val_created,
-            num_val_updated,
-            num_val_ignored,
-            num_path_created,
-            num_path_updated,
-            num_path_ignored,
-        ) = Poll.pull_results(poll.id)
-        results_log["flow-%s" % poll.flow_uuid] = {
-            "num_val_created": num_val_created,
-            "num_val_updated": num_val_updated,
-            "num_val_ignored": num_val_ignored,
-            "num_path_created": num_path_created,
-            "num_path_updated": num_path_updated,
-            "num_path_ignored": num_path_ignored,
-        }
-
-    return results_log
+    # a paused pull keeps the slot for the pull resuming it, the slot is released otherwise even when the pull fails
+    try:
+        Poll.pull_results(poll_id)
+    finally:
+        release_pull_slot(slot)
 
 
 @app.task()
@@ -219,22 +68,70 @@ def pull_refresh_from_archives(poll_id):
     Poll.pull_results_from_archives(poll_id)
 
 
+# downloading or decoding an archive can fail midway, pulling it again only rewrites the results already written
+@app.task(
+    name="polls.pull_refresh_from_archive",
+    autoretry_for=(requests.RequestException, OSError, EOFError, zlib.error),
+    max_retries=3,
+    retry_backoff=True,
+)
+def pull_refresh_from_archive(poll_id, archive_json):
+    from .models import Poll
+
+    return Poll.pull_results_from_archive(poll_id, archive_json)
+
+
+@app.task(name="polls.pull_refresh_from_archives_completed")
+def pull_refresh_from_archives_completed(archives_results, poll_id):
+    from .models import Poll
+
+    Poll.complete_pull_results_from_archives(archives_results, poll_id)
+
+
+@app.task(name="polls.prune_run_archives_cache")
+def prune_run_archives_cache():
+    from rtm.backend.archives import ArchiveStore
+    from rtm.backend.rapidpro import RUN_ARCHIVES_CACHE_DIR, RUN_ARCHIVES_CACHE_MAX_AGE
+
+    removed = ArchiveStore(RUN_ARCHIVES_CACHE_DIR).prune(RUN_ARCHIVES_CACHE_MAX_AGE)
+    logger.info("Removed %d unused run archives from %s" % (removed, RUN_ARCHIVES_CACHE_DIR))
+
+
 @app.task(name="polls.rebuild_counts")
 def rebuild_counts():
     from .models import Poll
+    from .rebuilds import clear_dirty_flows_without_polls, get_dirty_polls, schedule_rebuilds
 
     now = timezone.now()
     start = now - timedelta(days=365)
 
     polls = Poll.objects.filter(poll_date__gte=start)
 
-    for poll in polls:
+    # the flows of older polls are not rebuilt here, drop them so they do not pile up in the dirty flows
+    clear_dirty_flows_without_polls(polls)
+
+    # only the polls of the flows with results changed since they were last rebuilt
+    schedule_rebuilds(get_dirty_polls(polls))
+
+
+@app.task(name="polls.rebuild_polls_counts")
+def rebuild_polls_counts(poll_ids):
+    from .models import Poll
+
+    for poll in Poll.objects.filter(pk__in=poll_ids).order_by("pk"):
         poll.rebuild_poll_results_counts()
 
 
+@app.task(name="polls.run_requested_rebuilds")
+def run_requested_rebuilds():
+    from .rebuilds import run_requested_rebuilds as do_run_requested_rebuilds
+
+    do_run_requested_rebuilds()
+
+
 @app.task(name="update_results_age_gender")
 def update_results_age_gender(org_id=None):
-    from .models import Poll
+    from .rebuilds import get_dirty_flows, request_rebuild
 
     org = None
     if org_id:
@@ -242,11 +139,9 @@ def update_results_age_gender(org_id=None):
 
     populate_age_and_gender_poll_results(org)
 
-    polls = Poll.objects.all()
-    if org:
-        polls = polls.filter(org=org)
-    for poll in polls:
-        poll.rebuild_poll_results_counts()
+    # coalesced with the rebuilds already requested for the same flows
+    for flow_org_id, flow_uuid in get_dirty_flows(org.pk if org else None):
+        request_rebuild(flow_org_id, flow_uuid)
 
 
 @app.task(name="polls.refresh_org_flows")
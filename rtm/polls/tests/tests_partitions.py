@@ -0,0 +1,122 @@
+import uuid
+from datetime import timedelta
+
+from django.db import connection
+from django.test import TestCase
+
+from rtm.backend.loaders import POLL_RESULTS_LOADER_COPY, POLL_RESULTS_LOADER_INSERT, save_poll_results
+from rtm.polls.models import PollResult
+from rtm.polls.partitions import (
+    POLL_RESULTS_ORG_PARTITION,
+    create_org_partition,
+    has_org_partition,
+    is_poll_results_partitioned,
+    partition_poll_results,
+)
+from rtm.stats.models import ContactActivity
+from rtm.test import RTMTestMixin
+
+
+class PollResultsPartitionTest(RTMTestMixin, TestCase):
+    """
+    The conversion runs in the transaction of the test, so the table is unpartitioned again for the other tests
+    """
+
+    def setUp(self):
+        if connection.pg_version < 110000:
+            self.skipTest("Partitioning the poll results needs PostgreSQL 11 or later")
+
+    @staticmethod
+    def count_rows(table, org):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT COUNT(*) FROM %s WHERE org_id = %%s" % table, [org.pk])
+            return cursor.fetchone()[0]
+
+    @staticmethod
+    def get_activities(org):
+        return sorted(ContactActivity.objects.filter(org=org).values_list("contact", "date"))
+
+    @staticmethod
+    def copy_to_org(poll_results, org):
+        copied_fields = [f.attname for f in PollResult._meta.concrete_fields if f.attname not in ("id", "org_id")]
+        return [
+            PollResult(org=org, **{field: getattr(result, field) for field in copied_fields})
+            for result in poll_results
+        ]
+
+    def test_partition(self):
+        org, other_org = self.create_org(), self.create_org()
+        rulesets = [str(uuid.uuid4()) for i in range(2)]
+
+        poll_results = self.build_poll_results(org, 10, rulesets)
+        save_poll_results(poll_results, POLL_RESULTS_LOADER_INSERT)
+        self.assertFalse(is_poll_results_partitioned())
+        self.assertFalse(create_org_partition(org.pk))
+
+        self.assertTrue(partition_poll_results([org.pk, other_org.pk]))
+        self.assertTrue(is_poll_results_partitioned())
+        self.assertFalse(partition_poll_results([org.pk, other_org.pk]))
+
+        # the results were copied to the partition of their org
+        self.assertEqual(PollResult.objects.filter(org=org).count(), 20)
+        self.assertEqual(self.count_rows(POLL_RESULTS_ORG_PARTITION % org.pk, org), 20)
+        self.assertTrue(has_org_partition(other_org.pk))
+        self.assertFalse(create_org_partition(org.pk))
+
+        # the loaders write to the partitions, the activities triggers fire on them
+        other_results = self.copy_to_org(poll_results, other_org)
+        written = save_poll_results(other_results, POLL_RESULTS_LOADER_INSERT)
+        self.assertEqual(len(written), 20)
+        self.assertEqual(self.count_rows(POLL_RESULTS_ORG_PARTITION % other_org.pk, other_org), 20)
+        self.assertEqual(self.get_activities(other_org), self.get_activities(org))
+
+        # the ON CONFLICT upsert still keeps the newest result of each contact and question
+        newer, older = other_results[2], other_results[3]
+        newer.date += timedelta(hours=1)
+        newer.category = "No"
+        older.date -= timedelta(hours=1)
+        older.category = "No"
+
+        written = save_poll_results([newer, older], POLL_RESULTS_LOADER_INSERT)
+        self.assertEqual(written, [(newer.contact, newer.ruleset, False)])
+
+        self.assertEqual(PollResult.objects.filter(org=other_org).count(), 20)
+        self.assertEqual(
+            PollResult.objects.get(org=other_org, contact=newer.contact, ruleset=newer.ruleset).category, "No"
+        )
+        self.assertEqual(
+            PollResult.objects.get(org=other_org, contact=older.contact, ruleset=older.ruleset).category, "Yes"
+        )
+
+        # the ORM creates results on the partitions too
+        contact = str(uuid.uuid4())
+        PollResult.objects.create(
+            org=other_org,
+            flow=newer.flow,
+            ruleset=rulesets[0],
+            contact=contact,
+            date=newer.date,
+            completed=True,
+            category="Yes",
+            text="Yes",
+            state="R-LAGOS",
+            district="R-OYO",
+            ward="",
+            gender="M",
+            born=1990,
+        )
+        self.assertEqual(PollResult.objects.filter(org=other_org).count(), 21)
+        self.assertTrue(ContactActivity.objects.filter(org=other_org, contact=contact).exists())
+
+        # the results of an org created later go to the default partition until it gets its own
+        new_org = self.create_org()
+        save_poll_results(self.copy_to_org(poll_results, new_org), POLL_RESULTS_LOADER_COPY)
+        self.assertEqual(self.count_rows("polls_pollresult_default", new_org), 20)
+        self.assertFalse(has_org_partition(new_org.pk))
+
+        self.assertTrue(create_org_partition(new_org.pk))
+        self.assertFalse(create_org_partition(new_org.pk))
+        self.assertEqual(self.count_rows("polls_pollresult_default", new_org), 0)
+        self.assertEqual(self.count_rows(POLL_RESULTS_ORG_PARTITION % new_org.pk, new_org), 20)
+        self.assertEqual(PollResult.objects.filter(org=new_org).count(), 20)
+        self.assertEqual(self.get_activities(new_org), self.get_activities(org))
@@ -0,0 +1,35 @@
+import uuid
+
+from django.test import TransactionTestCase
+
+from rtm.polls.models import PollResult
+from rtm.polls.purge import purge_flow_results
+from rtm.stats.models import ContactActivity
+from rtm.test import RTMTestMixin
+
+
+class PollResultsPurgeTest(RTMTestMixin, TransactionTestCase):
+    def test_purge_flow_results(self):
+        org = self.create_org()
+        rulesets = [str(uuid.uuid4()), str(uuid.uuid4())]
+
+        poll_results = self.build_poll_results(org, 25, rulesets)
+        other_results = self.build_poll_results(org, 5, rulesets)
+        PollResult.objects.bulk_create(poll_results + other_results)
+        flow = poll_results[0].flow
+
+        num_activities = ContactActivity.objects.filter(org=org).count()
+        self.assertTrue(num_activities)
+
+        progress = []
+        self.assertEqual(purge_flow_results(org.pk, flow, batch_size=20, progress=progress.append), 50)
+
+        # deleted in batches, the last short one ends the purge
+        self.assertEqual(progress, [20, 40, 50])
+        self.assertFalse(PollResult.objects.filter(org=org, flow=flow).exists())
+
+        # the results of other flows and the contact activities are kept
+        self.assertEqual(PollResult.objects.filter(org=org).count(), len(other_results))
+        self.assertEqual(ContactActivity.objects.filter(org=org).count(), num_activities)
+
+        self.assertEqual(purge_flow_results(org.pk, flow), 0)
@@ -0,0 +1,286 @@
+import uuid
+from collections import defaultdict
+from datetime import timedelta
+from unittest.mock import patch
+
+from django.db import DatabaseError
+from django.db.backends.utils import CursorWrapper
+from django.test import SimpleTestCase, TransactionTestCase
+from django.utils import timezone
+
+from rtm.locations.models import Boundary
+from rtm.polls.models import (
+    INSERT_POLL_STATS_SQL,
+    Poll,
+    PollQuestion,
+    PollResponseCategory,
+    PollResult,
+    PollResultsCounter,
+)
+from rtm.polls.rebuilds import (
+    POLL_RESULTS_REBUILD_DEBOUNCE,
+    POLL_RESULTS_REBUILD_MAX_DELAY,
+    get_dirty_flows,
+    mark_flow_dirty,
+    pop_due_rebuilds,
+    request_rebuild,
+)
+from rtm.polls.tasks import rebuild_counts
+from rtm.stats.models import AgeSegment, GenderSegment, PollStats
+from rtm.test import RTMTestMixin
+
+
+class PollResultsCountsRebuildTest(RTMTestMixin, TransactionTestCase):
+    CATEGORIES = ("Yes", "yes", "NO", "Other", "No Response", "", None)
+    TEXTS = ("Yes", "", None, "None", "some\ttext")
+    STATES = ("R-LAGOS", "r-lagos", "R-UNKNOWN", "", None)
+    GENDERS = ("M", "f", "O", "X", "", None)
+    BORNS = (1990, 2005, 2030, 0, None)
+
+    def setUp(self):
+        for gender in ("M", "F", "O"):
+            GenderSegment.objects.get_or_create(gender=gender)
+        for min_age in AgeSegment.MIN_AGES:
+            AgeSegment.objects.get_or_create(min_age=min_age)
+
+    def create_results(self, poll, num_contacts, rulesets):
+        Boundary.objects.create(org=poll.org, osm_id="R-LAGOS", name="Lagos", level=1, geometry="{}")
+        Boundary.objects.create(org=poll.org, osm_id="R-OYO", name="Oyo", level=2, geometry="{}")
+
+        now = timezone.now()
+        poll_results = []
+        for i in range(num_contacts):
+            contact = str(uuid.uuid4())
+            for j, ruleset in enumerate(rulesets):
+                k = i + j
+                poll_results.append(
+                    PollResult(
+                        org=poll.org,
+                        flow=poll.flow_uuid,
+                        ruleset=ruleset,
+                        contact=contact,
+                        date=now - timedelta(days=i % 5, hours=j),
+                        completed=i % 2 == 0,
+                        category=self.CATEGORIES[k % len(self.CATEGORIES)],
+                        text=self.TEXTS[k % len(self.TEXTS)],
+                        state=self.STATES[k % len(self.STATES)],
+                        district="R-OYO" if k % 4 == 0 else "",
+                        ward="R-WARD" if k % 11 == 0 else None,
+                        gender=self.GENDERS[k % len(self.GENDERS)],
+                        born=self.BORNS[k % len(self.BORNS)],
+                    )
+                )
+
+        PollResult.objects.bulk_create(poll_results)
+        return poll_results
+
+    @staticmethod
+    def generate_expected(poll, poll_results):
+        """
+        Aggregates the counters and stats of the results in Python with generate_counters and generate_poll_stats
+        """
+        counters_dict = defaultdict(int)
+        stats_dict = defaultdict(int)
+        for result in poll_results:
+            for key, count in result.generate_counters().items():
+                counters_dict[(result.org_id, result.ruleset, key)] += count
+            for key, count in result.generate_poll_stats().items():
+                stats_dict[key] += count
+
+        counters = sorted((ruleset,) + key + (count,) for (org_id, ruleset, key), count in counters_dict.items())
+        stats = sorted(
+            (stat.question_id, stat.category_id, stat.age_segment_id, stat.gender_segment_id, stat.location_id)
+            + (stat.date, stat.count)
+            for stat in poll.build_poll_stats(stats_dict, poll.get_poll_stats_lookups())
+        )
+        return counters, stats
+
+    def generate_expected_stats(self, poll, poll_results):
+        # keyed like get_stats
+        return sorted((stat[:-1], stat[-1]) for stat in self.generate_expected(poll, poll_results)[1])
+
+    @staticmethod
+    def get_rebuilt(poll, rulesets):
+        counters = sorted(
+            PollResultsCounter.objects.filter(org=poll.org, ruleset__in=rulesets).values_list(
+                "ruleset", "kind", "category", "value", "count"
+            )
+        )
+        stats = sorted(
+            PollStats.objects.filter(org=poll.org).values_list(
+                "question", "category", "age_segment", "gender_segment", "location", "date", "count"
+            )
+        )
+        return counters, stats
+
+    def test_rebuild_matches_generate_counters(self):
+        org = self.create_org()
+        poll = self.create_poll(org, 3)
+        rulesets = list(poll.questions.values_list("ruleset_uuid", flat=True))
+
+        # results of rulesets which are not questions of the poll get counters but no stats
+        poll_results = self.create_results(poll, 120, rulesets + [str(uuid.uuid4())])
+        expected_counters, expected_stats = self.generate_expected(poll, poll_results)
+
+        poll.rebuild_poll_results_counts()
+        counters, stats = self.get_rebuilt(poll, rulesets + [poll_results[-1].ruleset])
+
+        self.assertEqual(counters, expected_counters)
+        self.assertEqual(stats, expected_stats)
+
+        # rebuilding again replaces the counters of the questions
+        poll.rebuild_poll_results_counts()
+        self.assertEqual(self.get_rebuilt(poll, rulesets)[1], expected_stats)
+
+    def test_rebuild_shared_flow(self):
+        org = self.create_org()
+        poll = self.create_poll(org, 2)
+        rulesets = list(poll.questions.values_list("ruleset_uuid", flat=True))
+
+        # a duplicate of the poll, with the same flow and questions
+        other_poll = self.create_poll(org, 0)
+        other_poll.flow_uuid = poll.flow_uuid
+        other_poll.save()
+        for question in poll.questions.all():
+            other_question = PollQuestion.objects.create(
+                poll=other_poll,
+                title=question.title,
+                ruleset_uuid=question.ruleset_uuid,
+                sdgs=[],
+                created_by=org.created_by,
+                modified_by=org.created_by,
+            )
+            for category in ("Yes", "No"):
+                PollResponseCategory.objects.create(
+                    question=other_question, rule_uuid=str(uuid.uuid4()), category=category
+                )
+
+        poll_results = self.create_results(poll, 60, rulesets + [str(uuid.uuid4())])
+        expected_counters = self.generate_expected(poll, poll_results)[0]
+        all_rulesets = rulesets + [poll_results[-1].ruleset]
+
+        # rebuilding either poll rebuilds the counters of the flow once and the stats of both polls
+        for rebuilt_poll in (poll, other_poll, poll):
+            rebuilt_poll.rebuild_poll_results_counts()
+
+            self.assertEqual(self.get_rebuilt(poll, all_rulesets)[0], expected_counters)
+            self.assertEqual(self.get_stats(poll), self.generate_expected_stats(poll, poll_results))
+            self.assertEqual(self.get_stats(other_poll), self.generate_expected_stats(other_poll, poll_results))
+
+    def test_rebuild_is_atomic(self):
+        org = self.create_org()
+        poll = self.create_poll(org, 2)
+        rulesets = list(poll.questions.values_list("ruleset_uuid", flat=True))
+
+        self.create_results(poll, 40, rulesets)
+        poll.rebuild_poll_results_counts()
+        rebuilt = self.get_rebuilt(poll, rulesets)
+        self.assertTrue(rebuilt[0])
+        self.assertTrue(rebuilt[1])
+
+        # a rebuild failing after the counters were replaced leaves the previous counters and stats in place
+        execute = CursorWrapper.execute
+
+        def failing_execute(cursor, sql, params=None):
+            if sql == INSERT_POLL_STATS_SQL:
+                raise DatabaseError("failed")
+            return execute(cursor, sql, params)
+
+        with patch.object(CursorWrapper, "execute", autospec=True, side_effect=failing_execute):
+            with self.assertRaises(DatabaseError):
+                poll.rebuild_poll_results_counts()
+
+        self.assertEqual(self.get_rebuilt(poll, rulesets), rebuilt)
+
+    def test_question_results(self):
+        org = self.create_org()
+        poll = self.create_poll(org, 2)
+        rulesets = list(poll.questions.values_list("ruleset_uuid", flat=True))
+
+        poll_results = self.create_results(poll, 60, rulesets)
+        poll.rebuild_poll_results_counts()
+
+        question = poll.questions.order_by("pk").first()
+        question_results = [result for result in poll_results if result.ruleset == question.ruleset_uuid]
+
+        def get_category(result):
+            category = (result.category or "").lower()
+            return "" if category in PollResponseCategory.IGNORED_CATEGORY_RULES else category
+
+        def count_results(category, **kwargs):
+            return len(
+                [
+                    result
+                    for result in question_results
+                    if (get_category(result) == category if category is not None else get_category(result))
+                    and all(condition(result) for condition in kwargs.values())
+                ]
+            )
+
+        results = question.calculate_results()[0]
+        self.assertEqual(
+            results["categories"],
+            [dict(count=count_results("yes"), label="Yes"), dict(count=count_results("no"), label="No")],
+        )
+
+        male = dict(gender=lambda result: (result.gender or "").lower() == "m")
+        results = {result["label"]: result for result in question.calculate_results(segment=dict(gender="Gender"))}
+        self.assertEqual(results["Male"]["set"], count_results(None, **male))
+        self.assertEqual(results["Male"]["unset"], count_results("", **male))
+        self.assertEqual(results["Male"]["categories"][0], dict(count=count_results("yes", **male), label="Yes"))
+
+        poll_year = poll.poll_date.year
+        older = dict(born=lambda result: bool(result.born) and 35 <= poll_year - result.born < 2000)
+        results = {result["label"]: result for result in question.calculate_results(segment=dict(age="Age"))}
+        self.assertEqual(results["35+"]["set"], count_results(None, **older))
+        self.assertEqual(results["35+"]["unset"], count_results("", **older))
+
+
+class PollResultsDirtyFlowsRebuildTest(RTMTestMixin, TransactionTestCase):
+    @patch("rtm.polls.tasks.rebuild_polls_counts.delay")
+    def test_rebuild_counts(self, mock_rebuild_polls_counts):
+        org = self.create_org()
+        poll = self.create_poll(org, 1)
+        old_poll = self.create_poll(org, 1)
+        Poll.objects.filter(pk=old_poll.pk).update(poll_date=timezone.now() - timedelta(days=400))
+        deleted_flow = str(uuid.uuid4())
+
+        for flow_uuid in (poll.flow_uuid, old_poll.flow_uuid, deleted_flow):
+            mark_flow_dirty(org.pk, flow_uuid)
+
+        rebuild_counts()
+
+        # only the recent poll is rebuilt, the flows without one are not left dirty forever
+        rebuilt = [poll_id for call in mock_rebuild_polls_counts.call_args_list for poll_id in call[0][0]]
+        self.assertEqual(rebuilt, [poll.pk])
+        self.assertEqual(get_dirty_flows(org.pk), [(org.pk, poll.flow_uuid)])
+
+
+class PollResultsRebuildRequestsTest(SimpleTestCase):
+    @patch("rtm.polls.rebuilds.time.time")
+    def test_requests_coalesced(self, mock_time):
+        flow_uuid = str(uuid.uuid4())
+        now = 1000000.0
+
+        mock_time.return_value = now
+        request_rebuild(1, flow_uuid)
+
+        # requests in a burst push the rebuild back
+        mock_time.return_value = now + POLL_RESULTS_REBUILD_DEBOUNCE - 1
+        self.assertNotIn((1, flow_uuid), pop_due_rebuilds())
+        request_rebuild(1, flow_uuid)
+
+        mock_time.return_value = now + POLL_RESULTS_REBUILD_DEBOUNCE + 1
+        self.assertNotIn((1, flow_uuid), pop_due_rebuilds())
+
+        # but never past the max delay from the first request
+        mock_time.return_value = now + POLL_RESULTS_REBUILD_MAX_DELAY - POLL_RESULTS_REBUILD_DEBOUNCE / 2
+        request_rebuild(1, flow_uuid)
+        mock_time.return_value = now + POLL_RESULTS_REBUILD_MAX_DELAY
+        self.assertEqual(pop_due_rebuilds().count((1, flow_uuid)), 1)
+
+        # taken once, a new request starts a new burst
+        self.assertNotIn((1, flow_uuid), pop_due_rebuilds())
+        request_rebuild(1, flow_uuid)
+        mock_time.return_value = now + POLL_RESULTS_REBUILD_MAX_DELAY + POLL_RESULTS_REBUILD_DEBOUNCE
+        self.assertIn((1, flow_uuid), pop_due_rebuilds())
@@ -0,0 +1,187 @@
+import time
+from datetime import timedelta
+from unittest.mock import patch
+
+from django_redis import get_redis_connection
+
+from django.core.cache import cache
+from django.test import TransactionTestCase
+from django.utils import timezone
+
+from rtm.backend import BaseBackend
+from rtm.polls.models import Poll, SyncRun
+from rtm.polls.scheduler import (
+    POLL_RESULTS_PULL_SLOTS_KEY,
+    PULL_PRIORITY_BACKFILL,
+    PULL_PRIORITY_BRICK,
+    PULL_PRIORITY_MAIN,
+    PULL_PRIORITY_OTHER,
+    PULL_PRIORITY_RECENT,
+    get_flow_priorities,
+    get_pull_candidates,
+    get_pull_slot,
+    schedule_pulls,
+)
+from rtm.polls.tasks import pull_poll_results
+from rtm.test import RTMTestMixin
+from rtm.utils import datetime_to_json_date
+
+
+class PollResultsSchedulerTest(RTMTestMixin, TransactionTestCase):
+    def setUp(self):
+        get_redis_connection().delete(POLL_RESULTS_PULL_SLOTS_KEY)
+
+        self.org = self.create_org()
+        month_ago = timezone.now() - timedelta(days=30)
+
+        self.main_poll = self.create_poll(self.org, 1)
+        self.brick_poll = self.create_poll(self.org, 1)
+        self.recent_poll = self.create_poll(self.org, 0)
+        self.backfill_poll = self.create_poll(self.org, 0)
+        self.other_poll = self.create_poll(self.org, 0)
+
+        # a poll of the main flow that is not synced yet, and an inactive one
+        self.main_copy_poll = self.create_poll(self.org, 0)
+        self.inactive_poll = self.create_poll(self.org, 0)
+
+        Poll.objects.filter(pk=self.main_poll.pk).update(is_featured=True, has_synced=True)
+        Poll.objects.filter(pk=self.brick_poll.pk).update(has_synced=True, created_on=month_ago)
+        Poll.objects.filter(pk=self.recent_poll.pk).update(has_synced=True)
+        Poll.objects.filter(pk=self.other_poll.pk).update(has_synced=True, created_on=month_ago)
+        Poll.objects.filter(pk=self.main_copy_poll.pk).update(flow_uuid=self.main_poll.flow_uuid)
+        Poll.objects.filter(pk=self.inactive_poll.pk).update(is_active=False)
+
+    def tearDown(self):
+        get_redis_connection().delete(POLL_RESULTS_PULL_SLOTS_KEY)
+
+    def set_last_sync_time(self, poll, sync_time):
+        cache.set(
+            Poll.POLL_RESULTS_LAST_SYNC_TIME_CACHE_KEY % (self.org.pk, poll.flow_uuid),
+            datetime_to_json_date(sync_time),
+            None,
+        )
+
+    def test_get_flow_priorities(self):
+        self.assertEqual(
+            get_flow_priorities(self.org),
+            {
+                self.main_poll.flow_uuid: (self.main_poll.pk, PULL_PRIORITY_MAIN),
+                self.recent_poll.flow_uuid: (self.recent_poll.pk, PULL_PRIORITY_RECENT),
+                self.brick_poll.flow_uuid: (self.brick_poll.pk, PULL_PRIORITY_BRICK),
+                self.backfill_poll.flow_uuid: (self.backfill_poll.pk, PULL_PRIORITY_BACKFILL),
+                self.other_poll.flow_uuid: (self.other_poll.pk, PULL_PRIORITY_OTHER),
+            },
+        )
+
+    def test_get_pull_candidates(self):
+        now = timezone.now()
+
+        # flows never synced are all due
+        candidates = get_pull_candidates(self.org, now=now)
+        self.assertEqual(len(candidates), 5)
+        self.assertEqual(set(candidate.score for candidate in candidates), {2.0})
+
+        # flows synced within their interval are not due, overdue ones are scored by how overdue they are
+        self.set_last_sync_time(self.main_poll, now - timedelta(minutes=10))
+        self.set_last_sync_time(self.other_poll, now - timedelta(days=3))
+        self.set_last_sync_time(self.brick_poll, now - timedelta(days=30))
+
+        sync_run = SyncRun.start(self.recent_poll, SyncRun.SOURCE_API)
+        sync_run.num_runs = 99
+        sync_run.save()
+
+        candidates = {candidate.flow_uuid: candidate for candidate in get_pull_candidates(self.org, now=now)}
+        self.assertNotIn(self.main_poll.flow_uuid, candidates)
+        self.assertAlmostEqual(candidates[self.other_poll.flow_uuid].score, 3.0)
+        self.assertAlmostEqual(candidates[self.brick_poll.flow_uuid].score, 10.0)
+        self.assertAlmostEqual(candidates[self.recent_poll.flow_uuid].score, 6.0)
+        self.assertEqual(candidates[self.recent_poll.flow_uuid].poll_id, self.recent_poll.pk)
+
+        # a paused pull is left to resume on its own, keeping its slot until then
+        with patch("rtm.polls.tasks.pull_poll_results.apply_async") as mock_pull_poll_results:
+            BaseBackend._mark_poll_results_sync_paused(
+                self.org, self.backfill_poll, "cursor", None, None, None, countdown=600
+            )
+            slot = get_pull_slot(self.org.pk, self.backfill_poll.flow_uuid)
+            mock_pull_poll_results.assert_called_once_with((self.backfill_poll.pk, slot), countdown=600, queue="sync")
+
+        self.assertAlmostEqual(
+            get_redis_connection().zscore(POLL_RESULTS_PULL_SLOTS_KEY, slot),
+            time.time() + 600 + Poll.POLL_SYNC_LOCK_TIMEOUT,
+            delta=5,
+        )
+
+        candidates = {candidate.flow_uuid for candidate in get_pull_candidates(self.org, now=now)}
+        self.assertNotIn(self.backfill_poll.flow_uuid, candidates)
+
+        candidates = {
+            candidate.flow_uuid for candidate in get_pull_candidates(self.org, now=now + timedelta(minutes=11))
+        }
+        self.assertIn(self.backfill_poll.flow_uuid, candidates)
+
+        BaseBackend._mark_poll_results_sync_completed(self.backfill_poll, self.org, None)
+        self.assertIsNone(
+            cache.get(Poll.POLL_RESULTS_PAUSED_UNTIL_CACHE_KEY % (self.org.pk, self.backfill_poll.flow_uuid))
+        )
+
+    @patch("rtm.polls.scheduler.POLL_RESULTS_PULL_CONCURRENCY", 3)
+    @patch("rtm.polls.tasks.pull_poll_results.apply_async")
+    def test_schedule_pulls(self, mock_pull_poll_results):
+        r = get_redis_connection()
+        recent_slot = get_pull_slot(self.org.pk, self.recent_poll.flow_uuid)
+        dead_slot = get_pull_slot(self.org.pk, self.other_poll.flow_uuid)
+        r.zadd(POLL_RESULTS_PULL_SLOTS_KEY, {recent_slot: time.time() + 60, dead_slot: time.time() - 60})
+
+        # the slot of a dead pull is freed, the flow already being pulled is skipped
+        dispatched = schedule_pulls([self.org])
+        self.assertEqual([candidate.poll_id for candidate in dispatched], [self.main_poll.pk, self.brick_poll.pk])
+
+        main_slot = get_pull_slot(self.org.pk, self.main_poll.flow_uuid)
+        brick_slot = get_pull_slot(self.org.pk, self.brick_poll.flow_uuid)
+        self.assertEqual(
+            [call[0][0] for call in mock_pull_poll_results.call_args_list],
+            [(self.main_poll.pk, main_slot), (self.brick_poll.pk, brick_slot)],
+        )
+        self.assertEqual(
+            set(slot.decode("utf-8") for slot in r.zrange(POLL_RESULTS_PULL_SLOTS_KEY, 0, -1)),
+            {recent_slot, main_slot, brick_slot},
+        )
+
+        # no free slots left
+        self.assertEqual(schedule_pulls([self.org]), [])
+
+    @patch("rtm.polls.models.Poll.pull_results")
+    def test_pull_poll_results(self, mock_pull_results):
+        r = get_redis_connection()
+        slot = get_pull_slot(self.org.pk, self.main_poll.flow_uuid)
+
+        r.zadd(POLL_RESULTS_PULL_SLOTS_KEY, {slot: time.time() + 60})
+        pull_poll_results(self.main_poll.pk, slot)
+        mock_pull_results.assert_called_once_with(self.main_poll.pk)
+        self.assertIsNone(r.zscore(POLL_RESULTS_PULL_SLOTS_KEY, slot))
+
+        # the slot is released when the pull fails too
+        mock_pull_results.side_effect = ValueError("boom")
+        r.zadd(POLL_RESULTS_PULL_SLOTS_KEY, {slot: time.time() + 60})
+        with self.assertRaises(ValueError):
+            pull_poll_results(self.main_poll.pk, slot)
+        self.assertIsNone(r.zscore(POLL_RESULTS_PULL_SLOTS_KEY, slot))
+
+        # a pull that paused keeps the slot for the pull resuming it, which releases it once done
+        def pause(poll_id):
+            with patch("rtm.polls.tasks.pull_poll_results.apply_async") as mock_pull_poll_results:
+                BaseBackend._mark_poll_results_sync_paused(
+                    self.org, self.main_poll, "cursor", None, None, None, countdown=600
+                )
+                mock_pull_poll_results.assert_called_once_with((self.main_poll.pk, slot), countdown=600, queue="sync")
+
+        mock_pull_results.side_effect = pause
+        r.zadd(POLL_RESULTS_PULL_SLOTS_KEY, {slot: time.time() + 60})
+        pull_poll_results(self.main_poll.pk, slot)
+        self.assertIsNotNone(r.zscore(POLL_RESULTS_PULL_SLOTS_KEY, slot))
+
+        mock_pull_results.side_effect = lambda poll_id: BaseBackend._mark_poll_results_sync_completed(
+            self.main_poll, self.org, None
+        )
+        pull_poll_results(self.main_poll.pk, slot)
+        self.assertIsNone(r.zscore(POLL_RESULTS_PULL_SLOTS_KEY, slot))
@@ -0,0 +1,108 @@
+import json
+from datetime import timedelta
+from unittest.mock import patch
+
+from django.test import RequestFactory, TransactionTestCase
+from django.utils import timezone
+
+from rtm.polls.models import SyncRun
+from rtm.polls.views import PollCRUDL
+from rtm.test import RTMTestMixin
+
+
+class SyncRunTest(RTMTestMixin, TransactionTestCase):
+    def setUp(self):
+        self.org = self.create_org()
+        self.poll = self.create_poll(self.org, 1)
+
+    @staticmethod
+    def get_stats_dict(**kwargs):
+        stats_dict = dict(
+            num_val_created=0,
+            num_val_updated=0,
+            num_val_ignored=0,
+            num_path_created=0,
+            num_path_updated=0,
+            num_path_ignored=0,
+            num_synced=0,
+        )
+        stats_dict.update(kwargs)
+        return stats_dict
+
+    def create_sync_run(self, poll, duration, started_on):
+        return SyncRun.objects.create(
+            org=poll.org,
+            poll=poll,
+            source=SyncRun.SOURCE_API,
+            started_on=started_on,
+            ended_on=started_on + timedelta(seconds=duration),
+            duration=duration,
+        )
+
+    def test_sync_run(self):
+        sync_run = SyncRun.start(self.poll, SyncRun.SOURCE_API)
+        self.assertIsNone(sync_run.pk)
+
+        sync_run.add_fetch(250, 1.5, 0.25, 0.5)
+        sync_run.add_fetch(100, 0.5, 0.25, 0.5)
+        sync_run.finish(
+            self.get_stats_dict(
+                num_val_created=3, num_path_created=2, num_val_updated=4, num_val_ignored=1, num_path_ignored=5
+            ),
+            SyncRun.PAUSE_MAX_RUNS,
+        )
+
+        sync_run = SyncRun.objects.get(pk=sync_run.pk)
+        self.assertEqual((sync_run.org_id, sync_run.poll_id, sync_run.source), (self.org.pk, self.poll.pk, "A"))
+        self.assertEqual((sync_run.num_fetches, sync_run.num_runs), (2, 350))
+        self.assertEqual((sync_run.api_wait_time, sync_run.diff_time, sync_run.db_write_time), (2.0, 0.5, 1.0))
+        self.assertEqual((sync_run.num_created, sync_run.num_updated, sync_run.num_ignored), (5, 4, 6))
+        self.assertEqual(sync_run.pause_reason, SyncRun.PAUSE_MAX_RUNS)
+        self.assertIsNotNone(sync_run.ended_on)
+        self.assertGreaterEqual(sync_run.duration, 0)
+        self.assertGreater(sync_run.peak_memory, 0)
+        self.assertEqual(sync_run.as_json()["pause_reason"], "Max runs")
+
+        sync_run = SyncRun.start(self.poll, SyncRun.SOURCE_ARCHIVE)
+        sync_run.add_fetch(10, 0, 0.1, 0.2)
+        sync_run.finish(self.get_stats_dict(num_path_updated=7))
+
+        sync_run = SyncRun.objects.get(pk=sync_run.pk)
+        self.assertEqual((sync_run.num_fetches, sync_run.num_runs), (1, 10))
+        self.assertEqual((sync_run.num_created, sync_run.num_updated, sync_run.num_ignored), (0, 7, 0))
+        self.assertIsNone(sync_run.pause_reason)
+        self.assertIsNone(sync_run.as_json()["pause_reason"])
+
+    def test_slowest_syncs(self):
+        now = timezone.now()
+        other_org = self.create_org()
+        other_poll = self.create_poll(other_org, 1)
+
+        slow = self.create_sync_run(self.poll, 300, now - timedelta(days=1))
+        fast = self.create_sync_run(self.poll, 10, now - timedelta(days=2))
+        old = self.create_sync_run(self.poll, 900, now - timedelta(days=10))
+        self.create_sync_run(other_poll, 600, now - timedelta(days=1))
+
+        # syncs still running are not listed
+        SyncRun.objects.create(org=self.org, poll=self.poll, source=SyncRun.SOURCE_API, started_on=now)
+
+        def get_slowest_syncs(**params):
+            request = RequestFactory().get("/poll/slowest_syncs/", params)
+            request.org = self.org
+
+            view = PollCRUDL.SlowestSyncs()
+            view.request = request
+            response = json.loads(view.render_to_response(dict()).content)
+            return response["days"], [sync_run["id"] for sync_run in response["results"]]
+
+        self.assertEqual(get_slowest_syncs(), (7, [slow.pk, fast.pk]))
+        self.assertEqual(get_slowest_syncs(days=30), (30, [old.pk, slow.pk, fast.pk]))
+        self.assertEqual(get_slowest_syncs(days=30, limit=2), (30, [old.pk, slow.pk]))
+
+        # bad values fall back to the defaults
+        self.assertEqual(get_slowest_syncs(days="x", limit=1), (7, [slow.pk, fast.pk]))
+
+        with patch.object(SyncRun, "get_slowest", return_value=[]) as mock_get_slowest:
+            self.assertEqual(get_slowest_syncs(limit=1000), (7, []))
+            self.assertEqual(mock_get_slowest.call_args[1]["org"], self.org)
+            self.assertEqual(mock_get_slowest.call_args[1]["limit"], PollCRUDL.SlowestSyncs.MAX_LIMIT)
@@ -28,7 +28,7 @@ from django.views.generic import View
 from dash.orgs.models import OrgBackend
 from rtm.utils import json_date_to_datetime, get_paginator
 
-from .models import Poll, PollImage, PollQuestion
+from .models import Poll, PollImage, PollQuestion, SyncRun
 
 
 class PollForm(forms.ModelForm):
@@ -190,6 +190,7 @@ class PollCRUDL(SmartCRUDL):
         "import",
         "poll_date",
         "poll_flow",
+        "slowest_syncs",
     )
 
     class PollDate(OrgObjPermsMixin, SmartUpdateView):
@@ -688,6 +689,30 @@ class PollCRUDL(SmartCRUDL):
 
             return obj
 
+    class SlowestSyncs(OrgPermsMixin, SmartTemplateView):
+        """
+        JSON list of the slowest poll syncs of the org in the last days
+        """
+
+        DEFAULT_DAYS = 7
+        DEFAULT_LIMIT = 20
+        MAX_LIMIT = 200
+
+        def derive_url_pattern(path, action):
+            return "^poll/slowest_syncs/"
+
+        def render_to_response(self, context, **kwargs):
+            try:
+                days = int(self.request.GET.get("days", self.DEFAULT_DAYS))
+                limit = min(int(self.request.GET.get("limit", self.DEFAULT_LIMIT)), self.MAX_LIMIT)
+            except ValueError:
+                days, limit = self.DEFAULT_DAYS, self.DEFAULT_LIMIT
+
+            since = timezone.now() - timedelta(days=days)
+            sync_runs = SyncRun.get_slowest(org=self.request.org, since=since, limit=limit)
+
+            return JsonResponse(dict(days=days, results=[sync_run.as_json() for sync_run in sync_runs]))
+
     class PullRefresh(SmartUpdateView):
         fields = ("id",)
         success_url = "@polls.poll_list"
@@ -258,7 +258,7 @@ PERMISSIONS = {
     ),  # can view a list of the objects
     "dashblocks.dashblock": ("html",),
     "orgs.org": ("choose", "edit", "home", "manage_accounts", "create_login", "join", "refresh_cache"),
-    "polls.poll": ("questions", "responses", "images", "pull_refresh", "poll_date", "poll_flow"),
+    "polls.poll": ("questions", "responses", "images", "pull_refresh", "poll_date", "poll_flow", "slowest_syncs"),
     "stories.story": ("html", "images"),
 }
 
@@ -369,39 +369,26 @@ CELERYBEAT_SCHEDULE = {
         "schedule": timedelta(minutes=20),
         "relative": True,
     },
+    "prune_run_archives_cache": {
+        "task": "polls.prune_run_archives_cache",
+        "schedule": timedelta(hours=24),
+        "relative": True,
+    },
     "contact-pull": {
         "task": "dash.orgs.tasks.trigger_org_task",
         "schedule": crontab(minute=[0, 10, 20, 30, 40, 50]),
         "args": ("rtm.contacts.tasks.pull_contacts",),
     },
-    "backfill-poll-results": {
-        "task": "dash.orgs.tasks.trigger_org_task",
-        "schedule": timedelta(minutes=10),
-        "relative": True,
-        "args": ("rtm.polls.tasks.backfill_poll_results", "sync"),
-    },
-    "results-pull-main-poll": {
-        "task": "dash.orgs.tasks.trigger_org_task",
-        "schedule": crontab(minute=[5, 25, 45]),
-        "args": ("rtm.polls.tasks.pull_results_main_poll", "sync"),
-    },
-    "results-pull-recent-polls": {
-        "task": "dash.orgs.tasks.trigger_org_task",
-        "schedule": timedelta(hours=1),
-        "relative": True,
-        "args": ("rtm.polls.tasks.pull_results_recent_polls", "sync"),
-    },
-    "results-pull-brick-polls": {
-        "task": "dash.orgs.tasks.trigger_org_task",
-        "schedule": timedelta(hours=1),
+    "rebuild-poll-results-counts": {"task": "polls.rebuild_counts", "schedule": crontab(hour=2, minute=0)},
+    "run-requested-poll-results-rebuilds": {
+        "task": "polls.run_requested_rebuilds",
+        "schedule": timedelta(minutes=1),
         "relative": True,
-        "args": ("rtm.polls.tasks.pull_results_brick_polls", "sync"),
     },
-    "results-pull-other-polls": {
-        "task": "dash.orgs.tasks.trigger_org_task",
-        "schedule": timedelta(hours=1),
+    "schedule-poll-results-pulls": {
+        "task": "polls.schedule_poll_results_pulls",
+        "schedule": timedelta(minutes=1),
         "relative": True,
-        "args": ("rtm.polls.tasks.pull_results_other_polls", "sync"),
     },
     "refresh-engagement-data": {
         "task": "dash.orgs.tasks.trigger_org_task",
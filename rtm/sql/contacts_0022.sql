@@ -0,0 +1,109 @@
+-----------------------------------------------------------------------------
+-- Updates our reporters counters once per statement, from the contacts it
+-- changed. The transition tables are only visible from the trigger function
+-- so the queries are all here
+-----------------------------------------------------------------------------
+CREATE OR REPLACE FUNCTION ureport_update_counters_for_statement() RETURNS TRIGGER AS $$
+BEGIN
+  -- Contacts being created or deleted, every counter of the active contacts with an org summed up by org and type
+  IF TG_OP = 'INSERT' OR TG_OP = 'DELETE' THEN
+    EXECUTE format($sql$
+      INSERT INTO contacts_reporterscounter("org_id", "type", "count")
+      SELECT c.org_id, counters.type, SUM(%2$s)
+      FROM %1$I c
+      CROSS JOIN LATERAL (VALUES
+        ('total-reporters'),
+        (CASE WHEN c.gender IS NOT NULL THEN CONCAT('gender:', LOWER(c.gender)) END),
+        (CASE WHEN c.born IS NOT NULL THEN CONCAT('born:', LOWER(CAST(c.born AS VARCHAR ))) END),
+        (CASE WHEN c.occupation IS NOT NULL THEN CONCAT('occupation:', LOWER(c.occupation)) END),
+        (CASE WHEN c.registered_on IS NOT NULL THEN CONCAT('registered_on:', DATE(c.registered_on)) END),
+        (CASE WHEN c.registered_on IS NOT NULL AND c.gender IS NOT NULL THEN CONCAT('registered_gender:', DATE(date_trunc('month', c.registered_on)::timestamp), ':', LOWER(c.gender)) END),
+        (CASE WHEN c.registered_on IS NOT NULL AND c.born IS NOT NULL THEN CONCAT('registered_born:', DATE(date_trunc('month', c.registered_on)::timestamp), ':', LOWER(CAST(c.born AS VARCHAR ))) END),
+        (CASE WHEN c.registered_on IS NOT NULL AND c.state IS NOT NULL THEN CONCAT('registered_state:', DATE(date_trunc('month', c.registered_on)::timestamp), ':', UPPER(c.state)) END),
+        (CASE WHEN c.state IS NOT NULL THEN CONCAT('state:', UPPER(c.state)) END),
+        (CASE WHEN c.district IS NOT NULL THEN CONCAT('district:', UPPER(c.district)) END),
+        (CASE WHEN c.ward IS NOT NULL THEN CONCAT('ward:', UPPER(c.ward)) END)
+      ) AS counters(type)
+      WHERE c.org_id IS NOT NULL AND c.is_active AND counters.type IS NOT NULL
+      GROUP BY c.org_id, counters.type
+    $sql$, CASE WHEN TG_OP = 'INSERT' THEN 'new_contacts' ELSE 'old_contacts' END, CASE WHEN TG_OP = 'INSERT' THEN 1 ELSE -1 END);
+  -- Contacts being changed, adjust the counters like ureport_adjust_counter_for_contact does for each of them
+  ELSIF TG_OP = 'UPDATE' THEN
+    INSERT INTO contacts_reporterscounter("org_id", "type", "count")
+    SELECT counters.org_id, counters.type, SUM(counters.count)
+    FROM old_contacts o
+    JOIN new_contacts n ON n.id = o.id
+    CROSS JOIN LATERAL (
+      -- no org id, or no longer active, decrement all reporters counters for the previous values
+      SELECT o.org_id, previous.type, -1
+      FROM (VALUES
+        ('total-reporters'),
+        (CASE WHEN o.gender IS NOT NULL THEN CONCAT('gender:', LOWER(o.gender)) END),
+        (CASE WHEN o.born IS NOT NULL THEN CONCAT('born:', LOWER(CAST(o.born AS VARCHAR ))) END),
+        (CASE WHEN o.occupation IS NOT NULL THEN CONCAT('occupation:', LOWER(o.occupation)) END),
+        (CASE WHEN o.registered_on IS NOT NULL THEN CONCAT('registered_on:', DATE(o.registered_on)) END),
+        (CASE WHEN o.registered_on IS NOT NULL AND o.gender IS NOT NULL THEN CONCAT('registered_gender:', DATE(date_trunc('month', o.registered_on)::timestamp), ':', LOWER(o.gender)) END),
+        (CASE WHEN o.registered_on IS NOT NULL AND o.born IS NOT NULL THEN CONCAT('registered_born:', DATE(date_trunc('month', o.registered_on)::timestamp), ':', LOWER(CAST(o.born AS VARCHAR ))) END),
+        (CASE WHEN o.registered_on IS NOT NULL AND o.state IS NOT NULL THEN CONCAT('registered_state:', DATE(date_trunc('month', o.registered_on)::timestamp), ':', UPPER(o.state)) END),
+        (CASE WHEN o.state IS NOT NULL THEN CONCAT('state:', UPPER(o.state)) END),
+        (CASE WHEN o.district IS NOT NULL THEN CONCAT('district:', UPPER(o.district)) END),
+        (CASE WHEN o.ward IS NOT NULL THEN CONCAT('ward:', UPPER(o.ward)) END)
+      ) AS previous(type)
+      WHERE o.org_id IS NOT NULL AND o.is_active AND previous.type IS NOT NULL
+      AND (n.org_id IS NULL OR (n.is_active != o.is_active AND NOT n.is_active))
+
+      UNION ALL
+
+      -- same org, move each changed value from the previous counter to the new one
+      SELECT changed.org_id, changed.type, changed.count
+      FROM (VALUES
+        (o.org_id, CASE WHEN n.gender != o.gender THEN CONCAT('gender:', LOWER(o.gender)) END, -1),
+        (n.org_id, CASE WHEN n.gender != o.gender THEN CONCAT('gender:', LOWER(n.gender)) END, 1),
+        (o.org_id, CASE WHEN n.born != o.born THEN CONCAT('born:', LOWER(CAST(o.born AS VARCHAR ))) END, -1),
+        (n.org_id, CASE WHEN n.born != o.born THEN CONCAT('born:', LOWER(CAST(n.born AS VARCHAR ))) END, 1),
+        (o.org_id, CASE WHEN n.occupation != o.occupation THEN CONCAT('occupation:', LOWER(o.occupation)) END, -1),
+        (n.org_id, CASE WHEN n.occupation != o.occupation THEN CONCAT('occupation:', LOWER(n.occupation)) END, 1),
+        (o.org_id, CASE WHEN n.registered_on != o.registered_on THEN CONCAT('registered_on:', DATE(o.registered_on)) END, -1),
+        (n.org_id, CASE WHEN n.registered_on != o.registered_on THEN CONCAT('registered_on:', DATE(n.registered_on)) END, 1),
+        (o.org_id, CASE WHEN n.registered_on != o.registered_on AND n.gender != o.gender THEN CONCAT('registered_gender:', DATE(date_trunc('month', o.registered_on)::timestamp), ':', LOWER(o.gender)) END, -1),
+        (n.org_id, CASE WHEN n.registered_on != o.registered_on AND n.gender != o.gender THEN CONCAT('registered_gender:', DATE(date_trunc('month', n.registered_on)::timestamp), ':', LOWER(n.gender)) END, 1),
+        (o.org_id, CASE WHEN n.registered_on != o.registered_on AND n.born != o.born THEN CONCAT('registered_born:', DATE(date_trunc('month', o.registered_on)::timestamp), ':', LOWER(CAST(o.born AS VARCHAR ))) END, -1),
+        (n.org_id, CASE WHEN n.registered_on != o.registered_on AND n.born != o.born THEN CONCAT('registered_born:', DATE(date_trunc('month', n.registered_on)::timestamp), ':', LOWER(CAST(n.born AS VARCHAR ))) END, 1),
+        (o.org_id, CASE WHEN n.registered_on != o.registered_on AND n.state != o.state THEN CONCAT('registered_state:', DATE(date_trunc('month', o.registered_on)::timestamp), ':', UPPER(o.state)) END, -1),
+        (n.org_id, CASE WHEN n.registered_on != o.registered_on AND n.state != o.state THEN CONCAT('registered_state:', DATE(date_trunc('month', n.registered_on)::timestamp), ':', UPPER(n.state)) END, 1),
+        (o.org_id, CASE WHEN n.state != o.state THEN CONCAT('state:', UPPER(o.state)) END, -1),
+        (n.org_id, CASE WHEN n.state != o.state THEN CONCAT('state:', UPPER(n.state)) END, 1),
+        (o.org_id, CASE WHEN n.district != o.district THEN CONCAT('district:', UPPER(o.district)) END, -1),
+        (n.org_id, CASE WHEN n.district != o.district THEN CONCAT('district:', UPPER(n.district)) END, 1),
+        (o.org_id, CASE WHEN n.ward != o.ward THEN CONCAT('ward:', UPPER(o.ward)) END, -1),
+        (n.org_id, CASE WHEN n.ward != o.ward THEN CONCAT('ward:', UPPER(n.ward)) END, 1)
+      ) AS changed(org_id, type, count)
+      WHERE n.org_id = o.org_id AND (n.is_active != o.is_active) IS NOT TRUE AND changed.type IS NOT NULL
+    ) AS counters(org_id, type, count)
+    GROUP BY counters.org_id, counters.type
+    HAVING SUM(counters.count) <> 0;
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Replace the row trigger on INSERT DELETE OR UPDATE on contacts_contact, transition tables need a trigger per event
+DROP TRIGGER IF EXISTS ureport_when_contacts_update_then_update_counters on contacts_contact;
+
+DROP TRIGGER IF EXISTS ureport_when_contacts_insert_then_update_counters on contacts_contact;
+CREATE TRIGGER ureport_when_contacts_insert_then_update_counters
+  AFTER INSERT ON contacts_contact
+  REFERENCING NEW TABLE AS new_contacts
+  FOR EACH STATEMENT EXECUTE PROCEDURE ureport_update_counters_for_statement();
+
+DROP TRIGGER IF EXISTS ureport_when_contacts_change_then_update_counters on contacts_contact;
+CREATE TRIGGER ureport_when_contacts_change_then_update_counters
+  AFTER UPDATE ON contacts_contact
+  REFERENCING OLD TABLE AS old_contacts NEW TABLE AS new_contacts
+  FOR EACH STATEMENT EXECUTE PROCEDURE ureport_update_counters_for_statement();
+
+DROP TRIGGER IF EXISTS ureport_when_contacts_delete_then_update_counters on contacts_contact;
+CREATE TRIGGER ureport_when_contacts_delete_then_update_counters
+  AFTER DELETE ON contacts_contact
+  REFERENCING OLD TABLE AS old_contacts
+  FOR EACH STATEMENT EXECUTE PROCEDURE ureport_update_counters_for_statement();
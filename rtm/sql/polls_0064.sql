@@ -0,0 +1,23 @@
+-----------------------------------------------------------------------------
+-- Updates our results counters, unless the loader maintains them itself
+-----------------------------------------------------------------------------
+CREATE OR REPLACE FUNCTION ureport_update_contact_activities() RETURNS TRIGGER AS $$
+BEGIN
+  -- bulk loaders insert the contact activities of the rows they load in one set based step
+  IF TG_OP <> 'TRUNCATE' AND current_setting('ureport.skip_contact_activities', true) = 'on' THEN
+    RETURN NULL;
+  END IF;
+
+  -- PollResult being created, increment counters for poll_result NEW
+  IF TG_OP = 'INSERT' THEN
+    PERFORM generate_contact_activities_for_latest_poll_result(NEW);
+  ELSIF TG_OP = 'UPDATE' THEN
+    PERFORM generate_contact_activities_for_latest_poll_result(NEW);
+  -- poll_result is being deleted
+  ELSIF TG_OP = 'TRUNCATE' THEN
+   -- Clear all contact_activities
+   TRUNCATE stats_contactactivity;
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,8 @@
+-----------------------------------------------------------------------------
+-- Deleted poll results have no contact activities work, stop firing for them
+-- so that purges do not pay a trigger call for every deleted row
+-----------------------------------------------------------------------------
+DROP TRIGGER IF EXISTS ureport_when_poll_result_contact_activities on polls_pollresult;
+CREATE TRIGGER ureport_when_poll_result_contact_activities
+  AFTER INSERT OR UPDATE ON polls_pollresult
+  FOR EACH ROW EXECUTE PROCEDURE ureport_update_contact_activities();
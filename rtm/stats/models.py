@@ -22,13 +22,14 @@ class GenderSegment(models.Model):
 
 
 class AgeSegment(models.Model):
+    MIN_AGES = [0, 15, 20, 25, 31, 35]
+
     min_age = models.IntegerField(null=True)
     max_age = models.IntegerField(null=True)
 
     @classmethod
     def get_age_segment_min_age(cls, age):
-        min_ages = [0, 15, 20, 25, 31, 35]
-        return [elt for elt in min_ages if age >= elt][-1]
+        return [elt for elt in cls.MIN_AGES if age >= elt][-1]
 
 
 class PollStats(models.Model):
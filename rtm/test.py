@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import uuid
+from datetime import timedelta
+
+from dash.categories.models import Category
+from dash.orgs.models import Org
+
+from django.contrib.auth.models import User
+from django.db.models import Sum
+from django.utils import timezone
+
+from rtm.polls.models import Poll, PollQuestion, PollResponseCategory, PollResult, PollResultsCounter
+from rtm.stats.models import PollStats
+
+
+class RTMTestMixin(object):
+    """
+    Fixtures shared by the tests of the apps, creating orgs, polls and their results
+    """
+
+    def create_org(self):
+        user = User.objects.create(username="loader-%s" % uuid.uuid4().hex[:8])
+        return Org.objects.create(
+            name="Loader", language="en", subdomain=uuid.uuid4().hex[:12], created_by=user, modified_by=user
+        )
+
+    def create_poll(self, org, num_questions):
+        user = org.created_by
+        category, _ = Category.objects.get_or_create(
+            org=org, name="Counts", defaults=dict(created_by=user, modified_by=user)
+        )
+        poll = Poll.objects.create(
+            org=org,
+            flow_uuid=str(uuid.uuid4()),
+            title="Counts",
+            category=category,
+            poll_date=timezone.now(),
+            created_by=user,
+            modified_by=user,
+        )
+
+        for i in range(num_questions):
+            question = PollQuestion.objects.create(
+                poll=poll,
+                title="Question %d" % i,
+                ruleset_uuid=str(uuid.uuid4()),
+                sdgs=[],
+                created_by=user,
+                modified_by=user,
+            )
+            for category in ("Yes", "No"):
+                PollResponseCategory.objects.create(question=question, rule_uuid=str(uuid.uuid4()), category=category)
+
+        return poll
+
+    def build_poll_results(self, org, num_contacts, rulesets):
+        flow = str(uuid.uuid4())
+        now = timezone.now()
+        poll_results = []
+        for i in range(num_contacts):
+            contact = str(uuid.uuid4())
+            for j, ruleset in enumerate(rulesets):
+                poll_results.append(
+                    PollResult(
+                        org=org,
+                        flow=flow,
+                        ruleset=ruleset,
+                        contact=contact,
+                        date=now - timedelta(days=i % 60, minutes=j),
+                        completed=i % 2 == 0,
+                        category=None if i % 10 == 0 else "Yes",
+                        text="line\twith\\special\nchars" if i % 7 == 0 else "Yes",
+                        state="R-LAGOS" if i % 3 else None,
+                        district="R-OYO",
+                        ward="",
+                        gender="M" if i % 2 else "F",
+                        born=1990 + i % 20,
+                    )
+                )
+        return poll_results
+
+    @staticmethod
+    def get_counters(poll):
+        rulesets = poll.questions.values_list("ruleset_uuid", flat=True)
+        counters = PollResultsCounter.objects.filter(org=poll.org, ruleset__in=rulesets)
+        counters = counters.values_list("ruleset", "kind", "category", "value").annotate(total=Sum("count"))
+        return sorted(counter for counter in counters if counter[-1])
+
+    @staticmethod
+    def get_stats(poll):
+        stats = PollStats.objects.filter(org=poll.org, question__poll=poll)
+        stats = stats.values_list(
+            "question", "category", "age_segment", "gender_segment", "location", "date"
+        ).annotate(total=Sum("count"))
+        return sorted((stat[:-1], stat[-1]) for stat in stats if stat[-1])
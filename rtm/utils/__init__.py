@@ -26,11 +26,13 @@ from django.contrib.admin.models import ACTION_FLAG_CHOICES, LogEntry
 from rtm.channels.models import ChannelDailyStats
 from rtm.locations.models import Boundary
 from rtm.polls.models import Poll, PollResult
+from rtm.polls.rebuilds import mark_flows_dirty
 from rtm.stats.models import PollStats, GenderSegment, AgeSegment
 
 GLOBAL_COUNT_CACHE_KEY = "global_count"
 
-ORG_CONTACT_COUNT_KEY = "org:%d:contacts-counts"
+# the reporters counts of an org are cached by family of counters
+ORG_CONTACT_COUNT_KEY = "org:%d:contacts-counts:%s"
 ORG_CONTACT_COUNT_TIMEOUT = 300
 
 logger = logging.getLogger(__name__)
@@ -258,28 +260,32 @@ def get_global_count():
     return count
 
 
-def get_org_contacts_counts(org):
-
+def get_org_contacts_counts(org, family):
+    """
+    Gets the reporters counts of the org for a single family of counters, as ReportersCounter.get_family_counts
+    """
     from rtm.contacts.models import ReportersCounter
 
-    key = ORG_CONTACT_COUNT_KEY % org.pk
+    key = ORG_CONTACT_COUNT_KEY % (org.pk, family)
     org_contacts_counts = cache.get(key, None)
-    if org_contacts_counts:
+    if org_contacts_counts is not None:
         return org_contacts_counts
 
-    org_contacts_counts = ReportersCounter.get_counts(org)
+    org_contacts_counts = ReportersCounter.get_family_counts(org, family)
     cache.set(key, org_contacts_counts, ORG_CONTACT_COUNT_TIMEOUT)
     return org_contacts_counts
 
 
 def get_gender_stats(org):
-    org_contacts_counts = get_org_contacts_counts(org)
+    from rtm.contacts.models import ReportersCounter
+
+    gender_counts = get_org_contacts_counts(org, ReportersCounter.FAMILY_GENDER)
 
     has_extra_gender = org.get_config("common.has_extra_gender")
 
-    female_count = org_contacts_counts.get("gender:f", 0)
-    male_count = org_contacts_counts.get("gender:m", 0)
-    other_count = org_contacts_counts.get("gender:o", 0)
+    female_count = gender_counts.get("f", 0)
+    male_count = gender_counts.get("m", 0)
+    other_count = gender_counts.get("o", 0)
 
     if not female_count and not male_count:
         output = dict(female_count=female_count, female_percentage="---", male_count=male_count, male_percentage="---")
@@ -315,12 +321,14 @@ def get_gender_stats(org):
 
 
 def get_age_stats(org):
+    from rtm.contacts.models import ReportersCounter
+
     now = timezone.now()
     current_year = now.year
 
-    org_contacts_counts = get_org_contacts_counts(org)
+    born_counts = get_org_contacts_counts(org, ReportersCounter.FAMILY_BORN)
 
-    year_counts = {k[-4:]: v for k, v in org_contacts_counts.items() if k.startswith("born:") and len(k) == 9}
+    year_counts = {k: v for k, v in born_counts.items() if len(k) == 4}
 
     age_counts_interval = dict()
     age_counts_interval["0-14"] = 0
@@ -355,25 +363,23 @@ def get_age_stats(org):
 
 
 def get_sign_up_rate(org, time_filter):
+    from rtm.contacts.models import ReportersCounter
+
     now = timezone.now()
     year_ago = now - timedelta(days=365)
     start = year_ago.replace(day=1)
-    tz = pytz.timezone("UTC")
 
-    org_contacts_counts = get_org_contacts_counts(org)
-
-    registered_on_counts = {k[14:]: v for k, v in org_contacts_counts.items() if k.startswith("registered_on")}
+    registered_on_counts = get_org_contacts_counts(org, ReportersCounter.FAMILY_REGISTERED_ON)
 
     interval_dict = defaultdict(int)
 
-    for date_key, date_count in registered_on_counts.items():
-        parsed_time = tz.localize(datetime.strptime(date_key, "%Y-%m-%d")).replace(
-            day=1, hour=0, minute=0, second=0, microsecond=0
-        )
+    for registered_on, date_count in registered_on_counts.items():
+        registered_month = registered_on.replace(day=1)
 
-        if parsed_time > start:
+        # the months whose first day, at midnight UTC, is after the start
+        if registered_month > start.date():
 
-            interval_dict[str(parsed_time.date())] += date_count
+            interval_dict[str(registered_month)] += date_count
 
     keys = get_last_months(months_num=time_filter)
     data = dict()
@@ -384,14 +390,18 @@ def get_sign_up_rate(org, time_filter):
 
 
 def get_sign_up_rate_location(org, time_filter):
+    from rtm.contacts.models import ReportersCounter
+
     now = timezone.now()
     year_ago = now - timedelta(days=365)
     start = year_ago.replace(day=1)
-    tz = pytz.timezone("UTC")
 
-    org_contacts_counts = get_org_contacts_counts(org)
+    registered_state_counts = get_org_contacts_counts(org, ReportersCounter.FAMILY_REGISTERED_STATE)
 
-    registered_on_counts = {k[17:]: v for k, v in org_contacts_counts.items() if k.startswith("registered_state")}
+    state_interval_dicts = defaultdict(lambda: defaultdict(int))
+    for (registered_month, state), date_count in registered_state_counts.items():
+        if registered_month > start.date():
+            state_interval_dicts[state][str(registered_month)] += date_count
 
     top_boundaries = Boundary.get_org_top_level_boundaries_name(org)
 
@@ -399,19 +409,7 @@ def get_sign_up_rate_location(org, time_filter):
     output_data = []
 
     for osm_id, name in top_boundaries.items():
-        interval_dict = defaultdict(int)
-        for date_key, date_count in registered_on_counts.items():
-            if date_key.endswith(f":{osm_id.upper()}"):
-                date_key = date_key[:10]
-            else:
-                continue
-
-            parsed_time = tz.localize(datetime.strptime(date_key, "%Y-%m-%d")).replace(
-                day=1, hour=0, minute=0, second=0, microsecond=0
-            )
-
-            if parsed_time > start:
-                interval_dict[str(parsed_time.date())] += date_count
+        interval_dict = state_interval_dicts[osm_id.upper()]
 
         data = dict()
         for key in keys:
@@ -421,14 +419,18 @@ def get_sign_up_rate_location(org, time_filter):
 
 
 def get_sign_up_rate_gender(org, time_filter):
+    from rtm.contacts.models import ReportersCounter
+
     now = timezone.now()
     year_ago = now - timedelta(days=365)
     start = year_ago.replace(day=1)
-    tz = pytz.timezone("UTC")
 
-    org_contacts_counts = get_org_contacts_counts(org)
+    registered_gender_counts = get_org_contacts_counts(org, ReportersCounter.FAMILY_REGISTERED_GENDER)
 
-    registered_on_counts = {k[18:]: v for k, v in org_contacts_counts.items() if k.startswith("registered_gender")}
+    gender_interval_dicts = defaultdict(lambda: defaultdict(int))
+    for (registered_month, gender), date_count in registered_gender_counts.items():
+        if registered_month > start.date():
+            gender_interval_dicts[gender][str(registered_month)] += date_count
 
     genders = GenderSegment.objects.all()
     if not org.get_config("common.has_extra_gender"):
@@ -440,19 +442,7 @@ def get_sign_up_rate_gender(org, time_filter):
     output_data = []
 
     for gender in genders:
-        interval_dict = defaultdict(int)
-        for date_key, date_count in registered_on_counts.items():
-            if date_key.endswith(f":{gender['gender'].lower()}"):
-                date_key = date_key[:-2]
-            else:
-                continue
-
-            parsed_time = tz.localize(datetime.strptime(date_key, "%Y-%m-%d")).replace(
-                day=1, hour=0, minute=0, second=0, microsecond=0
-            )
-
-            if parsed_time > start:
-                interval_dict[str(parsed_time.date())] += date_count
+        interval_dict = gender_interval_dicts[gender["gender"].lower()]
 
         data = dict()
         for key in keys:
@@ -462,15 +452,14 @@ def get_sign_up_rate_gender(org, time_filter):
 
 
 def get_sign_up_rate_age(org, time_filter):
+    from rtm.contacts.models import ReportersCounter
+
     now = timezone.now()
     current_year = now.year
     year_ago = now - timedelta(days=365)
     start = year_ago.replace(day=1)
-    tz = pytz.timezone("UTC")
-
-    org_contacts_counts = get_org_contacts_counts(org)
 
-    registered_on_counts = {k[16:]: v for k, v in org_contacts_counts.items() if k.startswith("registered_born")}
+    registered_born_counts = get_org_contacts_counts(org, ReportersCounter.FAMILY_REGISTERED_BORN)
     registered_on_counts_by_age = {
         "0-14": defaultdict(int),
         "15-19": defaultdict(int),
@@ -479,17 +468,13 @@ def get_sign_up_rate_age(org, time_filter):
         "31-34": defaultdict(int),
         "35+": defaultdict(int),
     }
-    for date_key, date_count in registered_on_counts.items():
-        date_key_date, date_key_year = date_key.split(":")
-        parsed_time = tz.localize(datetime.strptime(date_key_date, "%Y-%m-%d")).replace(
-            day=1, hour=0, minute=0, second=0, microsecond=0
-        )
-        if parsed_time < start:
+    for (registered_month, born), date_count in registered_born_counts.items():
+        if registered_month <= start.date():
             continue
 
-        date_key_date = str(parsed_time.date())
+        date_key_date = str(registered_month)
 
-        age = current_year - int(date_key_year)
+        age = current_year - int(born)
         if age > 34:
             registered_on_counts_by_age["35+"][date_key_date] += date_count
         elif age > 30:
@@ -531,24 +516,21 @@ def get_sign_up_rate_age(org, time_filter):
 
 
 def get_registration_stats(org):
+    from rtm.contacts.models import ReportersCounter
+
     now = timezone.now()
     six_months_ago = now - timedelta(days=180)
     six_months_ago = six_months_ago - timedelta(six_months_ago.weekday())
-    tz = pytz.timezone("UTC")
-
-    org_contacts_counts = get_org_contacts_counts(org)
 
-    registered_on_counts = {k[14:]: v for k, v in org_contacts_counts.items() if k.startswith("registered_on")}
+    registered_on_counts = get_org_contacts_counts(org, ReportersCounter.FAMILY_REGISTERED_ON)
 
     interval_dict = dict()
 
-    for date_key, date_count in registered_on_counts.items():
-        parsed_time = tz.localize(datetime.strptime(date_key, "%Y-%m-%d"))
-
-        # this is in the range we care about
-        if parsed_time > six_months_ago:
+    for registered_on, date_count in registered_on_counts.items():
+        # this is in the range we care about, the days starting after it at midnight UTC
+        if registered_on > six_months_ago.date():
             # get the week of the year
-            dict_key = parsed_time.strftime("%W")
+            dict_key = registered_on.strftime("%W")
 
             if interval_dict.get(dict_key, None):
                 interval_dict[dict_key] += date_count
@@ -569,24 +551,21 @@ def get_registration_stats(org):
 
 
 def get_reporter_registration_dates(org):
+    from rtm.contacts.models import ReportersCounter
+
     now = timezone.now()
     one_year_ago = now - timedelta(days=365)
     one_year_ago = one_year_ago - timedelta(one_year_ago.weekday())
-    tz = pytz.timezone("UTC")
-
-    org_contacts_counts = get_org_contacts_counts(org)
 
-    registered_on_counts = {k[14:]: v for k, v in org_contacts_counts.items() if k.startswith("registered_on")}
+    registered_on_counts = get_org_contacts_counts(org, ReportersCounter.FAMILY_REGISTERED_ON)
 
     interval_dict = dict()
 
-    for date_key, date_count in registered_on_counts.items():
-        parsed_time = tz.localize(datetime.strptime(date_key, "%Y-%m-%d"))
-
-        # this is in the range we care about
-        if parsed_time > one_year_ago:
+    for registered_on, date_count in registered_on_counts.items():
+        # this is in the range we care about, the days starting after it at midnight UTC
+        if registered_on > one_year_ago.date():
             # get the week of the year
-            dict_key = parsed_time.strftime("%W")
+            dict_key = registered_on.strftime("%W")
 
             if interval_dict.get(dict_key, None):
                 interval_dict[dict_key] += date_count
@@ -629,7 +608,8 @@ def get_ureporters_locations_stats(org, segment):
 
     field_type = field_type.lower()
 
-    org_contacts_counts = get_org_contacts_counts(org)
+    # the families of the location counters are named after the location fields
+    location_counts = get_org_contacts_counts(org, field_type)
 
     if field_type == "state":
         boundary_top_level = Boundary.COUNTRY_LEVEL if org.get_config("common.is_global") else Boundary.STATE_LEVEL
@@ -638,7 +618,6 @@ def get_ureporters_locations_stats(org, segment):
             .values("osm_id", "name")
             .order_by("osm_id")
         )
-        location_counts = {k[6:]: v for k, v in org_contacts_counts.items() if k.startswith("state")}
 
     elif field_type == "ward":
         boundaries = (
@@ -646,7 +625,6 @@ def get_ureporters_locations_stats(org, segment):
             .values("osm_id", "name")
             .order_by("osm_id")
         )
-        location_counts = {k[5:]: v for k, v in org_contacts_counts.items() if k.startswith("ward")}
     else:
         boundaries = (
             Boundary.objects.filter(
@@ -655,7 +633,6 @@ def get_ureporters_locations_stats(org, segment):
             .values("osm_id", "name")
             .order_by("osm_id")
         )
-        location_counts = {k[9:]: v for k, v in org_contacts_counts.items() if k.startswith("district")}
 
     return [
         dict(boundary=elt["osm_id"], label=elt["name"], set=location_counts.get(elt["osm_id"], 0))
@@ -724,16 +701,17 @@ def get_ureporters_locations_response_rates(org, segment):
 
 
 def get_reporters_count(org):
-    org_contacts_counts = get_org_contacts_counts(org)
+    from rtm.contacts.models import ReportersCounter
 
-    return org_contacts_counts.get("total-reporters", 0)
+    total_counts = get_org_contacts_counts(org, ReportersCounter.FAMILY_TOTAL)
 
+    return total_counts.get("", 0)
 
-def get_occupation_stats(org):
 
-    org_contacts_counts = get_org_contacts_counts(org)
+def get_occupation_stats(org):
+    from rtm.contacts.models import ReportersCounter
 
-    occupation_counts = {k[11:]: v for k, v in org_contacts_counts.items() if k.startswith("occupation")}
+    occupation_counts = get_org_contacts_counts(org, ReportersCounter.FAMILY_OCCUPATION)
 
     return json.dumps(
         sorted(
@@ -749,12 +727,11 @@ def get_occupation_stats(org):
 
 
 def get_regions_stats(org):
+    from rtm.contacts.models import ReportersCounter
 
-    org_contacts_counts = get_org_contacts_counts(org)
+    boundaries_stats = get_org_contacts_counts(org, ReportersCounter.FAMILY_STATE)
     boundaries_name = Boundary.get_org_top_level_boundaries_name(org)
 
-    boundaries_stats = {k[6:]: v for k, v in org_contacts_counts.items() if len(k) > 7 and k.startswith("state")}
-
     regions_stats = sorted(
         [dict(name=boundaries_name[k], count=v) for k, v in boundaries_stats.items() if k and k in boundaries_name],
         key=lambda i: i["count"],
@@ -824,6 +801,7 @@ def populate_age_and_gender_poll_results(org=None):
     for contact_id_batch in chunk_list(all_contacts, 1000):
         contact_batch = list(contact_id_batch)
         contacts = Contact.objects.filter(id__in=contact_batch)
+        updated_flows = set()
         for contact in contacts:
             i += 1
 
@@ -835,12 +813,16 @@ def populate_age_and_gender_poll_results(org=None):
                 update_fields["gender"] = contact.gender
 
             if update_fields:
-                results_ids = list(PollResult.objects.filter(contact=contact.uuid).values_list("id", flat=True))
-                PollResult.objects.filter(id__in=results_ids).update(**update_fields)
+                results = list(PollResult.objects.filter(contact=contact.uuid).values_list("id", "org_id", "flow"))
+                PollResult.objects.filter(id__in=[result[0] for result in results]).update(**update_fields)
+                updated_flows.update((org_id, flow) for result_id, org_id, flow in results)
 
             if org is None:
                 cache.set(LAST_POPULATED_CONTACT, contact.pk, None)
 
+        # the counters of the flows of the updated results need a rebuild
+        mark_flows_dirty(updated_flows)
+
         logger.info(
             "Processed poll results update %d / %d contacts in %ds" % (i, len(all_contacts), time.time() - start)
         )